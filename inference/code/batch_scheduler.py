@@ -0,0 +1,161 @@
+''' Dynamic micro-batching of inference requests.
+
+Requests submitted for the same key (model id) are queued and grouped into
+one batch. A batch is flushed as soon as it holds max_batch_size requests or
+the oldest request has waited max_wait_ms. The batch function runs once per
+batch and returns one result per request, which is handed back to the
+waiting caller.
+'''
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class BatchStats(object):
+    ''' Histograms of flushed batch sizes and queue depths at submit time '''
+    DEPTH_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64]
+    DEPTH_LABELS = ['0', '1', '2-3', '4-7', '8-15', '16-31', '32-63', '64+']
+
+    def __init__(self, max_batch_size):
+        self._lock = threading.Lock()
+        self.batch_size_hist = [0] * (max_batch_size + 1)
+        self.queue_depth_hist = [0] * len(self.DEPTH_BUCKETS)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.total_wait = 0.0
+
+    def record_submit(self, depth):
+        bucket = 0
+        for i, lower in enumerate(self.DEPTH_BUCKETS):
+            if depth >= lower:
+                bucket = i
+        with self._lock:
+            self.queue_depth_hist[bucket] += 1
+
+    def record_batch(self, batch_size, waits):
+        with self._lock:
+            self.batch_size_hist[batch_size] += 1
+            self.num_batches += 1
+            self.num_requests += batch_size
+            self.total_wait += sum(waits)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'mean_batch_size': self.num_requests / float(max(self.num_batches, 1)),
+                'mean_queue_wait_ms': 1000.0 * self.total_wait / max(self.num_requests, 1),
+                'batch_size_histogram': {str(k): v for k, v in enumerate(self.batch_size_hist) if k > 0},
+                'queue_depth_histogram': dict(zip(self.DEPTH_LABELS, self.queue_depth_hist)),
+            }
+
+
+class _PendingRequest(object):
+    def __init__(self, item):
+        self.item = item
+        self.enqueue_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    ''' Queue plus worker thread that batches requests for a single key
+
+    Args:
+        run_batch_fn: callable(list of items) -> list of results (same length)
+        max_batch_size: flush when this many requests are queued
+        max_wait_ms: flush when the oldest queued request waited this long
+    '''
+    def __init__(self, run_batch_fn, max_batch_size=8, max_wait_ms=10):
+        assert(max_batch_size >= 1)
+        self.run_batch_fn = run_batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = BatchStats(max_batch_size)
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='MicroBatcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, item):
+        ''' Enqueue item and block until its result is available '''
+        request = _PendingRequest(item)
+        self.stats.record_submit(self._queue.qsize())
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueue_time + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.time()
+            self.stats.record_batch(len(batch), [start - r.enqueue_time for r in batch])
+            try:
+                results = self.run_batch_fn([r.item for r in batch])
+                assert(len(results) == len(batch))
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+
+class BatchScheduler(object):
+    ''' One MicroBatcher per key, created on first use
+
+    Args:
+        run_batch_fn: callable(key, list of items) -> list of results
+    '''
+    def __init__(self, run_batch_fn, max_batch_size=8, max_wait_ms=10):
+        self.run_batch_fn = run_batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def _get_batcher(self, key):
+        with self._lock:
+            if key not in self._batchers:
+                self._batchers[key] = MicroBatcher(
+                    lambda items, key=key: self.run_batch_fn(key, items),
+                    self.max_batch_size, self.max_wait_ms)
+            return self._batchers[key]
+
+    def submit(self, key, item):
+        return self._get_batcher(key).submit(item)
+
+    def stats(self):
+        ''' Per-key queue depth and batching histograms '''
+        with self._lock:
+            batchers = dict(self._batchers)
+        ret = {}
+        for key, batcher in batchers.items():
+            ret[key] = batcher.stats.snapshot()
+            ret[key]['queue_depth'] = batcher.queue_depth()
+        return ret
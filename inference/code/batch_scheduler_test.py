@@ -0,0 +1,91 @@
+''' Testing the micro-batching of concurrent requests. '''
+
+import threading
+import time
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from batch_scheduler import MicroBatcher, BatchScheduler
+
+def _submit_concurrently(submit, items):
+    ''' Submit every item from its own thread, returns {item: result or exception} '''
+    results = {}
+    def run(item):
+        try:
+            results[item] = submit(item)
+        except Exception as e:
+            results[item] = e
+    threads = [threading.Thread(target=run, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+def test_flush_at_max_batch_size():
+    batches = []
+    def run_batch(items):
+        batches.append(list(items))
+        return [item*10 for item in items]
+    batcher = MicroBatcher(run_batch, max_batch_size=4, max_wait_ms=5000)
+    tic = time.time()
+    results = _submit_concurrently(batcher.submit, range(4))
+    assert time.time() - tic < 4 # flushed when full, not after max_wait
+    assert [len(batch) for batch in batches] == [4]
+    assert results == {item: item*10 for item in range(4)} # routed back to the submitting caller
+
+def test_flush_after_max_wait():
+    batches = []
+    def run_batch(items):
+        batches.append(list(items))
+        return items
+    batcher = MicroBatcher(run_batch, max_batch_size=8, max_wait_ms=100)
+    tic = time.time()
+    assert batcher.submit('a') == 'a'
+    assert time.time() - tic >= 0.09
+    assert batches == [['a']]
+
+def test_result_routing():
+    # results in reverse order of the items, every caller must still get its own
+    def run_batch(items):
+        time.sleep(0.01)
+        return [('result', item) for item in items]
+    scheduler = BatchScheduler(lambda key, items: [(key, r) for r in run_batch(items)],
+        max_batch_size=3, max_wait_ms=20)
+    results = _submit_concurrently(lambda item: scheduler.submit(item % 2, item), range(10))
+    assert results == {item: (item % 2, ('result', item)) for item in range(10)}
+    assert sorted(scheduler.stats().keys()) == [0, 1]
+
+def test_exception_propagates_to_every_waiter():
+    error = RuntimeError('forward pass failed')
+    def run_batch(items):
+        if 'bad' in items:
+            raise error
+        return items
+    batcher = MicroBatcher(run_batch, max_batch_size=3, max_wait_ms=5000)
+    results = _submit_concurrently(batcher.submit, ['x', 'y', 'bad'])
+    assert all(results[item] is error for item in ['x', 'y', 'bad'])
+    # the worker survives a failed batch
+    results = _submit_concurrently(batcher.submit, ['u', 'v', 'w'])
+    assert results == {'u': 'u', 'v': 'v', 'w': 'w'}
+
+def test_stats():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=2, max_wait_ms=5000)
+    _submit_concurrently(batcher.submit, ['a', 'b'])
+    _submit_concurrently(batcher.submit, ['c', 'd'])
+    stats = batcher.stats.snapshot()
+    assert stats['num_requests'] == 4 and stats['num_batches'] == 2
+    assert stats['mean_batch_size'] == 2
+    assert stats['batch_size_histogram'] == {'1': 0, '2': 2}
+    # every submit saw a queue depth of 0 or 1
+    assert sum(stats['queue_depth_histogram'].values()) == 4
+    assert stats['queue_depth_histogram']['0'] + stats['queue_depth_histogram']['1'] == 4
+
+if __name__=='__main__':
+    test_flush_at_max_batch_size()
+    test_flush_after_max_wait()
+    test_result_routing()
+    test_exception_propagates_to_every_waiter()
+    test_stats()
@@ -0,0 +1,56 @@
+''' In-memory cache of parsed JSON configuration files.
+
+A file is parsed once and served from memory afterwards. Its mtime is checked
+at most every check_interval seconds, so most lookups do no filesystem work;
+a changed file is parsed again on the next lookup after the check. invalidate()
+(e.g. from a SIGHUP handler) drops all entries at once.
+'''
+import json
+import os
+import threading
+import time
+
+
+class _CacheEntry(object):
+    def __init__(self, value, mtime, checked):
+        self.value = value
+        self.mtime = mtime
+        self.checked = checked
+
+
+class ConfigCache(object):
+    ''' Parsed and optionally transformed JSON files keyed by path
+
+    Args:
+        check_interval: seconds between two mtime checks of a cached file,
+            0 checks on every lookup
+    '''
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._entries = {} # {path: _CacheEntry}
+        self._lock = threading.Lock()
+
+    def load(self, path, transform=None):
+        ''' Return the parsed file, or transform(parsed file) if given (e.g. an index by id).
+        The returned objects are shared between callers and must not be modified. '''
+        now = time.time()
+        entry = self._entries.get(path)
+        if entry is not None and now - entry.checked < self.check_interval:
+            return entry.value
+        with self._lock:
+            entry = self._entries.get(path)
+            mtime = os.path.getmtime(path)
+            if entry is not None and entry.mtime == mtime:
+                entry.checked = now
+                return entry.value
+            with open(path) as config_file:
+                value = json.load(config_file)
+            if transform is not None:
+                value = transform(value)
+            self._entries[path] = _CacheEntry(value, mtime, now)
+            return value
+
+    def invalidate(self):
+        ''' Drop all cached files, they are parsed again on their next lookup '''
+        with self._lock:
+            self._entries.clear()
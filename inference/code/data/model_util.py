@@ -65,6 +65,22 @@ class DatasetConfig(object):
             angle = angle - 2*np.pi
         return angle
 
+    def class2angle_batch(self, pred_cls, residual, to_label_format=True):
+        ''' Inverse function to angle2class, for arrays of any shape '''
+        num_class = self.num_heading_bin
+        angle_per_class = 2*np.pi/float(num_class)
+        angle_center = pred_cls * angle_per_class
+        angle = angle_center + residual
+        if to_label_format:
+            mask = angle>np.pi
+            angle[mask] = angle[mask] - 2*np.pi
+        return angle
+
+    def class2size_batch(self, pred_cls, residual):
+        ''' Inverse function to size2class, for arrays of any shape '''
+        mean_size = self.mean_size_arr[pred_cls, :]
+        return mean_size + residual
+
     def param2obb(self, center, heading_class, heading_residual, size_class, size_residual):
         heading_angle = self.class2angle(heading_class, heading_residual)
         box_size = self.class2size(int(size_class), size_residual)
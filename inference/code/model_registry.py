@@ -0,0 +1,132 @@
+''' Process-wide registry of resident detection models.
+
+Models are built and loaded once per model_id and kept in eval mode between
+requests. Entries are evicted in least-recently-used order when the summed
+parameter/buffer size exceeds the memory budget, and reloaded when the
+checkpoint file on disk changes (mtime).
+'''
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def model_size_bytes(net):
+    ''' Bytes held by the parameters and buffers of a module '''
+    size = 0
+    for tensor in list(net.parameters()) + list(net.buffers()):
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class _RegistryEntry(object):
+    def __init__(self, net, checkpoint_path, mtime, size, epoch):
+        self.net = net
+        self.checkpoint_path = checkpoint_path
+        self.mtime = mtime
+        self.size = size
+        self.epoch = epoch
+
+
+class ModelRegistry(object):
+    ''' LRU cache of eval-mode networks keyed by model id
+
+    Args:
+        build_fn: callable(model_conf) -> nn.Module, builds an untrained network
+        device: torch.device the networks are moved to
+        memory_budget_mb: [optional] upper bound for the summed size of all
+            resident models. None disables eviction.
+        logger: [optional] logging.Logger
+    '''
+    def __init__(self, build_fn, device, memory_budget_mb=None, logger=None):
+        self.build_fn = build_fn
+        self.device = device
+        self.memory_budget = None if memory_budget_mb is None else int(memory_budget_mb*1024*1024)
+        self.logger = logger
+        self._models = OrderedDict() # {model_id: _RegistryEntry}, oldest first
+        self._lock = threading.RLock()
+        self._load_locks = {} # {model_id: threading.Lock}, serializes the loads of a model
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def get(self, model_id, model_conf, checkpoint_path):
+        ''' Return the resident network for model_id, loading it on a miss
+        or when the checkpoint file was modified since it was loaded.
+
+        The registry lock is only held for lookups and eviction. Loads are
+        serialized per model id, so a cold load does not stall other models. '''
+        mtime = os.path.getmtime(checkpoint_path)
+        with self._lock:
+            net = self._lookup(model_id, checkpoint_path, mtime)
+            if net is not None:
+                return net
+            load_lock = self._load_locks.setdefault(model_id, threading.Lock())
+        with load_lock:
+            with self._lock:
+                # Another thread may have loaded the model while we waited
+                net = self._lookup(model_id, checkpoint_path, mtime)
+                if net is not None:
+                    return net
+                if model_id in self._models:
+                    self._log('Reloading model %s, checkpoint %s changed.'%(model_id, checkpoint_path))
+            entry = self._load(model_conf, checkpoint_path, mtime)
+            with self._lock:
+                self._models.pop(model_id, None)
+                self._models[model_id] = entry
+                self._evict(keep=model_id)
+            return entry.net
+
+    def _lookup(self, model_id, checkpoint_path, mtime):
+        ''' Network of an up to date entry, marked as most recently used, or None '''
+        entry = self._models.get(model_id)
+        if entry is not None and entry.checkpoint_path == checkpoint_path \
+                and entry.mtime == mtime:
+            self._models.move_to_end(model_id)
+            return entry.net
+        return None
+
+    def _load(self, model_conf, checkpoint_path, mtime):
+        net = self.build_fn(model_conf)
+        # Only the model weights are needed for inference, skip the optimizer state
+        checkpoint = torch.load(checkpoint_path, map_location=self.device)
+        net.load_state_dict(checkpoint['model_state_dict'])
+        epoch = checkpoint.get('epoch', -1)
+        del checkpoint
+        net.to(self.device)
+        net.eval() # set model to eval mode (for bn and dp)
+        self._log('Loaded checkpoint %s (epoch: %d)'%(checkpoint_path, epoch))
+        return _RegistryEntry(net, checkpoint_path, mtime, model_size_bytes(net), epoch)
+
+    def _evict(self, keep=None):
+        if self.memory_budget is None:
+            return
+        while self.memory_usage() > self.memory_budget:
+            victim = next((k for k in self._models if k != keep), None)
+            if victim is None:
+                break
+            self._log('Evicting model %s (%d bytes).'%(victim, self._models[victim].size))
+            del self._models[victim]
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def memory_usage(self):
+        ''' Summed size in bytes of all resident models '''
+        with self._lock:
+            return sum(entry.size for entry in self._models.values())
+
+    def evict(self, model_id):
+        ''' Drop model_id from the registry if it is resident '''
+        with self._lock:
+            self._models.pop(model_id, None)
+
+    def loaded_models(self):
+        ''' Ids of the resident models, least recently used first '''
+        with self._lock:
+            return list(self._models.keys())
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
@@ -0,0 +1,67 @@
+''' Testing the model registry: loads of one model must not block other models. '''
+
+import threading
+import torch
+import torch.nn as nn
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from model_registry import ModelRegistry
+
+def _save_checkpoint(filename):
+    torch.save({'model_state_dict': nn.Linear(4, 2).state_dict(), 'epoch': 1}, filename)
+
+def test_cold_load_does_not_block_other_models(tmpdir):
+    release = threading.Event()
+    loading = threading.Event()
+    num_builds = {'a': 0, 'b': 0}
+
+    def build_fn(model_conf):
+        num_builds[model_conf['id']] += 1
+        if model_conf['id'] == 'a':
+            loading.set()
+            assert release.wait(10)
+        return nn.Linear(4, 2)
+
+    registry = ModelRegistry(build_fn, torch.device('cpu'))
+    paths = {}
+    for model_id in ['a', 'b']:
+        paths[model_id] = str(tmpdir.join(model_id + '.tar'))
+        _save_checkpoint(paths[model_id])
+    net_b = registry.get('b', {'id': 'b'}, paths['b'])
+
+    # Two concurrent cold loads of 'a', the second one waits for the first
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get('a', {'id': 'a'}, paths['a']))) \
+        for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    assert loading.wait(10)
+
+    # 'b' is served while 'a' is loading
+    done = threading.Event()
+    def get_b():
+        assert registry.get('b', {'id': 'b'}, paths['b']) is net_b
+        done.set()
+    threading.Thread(target=get_b).start()
+    assert done.wait(5)
+
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    assert len(results) == 2 and results[0] is results[1]
+    assert num_builds == {'a': 1, 'b': 1}
+    assert registry.loaded_models() == ['b', 'a']
+
+def test_reload_on_checkpoint_change(tmpdir):
+    registry = ModelRegistry(lambda model_conf: nn.Linear(4, 2), torch.device('cpu'))
+    path = str(tmpdir.join('a.tar'))
+    _save_checkpoint(path)
+    net = registry.get('a', {'id': 'a'}, path)
+    assert registry.get('a', {'id': 'a'}, path) is net
+    _save_checkpoint(path)
+    os.utime(path, (os.path.getmtime(path)+10,)*2)
+    assert registry.get('a', {'id': 'a'}, path) is not net
+    assert registry.loaded_models() == ['a']
@@ -13,11 +13,13 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 from eval_det import eval_det_cls, eval_det_multiprocessing
+from eval_det import get_pool, match_scans, eval_matched_scans
 from eval_det import get_iou_obb
-from nms import nms_2d_faster, nms_3d_faster, nms_3d_faster_samecls
-from box_util import get_3d_box
+from nms import nms_2d_faster, nms_3d_faster, nms_3d_faster_samecls, nms_batch, \
+    nms_3d_rotated_batch
+from box_util import get_3d_box, get_3d_box_batch
 sys.path.append(os.path.join(ROOT_DIR, 'data'))
-from utils import extract_pc_in_box3d
+from utils import points_in_boxes3d, points_in_boxes3d_torch
 
 def flip_axis_to_camera(pc):
     ''' Flip X-right,Y-forward,Z-up to X-right,Y-down,Z-forward
@@ -50,7 +52,9 @@ def parse_predictions(end_points, config_dict):
             size_scores, size_residuals, sem_cls_scores}
         config_dict: dict
             {dataset_config, remove_empty_box, use_3d_nms, nms_iou,
-            use_old_type_nms, conf_thresh, per_class_proposal}
+            use_old_type_nms, conf_thresh, per_class_proposal,
+            batch_nms (optional, NMS of all samples at once with torch),
+            rotated_nms (optional, 3D NMS with the IoU of the oriented boxes)}
 
     Returns:
         batch_pred_map_cls: a list of len == batch size (BS)
@@ -58,112 +62,96 @@ def parse_predictions(end_points, config_dict):
             where pred_list_i = [(pred_sem_cls, box_params, box_score)_j]
             where j = 0, ..., num of valid detections - 1 from sample input i
     """
-    pred_center = end_points['center'] # B,num_proposal,3
+    # Pick the predicted bins on the device and copy all per-proposal outputs
+    # to the host in one transfer
     pred_heading_class = torch.argmax(end_points['heading_scores'], -1) # B,num_proposal
     pred_heading_residual = torch.gather(end_points['heading_residuals'], 2,
         pred_heading_class.unsqueeze(-1)) # B,num_proposal,1
-    pred_heading_residual.squeeze_(2)
     pred_size_class = torch.argmax(end_points['size_scores'], -1) # B,num_proposal
     pred_size_residual = torch.gather(end_points['size_residuals'], 2,
         pred_size_class.unsqueeze(-1).unsqueeze(-1).repeat(1,1,1,3)) # B,num_proposal,1,3
     pred_size_residual.squeeze_(2)
-    pred_sem_cls = torch.argmax(end_points['sem_cls_scores'], -1) # B,num_proposal
-    sem_cls_probs = softmax(end_points['sem_cls_scores'].detach().cpu().numpy()) # B,num_proposal,10
-    pred_sem_cls_prob = np.max(sem_cls_probs,-1) # B,num_proposal
+    num_class = end_points['sem_cls_scores'].shape[-1]
+    pred = torch.cat((end_points['center'], # 0:3
+        pred_heading_class.unsqueeze(-1).float(), pred_heading_residual, # 3, 4
+        pred_size_class.unsqueeze(-1).float(), pred_size_residual, # 5, 6:9
+        end_points['objectness_scores'], end_points['sem_cls_scores']), -1) # 9:11, 11:
+    pred = pred.detach().cpu().numpy()
+    pred_center = pred[:,:,0:3] # B,num_proposal,3
+    pred_heading_class = pred[:,:,3].astype(np.int64)
+    pred_size_class = pred[:,:,5].astype(np.int64)
+    sem_cls_probs = softmax(pred[:,:,11:11+num_class]) # B,num_proposal,10
+    pred_sem_cls = np.argmax(pred[:,:,11:11+num_class], -1) # B,num_proposal
+    obj_prob = softmax(pred[:,:,9:11])[:,:,1] # (B,K)
 
-    num_proposal = pred_center.shape[1] 
     # Since we operate in upright_depth coord for points, while util functions
     # assume upright_camera coord.
-    bsize = pred_center.shape[0]
-    pred_corners_3d_upright_camera = np.zeros((bsize, num_proposal, 8, 3))
-    pred_center_upright_camera = flip_axis_to_camera(pred_center.detach().cpu().numpy())
-    for i in range(bsize):
-        for j in range(num_proposal):
-            heading_angle = config_dict['dataset_config'].class2angle(\
-                pred_heading_class[i,j].detach().cpu().numpy(), pred_heading_residual[i,j].detach().cpu().numpy())
-            box_size = config_dict['dataset_config'].class2size(\
-                int(pred_size_class[i,j].detach().cpu().numpy()), pred_size_residual[i,j].detach().cpu().numpy())
-            corners_3d_upright_camera = get_3d_box(box_size, heading_angle, pred_center_upright_camera[i,j,:])
-            pred_corners_3d_upright_camera[i,j] = corners_3d_upright_camera
+    bsize, K = pred_center.shape[:2] # K==num_proposal
+    heading_angle = config_dict['dataset_config'].class2angle_batch(pred_heading_class, pred[:,:,4])
+    box_size = config_dict['dataset_config'].class2size_batch(pred_size_class, pred[:,:,6:9])
+    pred_corners_3d_upright_camera = get_3d_box_batch(box_size, heading_angle,
+        flip_axis_to_camera(pred_center)) # B,K,8,3
 
-    K = pred_center.shape[1] # K==num_proposal
     nonempty_box_mask = np.ones((bsize, K))
 
     if config_dict['remove_empty_box']:
         # -------------------------------------
         # Remove predicted boxes without any point within them..
-        batch_pc = end_points['point_clouds'].cpu().numpy()[:,:,0:3] # B,N,3
-        for i in range(bsize):
-            pc = batch_pc[i,:,:] # (N,3)
-            for j in range(K):
-                box3d = pred_corners_3d_upright_camera[i,j,:,:] # (8,3)
-                box3d = flip_axis_to_depth(box3d)
-                pc_in_box,inds = extract_pc_in_box3d(pc, box3d)
-                if len(pc_in_box) < 5:
-                    nonempty_box_mask[i,j] = 0
+        batch_pc = end_points['point_clouds'][:,:,0:3] # B,N,3
+        pred_corners_3d_upright_depth = flip_axis_to_depth(pred_corners_3d_upright_camera) # B,K,8,3
+        if batch_pc.is_cuda:
+            # Count on the device instead of copying the points to the host
+            _, num_pc_in_box = points_in_boxes3d_torch(batch_pc,
+                torch.from_numpy(pred_corners_3d_upright_depth))
+            num_pc_in_box = num_pc_in_box.cpu().numpy()
+        else:
+            batch_pc = batch_pc.numpy()
+            num_pc_in_box = np.stack([points_in_boxes3d(batch_pc[i], pred_corners_3d_upright_depth[i])[1] \
+                for i in range(bsize)]) # B,K
+        nonempty_box_mask[num_pc_in_box < 5] = 0
         # -------------------------------------
 
-    obj_logits = end_points['objectness_scores'].detach().cpu().numpy()
-    obj_prob = softmax(obj_logits)[:,:,1] # (B,K)
+    # ---------- NMS input: boxes_with_prob in (B,K,5), (B,K,7) or (B,K,8) -----------
+    box_min = np.min(pred_corners_3d_upright_camera, 2) # B,K,3
+    box_max = np.max(pred_corners_3d_upright_camera, 2) # B,K,3
     if not config_dict['use_3d_nms']:
-        # ---------- NMS input: pred_with_prob in (B,K,7) -----------
-        pred_mask = np.zeros((bsize, K))
-        for i in range(bsize):
-            boxes_2d_with_prob = np.zeros((K,5))
-            for j in range(K):
-                boxes_2d_with_prob[j,0] = np.min(pred_corners_3d_upright_camera[i,j,:,0])
-                boxes_2d_with_prob[j,2] = np.max(pred_corners_3d_upright_camera[i,j,:,0])
-                boxes_2d_with_prob[j,1] = np.min(pred_corners_3d_upright_camera[i,j,:,2])
-                boxes_2d_with_prob[j,3] = np.max(pred_corners_3d_upright_camera[i,j,:,2])
-                boxes_2d_with_prob[j,4] = obj_prob[i,j]
-            nonempty_box_inds = np.where(nonempty_box_mask[i,:]==1)[0]
-            pick = nms_2d_faster(boxes_2d_with_prob[nonempty_box_mask[i,:]==1,:],
-                config_dict['nms_iou'], config_dict['use_old_type_nms'])
-            assert(len(pick)>0)
-            pred_mask[i, nonempty_box_inds[pick]] = 1
-        end_points['pred_mask'] = pred_mask
-        # ---------- NMS output: pred_mask in (B,K) -----------
-    elif config_dict['use_3d_nms'] and (not config_dict['cls_nms']):
-        # ---------- NMS input: pred_with_prob in (B,K,7) -----------
-        pred_mask = np.zeros((bsize, K))
-        for i in range(bsize):
-            boxes_3d_with_prob = np.zeros((K,7))
-            for j in range(K):
-                boxes_3d_with_prob[j,0] = np.min(pred_corners_3d_upright_camera[i,j,:,0])
-                boxes_3d_with_prob[j,1] = np.min(pred_corners_3d_upright_camera[i,j,:,1])
-                boxes_3d_with_prob[j,2] = np.min(pred_corners_3d_upright_camera[i,j,:,2])
-                boxes_3d_with_prob[j,3] = np.max(pred_corners_3d_upright_camera[i,j,:,0])
-                boxes_3d_with_prob[j,4] = np.max(pred_corners_3d_upright_camera[i,j,:,1])
-                boxes_3d_with_prob[j,5] = np.max(pred_corners_3d_upright_camera[i,j,:,2])
-                boxes_3d_with_prob[j,6] = obj_prob[i,j]
-            nonempty_box_inds = np.where(nonempty_box_mask[i,:]==1)[0]
-            pick = nms_3d_faster(boxes_3d_with_prob[nonempty_box_mask[i,:]==1,:],
-                config_dict['nms_iou'], config_dict['use_old_type_nms'])
-            assert(len(pick)>0)
-            pred_mask[i, nonempty_box_inds[pick]] = 1
-        end_points['pred_mask'] = pred_mask
-        # ---------- NMS output: pred_mask in (B,K) -----------
-    elif config_dict['use_3d_nms'] and config_dict['cls_nms']:
-        # ---------- NMS input: pred_with_prob in (B,K,8) -----------
-        pred_mask = np.zeros((bsize, K))
+        nms_func = nms_2d_faster
+        boxes_with_prob = np.concatenate((box_min[:,:,[0,2]], box_max[:,:,[0,2]],
+            obj_prob[:,:,None]), -1)
+    elif not config_dict['cls_nms']:
+        nms_func = nms_3d_faster
+        boxes_with_prob = np.concatenate((box_min, box_max, obj_prob[:,:,None]), -1)
+    else:
+        nms_func = nms_3d_faster_samecls
+        # only suppress if the two boxes are of the same class!!
+        boxes_with_prob = np.concatenate((box_min, box_max, obj_prob[:,:,None],
+            pred_sem_cls[:,:,None]), -1)
+    pred_mask = np.zeros((bsize, K))
+    if config_dict['use_3d_nms'] and config_dict.get('rotated_nms', False):
+        # Overlap of the oriented boxes instead of their axis aligned extents
+        keep = nms_3d_rotated_batch(torch.from_numpy(pred_corners_3d_upright_camera),
+            torch.from_numpy(obj_prob), config_dict['nms_iou'],
+            classes=torch.from_numpy(pred_sem_cls) if config_dict['cls_nms'] else None,
+            valid=torch.from_numpy(nonempty_box_mask)==1)
+        pred_mask[keep.numpy().astype(bool)] = 1
+    elif config_dict.get('batch_nms', False):
+        # All samples in one call with torch ops, same picks as nms_func
+        num_coords = 6 if config_dict['use_3d_nms'] else 4
+        boxes_with_prob = torch.from_numpy(boxes_with_prob)
+        keep = nms_batch(boxes_with_prob[:,:,:num_coords], boxes_with_prob[:,:,num_coords],
+            config_dict['nms_iou'], config_dict['use_old_type_nms'],
+            classes=boxes_with_prob[:,:,num_coords+1] if nms_func is nms_3d_faster_samecls else None,
+            valid=torch.from_numpy(nonempty_box_mask)==1)
+        pred_mask[keep.numpy().astype(bool)] = 1
+    else:
         for i in range(bsize):
-            boxes_3d_with_prob = np.zeros((K,8))
-            for j in range(K):
-                boxes_3d_with_prob[j,0] = np.min(pred_corners_3d_upright_camera[i,j,:,0])
-                boxes_3d_with_prob[j,1] = np.min(pred_corners_3d_upright_camera[i,j,:,1])
-                boxes_3d_with_prob[j,2] = np.min(pred_corners_3d_upright_camera[i,j,:,2])
-                boxes_3d_with_prob[j,3] = np.max(pred_corners_3d_upright_camera[i,j,:,0])
-                boxes_3d_with_prob[j,4] = np.max(pred_corners_3d_upright_camera[i,j,:,1])
-                boxes_3d_with_prob[j,5] = np.max(pred_corners_3d_upright_camera[i,j,:,2])
-                boxes_3d_with_prob[j,6] = obj_prob[i,j]
-                boxes_3d_with_prob[j,7] = pred_sem_cls[i,j] # only suppress if the two boxes are of the same class!!
             nonempty_box_inds = np.where(nonempty_box_mask[i,:]==1)[0]
-            pick = nms_3d_faster_samecls(boxes_3d_with_prob[nonempty_box_mask[i,:]==1,:],
+            pick = nms_func(boxes_with_prob[i,nonempty_box_inds,:],
                 config_dict['nms_iou'], config_dict['use_old_type_nms'])
             assert(len(pick)>0)
             pred_mask[i, nonempty_box_inds[pick]] = 1
-        end_points['pred_mask'] = pred_mask
-        # ---------- NMS output: pred_mask in (B,K) -----------
+    end_points['pred_mask'] = pred_mask
+    # ---------- NMS output: pred_mask in (B,K) -----------
 
     batch_pred_map_cls = [] # a list (len: batch_size) of list (len: num of predictions per sample) of tuples of pred_cls, pred_box and conf (0-1)
     for i in range(bsize):
@@ -171,11 +159,11 @@ def parse_predictions(end_points, config_dict):
             cur_list = []
             for ii in range(config_dict['dataset_config'].num_class):
                 cur_list += [(ii, pred_corners_3d_upright_camera[i,j], sem_cls_probs[i,j,ii]*obj_prob[i,j]) \
-                    for j in range(pred_center.shape[1]) if pred_mask[i,j]==1 and obj_prob[i,j]>config_dict['conf_thresh']]
+                    for j in range(K) if pred_mask[i,j]==1 and obj_prob[i,j]>config_dict['conf_thresh']]
             batch_pred_map_cls.append(cur_list)
         else:
             batch_pred_map_cls.append([(pred_sem_cls[i,j].item(), pred_corners_3d_upright_camera[i,j], obj_prob[i,j]) \
-                for j in range(pred_center.shape[1]) if pred_mask[i,j]==1 and obj_prob[i,j]>config_dict['conf_thresh']])
+                for j in range(K) if pred_mask[i,j]==1 and obj_prob[i,j]>config_dict['conf_thresh']])
     end_points['batch_pred_map_cls'] = batch_pred_map_cls
 
     return batch_pred_map_cls
@@ -226,15 +214,25 @@ def parse_groundtruths(end_points, config_dict):
 
 class APCalculator(object):
     ''' Calculating Average Precision '''
-    def __init__(self, ap_iou_thresh=0.25, class2type_map=None):
+    def __init__(self, ap_iou_thresh=0.25, class2type_map=None, num_workers=None):
         """
         Args:
             ap_iou_thresh: float between 0 and 1.0
                 IoU threshold to judge whether a prediction is positive.
+                Or a list of thresholds, evaluated together with each
+                prediction-GT IoU computed only once.
             class2type_map: [optional] dict {class_int:class_name}
+            num_workers: [optional] size of the shared worker pool that
+                matches the predictions of each step while the next batches
+                are computed, defaults to the number of CPUs. 0 to match in
+                the calling process. The pool is forked by the first step()
+                (a copy of the calling process per worker) and reused by all
+                later calculators with the same num_workers, pass it
+                explicitly next to DataLoader workers.
         """
         self.ap_iou_thresh = ap_iou_thresh
         self.class2type_map = class2type_map
+        self.num_workers = num_workers
         self.reset()
         
     def step(self, batch_pred_map_cls, batch_gt_map_cls):
@@ -248,15 +246,30 @@ class APCalculator(object):
         
         bsize = len(batch_pred_map_cls)
         assert(bsize == len(batch_gt_map_cls))
-        for i in range(bsize):
-            self.gt_map_cls[self.scan_cnt] = batch_gt_map_cls[i] 
-            self.pred_map_cls[self.scan_cnt] = batch_pred_map_cls[i] 
-            self.scan_cnt += 1
+        # Match the batch right away, asynchronously if there is a pool
+        scans = list(zip(batch_pred_map_cls, batch_gt_map_cls))
+        if self.num_workers == 0:
+            self.matches.append(match_scans((scans, get_iou_obb)))
+        else:
+            self.matches.append(get_pool(self.num_workers).apply_async(match_scans,
+                ((scans, get_iou_obb),)))
     
     def compute_metrics(self):
         """ Use accumulated predictions and groundtruths to compute Average Precision.
+
+        Returns:
+            dict of metrics, or a list of them (one per threshold) if
+            ap_iou_thresh is a list
         """
-        rec, prec, ap = eval_det_multiprocessing(self.pred_map_cls, self.gt_map_cls, ovthresh=self.ap_iou_thresh, get_iou_func=get_iou_obb)
+        matches = []
+        for batch_matches in self.matches:
+            matches += batch_matches if self.num_workers == 0 else batch_matches.get()
+        rec, prec, ap = eval_matched_scans(matches, ovthresh=self.ap_iou_thresh)
+        if isinstance(self.ap_iou_thresh, (list, tuple)):
+            return [self._metrics_dict(rec_t, ap_t) for rec_t, ap_t in zip(rec, ap)]
+        return self._metrics_dict(rec, ap)
+
+    def _metrics_dict(self, rec, ap):
         ret_dict = {} 
         for key in sorted(ap.keys()):
             clsname = self.class2type_map[key] if self.class2type_map else str(key)
@@ -275,6 +288,36 @@ class APCalculator(object):
         return ret_dict
 
     def reset(self):
-        self.gt_map_cls = {} # {scan_id: [(classname, bbox)]}
-        self.pred_map_cls = {} # {scan_id: [(classname, bbox, score)]}
-        self.scan_cnt = 0
+        # Only the per step matches are kept, not the boxes of the scans
+        self.matches = [] # per step, match_scans output (or its pending result)
+
+if __name__=='__main__':
+    # Post-processing time per cloud on random network outputs
+    # (8 clouds of 20k points, 256 proposals, settings of the inference API)
+    import time
+    from model_util import DatasetConfig
+    DC = DatasetConfig()
+    B, K, N = 8, 256, 20000
+    torch.manual_seed(0)
+    end_points = {
+        'point_clouds': torch.rand(B,N,4)*4-2,
+        'center': torch.rand(B,K,3)*4-2,
+        'heading_scores': torch.randn(B,K,DC.num_heading_bin),
+        'heading_residuals': torch.randn(B,K,DC.num_heading_bin)*0.1,
+        'size_scores': torch.randn(B,K,DC.num_size_cluster),
+        'size_residuals': torch.randn(B,K,DC.num_size_cluster,3)*0.1,
+        'sem_cls_scores': torch.randn(B,K,DC.num_class),
+        'objectness_scores': torch.randn(B,K,2),
+    }
+    if torch.cuda.is_available():
+        end_points = {key: value.cuda() for key, value in end_points.items()}
+    for remove_empty_box, batch_nms in [(False, False), (False, True), (True, False), (True, True)]:
+        config_dict = {'remove_empty_box': remove_empty_box, 'use_3d_nms': True, 'nms_iou': 0.25,
+            'use_old_type_nms': False, 'cls_nms': False, 'per_class_proposal': False,
+            'batch_nms': batch_nms, 'conf_thresh': 0.05, 'dataset_config': DC}
+        parse_predictions(end_points, config_dict)
+        tic = time.time()
+        for _ in range(3):
+            parse_predictions(end_points, config_dict)
+        print('parse_predictions (remove_empty_box=%s, batch_nms=%s): %.2f ms per cloud'%(
+            remove_empty_box, batch_nms, 1000*(time.time()-tic)/(3*B)))
@@ -9,6 +9,9 @@
 void query_ball_point_kernel_wrapper(int b, int n, int m, float radius,
                                      int nsample, const float *new_xyz,
                                      const float *xyz, int *idx);
+void query_ball_point_cpu_kernel_wrapper(int b, int n, int m, float radius,
+                                         int nsample, const float *new_xyz,
+                                         const float *xyz, int *idx);
 
 at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
                       const int nsample) {
@@ -26,11 +29,17 @@ at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
                    at::device(new_xyz.device()).dtype(at::ScalarType::Int));
 
   if (new_xyz.type().is_cuda()) {
+#ifdef WITH_CUDA
     query_ball_point_kernel_wrapper(xyz.size(0), xyz.size(1), new_xyz.size(1),
                                     radius, nsample, new_xyz.data<float>(),
                                     xyz.data<float>(), idx.data<int>());
+#else
+    AT_CHECK(false, "pointnet2 was built without CUDA support");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    query_ball_point_cpu_kernel_wrapper(
+        xyz.size(0), xyz.size(1), new_xyz.size(1), radius, nsample,
+        new_xyz.data<float>(), xyz.data<float>(), idx.data<int>());
   }
 
   return idx;
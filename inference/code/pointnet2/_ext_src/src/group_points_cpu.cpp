@@ -0,0 +1,50 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+//
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/Parallel.h>
+
+#include "cpu_utils.h"
+
+// input: points(b, c, n) idx(b, npoints, nsample)
+// output: out(b, c, npoints, nsample)
+void group_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                     int nsample, const float *points,
+                                     const int *idx, float *out) {
+  const int64_t work = (int64_t)npoints * nsample;
+  const int64_t grain = cpu_grain_size(work);
+  at::parallel_for(0, b * c, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bc = start; bc < end; ++bc) {
+      const int i = bc / c;
+      const float *points_row = points + bc * n;
+      const int *idx_row = idx + i * work;
+      float *out_row = out + bc * work;
+      for (int64_t j = 0; j < work; ++j) {
+        out_row[j] = points_row[idx_row[j]];
+      }
+    }
+  });
+}
+
+// input: grad_out(b, c, npoints, nsample), idx(b, npoints, nsample)
+// output: grad_points(b, c, n)
+// Every (b, c) row of grad_points is owned by exactly one task, so the
+// scatter-add needs no atomics.
+void group_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                          int nsample, const float *grad_out,
+                                          const int *idx, float *grad_points) {
+  const int64_t work = (int64_t)npoints * nsample;
+  const int64_t grain = cpu_grain_size(work);
+  at::parallel_for(0, b * c, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bc = start; bc < end; ++bc) {
+      const int i = bc / c;
+      const float *grad_out_row = grad_out + bc * work;
+      const int *idx_row = idx + i * work;
+      float *grad_points_row = grad_points + bc * n;
+      for (int64_t j = 0; j < work; ++j) {
+        grad_points_row[idx_row[j]] += grad_out_row[j];
+      }
+    }
+  });
+}
@@ -9,13 +9,22 @@
 void gather_points_kernel_wrapper(int b, int c, int n, int npoints,
                                   const float *points, const int *idx,
                                   float *out);
+void gather_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                      const float *points, const int *idx,
+                                      float *out);
 void gather_points_grad_kernel_wrapper(int b, int c, int n, int npoints,
                                        const float *grad_out, const int *idx,
                                        float *grad_points);
+void gather_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                           const float *grad_out,
+                                           const int *idx, float *grad_points);
 
 void furthest_point_sampling_kernel_wrapper(int b, int n, int m,
                                             const float *dataset, float *temp,
                                             int *idxs);
+void furthest_point_sampling_cpu_kernel_wrapper(int b, int n, int m,
+                                                const float *dataset,
+                                                float *temp, int *idxs);
 
 at::Tensor gather_points(at::Tensor points, at::Tensor idx) {
   CHECK_CONTIGUOUS(points);
@@ -32,11 +41,17 @@ at::Tensor gather_points(at::Tensor points, at::Tensor idx) {
                    at::device(points.device()).dtype(at::ScalarType::Float));
 
   if (points.type().is_cuda()) {
+#ifdef WITH_CUDA
     gather_points_kernel_wrapper(points.size(0), points.size(1), points.size(2),
                                  idx.size(1), points.data<float>(),
                                  idx.data<int>(), output.data<float>());
+#else
+    AT_CHECK(false, "pointnet2 was built without CUDA support");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    gather_points_cpu_kernel_wrapper(
+        points.size(0), points.size(1), points.size(2), idx.size(1),
+        points.data<float>(), idx.data<int>(), output.data<float>());
   }
 
   return output;
@@ -58,11 +73,17 @@ at::Tensor gather_points_grad(at::Tensor grad_out, at::Tensor idx,
                    at::device(grad_out.device()).dtype(at::ScalarType::Float));
 
   if (grad_out.type().is_cuda()) {
+#ifdef WITH_CUDA
     gather_points_grad_kernel_wrapper(grad_out.size(0), grad_out.size(1), n,
                                       idx.size(1), grad_out.data<float>(),
                                       idx.data<int>(), output.data<float>());
+#else
+    AT_CHECK(false, "pointnet2 was built without CUDA support");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    gather_points_grad_cpu_kernel_wrapper(
+        grad_out.size(0), grad_out.size(1), n, idx.size(1),
+        grad_out.data<float>(), idx.data<int>(), output.data<float>());
   }
 
   return output;
@@ -80,11 +101,17 @@ at::Tensor furthest_point_sampling(at::Tensor points, const int nsamples) {
                   at::device(points.device()).dtype(at::ScalarType::Float));
 
   if (points.type().is_cuda()) {
+#ifdef WITH_CUDA
     furthest_point_sampling_kernel_wrapper(
         points.size(0), points.size(1), nsamples, points.data<float>(),
         tmp.data<float>(), output.data<int>());
+#else
+    AT_CHECK(false, "pointnet2 was built without CUDA support");
+#endif
   } else {
-    AT_CHECK(false, "CPU not supported");
+    furthest_point_sampling_cpu_kernel_wrapper(
+        points.size(0), points.size(1), nsamples, points.data<float>(),
+        tmp.data<float>(), output.data<int>());
   }
 
   return output;
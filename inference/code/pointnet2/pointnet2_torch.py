@@ -0,0 +1,280 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+''' Pure PyTorch implementation of the pointnet2._ext operators.
+
+Drop-in replacement for the compiled extension: every function takes and
+returns the same tensors as its _ext counterpart (int32 indices, squared
+distances for three_nn), so the autograd Functions in pointnet2_utils can use
+either backend. Only batched tensor ops are used, hence it runs on any device
+and torch build without a C++/CUDA build step.
+
+Pairwise distance computations are chunked over the query points so that no
+intermediate tensor holds more than MAX_CHUNK_ELEMENTS entries.
+'''
+from __future__ import (
+    division,
+    absolute_import,
+    with_statement,
+    print_function,
+    unicode_literals,
+)
+import torch
+
+MAX_CHUNK_ELEMENTS = 2**24
+
+
+def _query_chunks(B, npoint, N):
+    ''' Yield (start, end) ranges over the query points so that a
+    (B, end-start, N) tensor stays below MAX_CHUNK_ELEMENTS '''
+    chunk = max(1, MAX_CHUNK_ELEMENTS // max(B * N, 1))
+    for start in range(0, npoint, chunk):
+        yield start, min(start + chunk, npoint)
+
+
+def _gather_last(features, idx):
+    ''' features (B, C, N), idx (B, ...) -> (B, C, ...) '''
+    B, C, _ = features.size()
+    flat_idx = idx.long().view(B, 1, -1).expand(-1, C, -1)
+    return torch.gather(features, 2, flat_idx).view((B, C) + tuple(idx.size()[1:]))
+
+
+def _scatter_add_last(values, idx, N):
+    ''' Adjoint of _gather_last: values (B, C, ...), idx (B, ...) -> (B, C, N) '''
+    B, C = values.size()[:2]
+    flat_idx = idx.long().view(B, 1, -1).expand(-1, C, -1)
+    out = values.new_zeros(B, C, N)
+    return out.scatter_add_(2, flat_idx, values.contiguous().view(B, C, -1))
+
+
+def _square_distance(a, b):
+    ''' a (B, n, 3), b (B, m, 3) -> (B, n, m) squared distances, accumulated
+    per coordinate like the CUDA kernels (torch.cdist may switch to a matmul
+    formulation that rounds differently near the ball boundary) '''
+    dist2 = None
+    for c in range(3):
+        diff = (a[:, :, c].unsqueeze(2) - b[:, :, c].unsqueeze(1))**2
+        dist2 = diff if dist2 is None else dist2.add_(diff)
+    return dist2
+
+
+def gather_points(points, idx):
+    # points (B, C, N), idx (B, npoint) -> (B, C, npoint)
+    return _gather_last(points, idx)
+
+
+def gather_points_grad(grad_out, idx, n):
+    # grad_out (B, C, npoint), idx (B, npoint) -> (B, C, n)
+    return _scatter_add_last(grad_out, idx, n)
+
+
+def furthest_point_sampling(points, nsamples):
+    ''' points (B, N, 3) -> (B, nsamples) int32
+
+    Same selection rule as the CUDA kernel: start at index 0, skip points
+    with a squared norm <= 1e-3 and break ties towards the lower index.
+    '''
+    B, N, _ = points.size()
+    idxs = torch.zeros(B, nsamples, dtype=torch.long, device=points.device)
+    if nsamples <= 0 or N == 0:
+        return idxs.int()
+    valid = (points * points).sum(2) > 1e-3
+    # Skipped points keep a distance of -1 so they never win the argmax
+    dists = torch.where(valid, torch.full_like(valid, 1e10, dtype=points.dtype),
+                        torch.full_like(valid, -1, dtype=points.dtype))
+    batch_inds = torch.arange(B, device=points.device)
+    old = idxs[:, 0]
+    for j in range(1, nsamples):
+        last = points[batch_inds, old].unsqueeze(1) # (B, 1, 3)
+        d = ((points - last)**2).sum(2)
+        dists = torch.where(valid, torch.min(dists, d), dists)
+        old = torch.argmax(dists, 1)
+        idxs[:, j] = old
+    return idxs.int()
+
+
+def ball_query(new_xyz, xyz, radius, nsample):
+    ''' new_xyz (B, npoint, 3), xyz (B, N, 3) -> (B, npoint, nsample) int32
+
+    Returns the first nsample points (in index order) closer than radius to
+    each center. Empty slots repeat the first point found; balls without any
+    point are filled with index 0, as in the CUDA kernel.
+    '''
+    B, npoint, _ = new_xyz.size()
+    N = xyz.size(1)
+    k = min(nsample, N)
+    inds = torch.zeros(B, npoint, nsample, dtype=torch.long, device=xyz.device)
+    if k == 0:
+        return inds.int()
+    order = torch.arange(N, device=xyz.device).view(1, 1, N)
+    for start, end in _query_chunks(B, npoint, N):
+        dist2 = _square_distance(new_xyz[:, start:end], xyz)
+        # Indices inside the ball keep their value, the others are pushed to N;
+        # the k smallest keys are then the first k points inside the ball
+        key = torch.where(dist2 < radius ** 2, order.expand_as(dist2),
+                          torch.full_like(order, N).expand_as(dist2))
+        first_k, _ = torch.topk(key, k, dim=2, largest=False, sorted=True)
+        first = first_k[:, :, :1]
+        first = torch.where(first == N, torch.zeros_like(first), first)
+        first_k = torch.where(first_k == N, first.expand_as(first_k), first_k)
+        inds[:, start:end, :k] = first_k
+        inds[:, start:end, k:] = first
+    return inds.int()
+
+
+# Hash multipliers for the (batch, cell) keys of ball_query_grid
+_CELL_HASH = (73856093, 19349663, 83492791, 2654435761)
+
+
+def _hash_cells(batch_ids, cells, num_buckets):
+    # batch_ids (...), cells (..., 3) non-negative -> bucket ids (...)
+    key = batch_ids * _CELL_HASH[0] + cells[..., 0] * _CELL_HASH[1] + \
+        cells[..., 1] * _CELL_HASH[2] + cells[..., 2] * _CELL_HASH[3]
+    return key % num_buckets
+
+
+def ball_query_grid(new_xyz, xyz, radius, nsample):
+    ''' Same contract and result as ball_query, using a voxel hash grid.
+
+    Points are bucketed once into cells of size radius. Every center then
+    only scans the points of its 27 neighbouring cells instead of all N
+    points, so the cost grows with the local point density rather than with
+    the scene size. Hash collisions only add candidates, which are removed
+    by the distance test.
+    '''
+    B, npoint, _ = new_xyz.size()
+    N = xyz.size(1)
+    device = xyz.device
+    inds = torch.zeros(B * npoint, nsample, dtype=torch.long, device=device)
+    if N == 0 or npoint == 0 or nsample == 0:
+        return inds.view(B, npoint, nsample).int()
+
+    # Slightly enlarged cells so rounding never moves a neighbour two cells away
+    cell_size = radius * (1 + 1e-5)
+    origin = torch.min(xyz.min(1)[0], new_xyz.min(1)[0]).unsqueeze(1)
+    num_buckets = 2 * B * N
+    batch_ids = torch.arange(B, device=device).view(B, 1)
+
+    # Bucket the points: sorted by (bucket, index), with per-bucket offsets
+    cells = torch.floor((xyz - origin) / cell_size).long() + 1
+    buckets = _hash_cells(batch_ids, cells, num_buckets).view(-1)
+    point_ids = torch.arange(B * N, device=device)
+    _, sorted_points = torch.sort(buckets * (B * N) + point_ids)
+    counts = torch.bincount(buckets, minlength=num_buckets)
+    starts = torch.cumsum(counts, 0) - counts
+
+    # Buckets of the 27 neighbouring cells of every center, each counted once
+    offsets = torch.arange(27, device=device)
+    offsets = torch.stack([offsets // 9, offsets // 3 % 3, offsets % 3], 1) - 1
+    new_cells = torch.floor((new_xyz - origin) / cell_size).long() + 1
+    neighbours = _hash_cells(batch_ids.unsqueeze(2), new_cells.unsqueeze(2) + offsets, num_buckets)
+    neighbours, _ = torch.sort(neighbours.view(B * npoint, 27), 1)
+    neighbour_counts = counts[neighbours]
+    neighbour_counts[:, 1:] *= (neighbours[:, 1:] != neighbours[:, :-1]).long()
+    candidates_per_query = neighbour_counts.sum(1)
+
+    flat_xyz = xyz.contiguous().view(B * N, 3)
+    flat_new_xyz = new_xyz.contiguous().view(B * npoint, 3)
+    num_found = torch.zeros(B * npoint, dtype=torch.long, device=device)
+    # Chunk the centers so the candidate pairs stay below MAX_CHUNK_ELEMENTS
+    cum_candidates = torch.cumsum(candidates_per_query, 0)
+    start = 0
+    while start < B * npoint:
+        limit = (cum_candidates[start - 1] if start > 0 else 0) + MAX_CHUNK_ELEMENTS
+        end = max(int((cum_candidates <= limit).sum()), start + 1)
+
+        # One (center, candidate point) pair per point of the neighbouring buckets
+        chunk_counts = neighbour_counts[start:end].contiguous().view(-1)
+        entries = torch.arange(chunk_counts.numel(), device=device)
+        pair_entry = torch.repeat_interleave(entries, chunk_counts)
+        entry_offsets = torch.cumsum(chunk_counts, 0) - chunk_counts
+        pair_rank = torch.arange(pair_entry.numel(), device=device) - entry_offsets[pair_entry]
+        pair_point = sorted_points[starts[neighbours[start:end].contiguous().view(-1)[pair_entry]] + pair_rank]
+        pair_query = pair_entry // 27 + start
+
+        d = flat_xyz[pair_point] - flat_new_xyz[pair_query]
+        inside = (d * d).sum(1) < radius ** 2
+        pair_query = pair_query[inside]
+        pair_point = pair_point[inside] % N
+
+        # Keep the first nsample points (in index order) of every ball
+        _, order = torch.sort(pair_query * N + pair_point)
+        pair_query, pair_point = pair_query[order], pair_point[order]
+        found = torch.bincount(pair_query - start, minlength=end - start)
+        first_pair = torch.cumsum(found, 0) - found
+        slot = torch.arange(pair_query.numel(), device=device) - first_pair[pair_query - start]
+        keep = slot < nsample
+        inds[pair_query[keep], slot[keep]] = pair_point[keep]
+        num_found[start:end] = found
+        start = end
+
+    # Empty slots repeat the first point found (index 0 for empty balls)
+    empty = torch.arange(nsample, device=device).view(1, -1) >= num_found.view(-1, 1)
+    inds = torch.where(empty, inds[:, :1].expand_as(inds), inds)
+    return inds.view(B, npoint, nsample).int()
+
+def group_points(points, idx):
+    # points (B, C, N), idx (B, npoint, nsample) -> (B, C, npoint, nsample)
+    return _gather_last(points, idx)
+
+
+def group_points_grad(grad_out, idx, n):
+    # grad_out (B, C, npoint, nsample), idx (B, npoint, nsample) -> (B, C, n)
+    return _scatter_add_last(grad_out, idx, n)
+
+
+def three_nn(unknowns, knows):
+    ''' unknowns (B, n, 3), knows (B, m, 3) -> dist2 (B, n, 3), idx (B, n, 3) int32 '''
+    B, n, _ = unknowns.size()
+    m = knows.size(1)
+    dist2 = unknowns.new_zeros(B, n, 3)
+    idx = torch.zeros(B, n, 3, dtype=torch.long, device=unknowns.device)
+    for start, end in _query_chunks(B, n, m):
+        best_dist2, best_idx = torch.topk(_square_distance(unknowns[:, start:end], knows),
+                                          3, dim=2, largest=False, sorted=True)
+        dist2[:, start:end] = best_dist2
+        idx[:, start:end] = best_idx
+    return dist2, idx.int()
+
+
+def three_interpolate(points, idx, weight):
+    # points (B, C, m), idx (B, n, 3), weight (B, n, 3) -> (B, C, n)
+    return (_gather_last(points, idx) * weight.unsqueeze(1)).sum(3)
+
+
+def three_interpolate_grad(grad_out, idx, weight, m):
+    # grad_out (B, C, n), idx (B, n, 3), weight (B, n, 3) -> (B, C, m)
+    return _scatter_add_last(grad_out.unsqueeze(3) * weight.unsqueeze(1), idx, m)
+
+
+if __name__ == '__main__':
+    # Ball query benchmark: scan vs. voxel hash grid for growing scenes of
+    # constant point density (sa1 settings: 2048 centers, radius 0.2, 64 samples)
+    import time
+    try:
+        import pointnet2._ext as _ext
+        scan_fn, scan_name = _ext.ball_query, 'ext scan'
+    except ImportError:
+        scan_fn, scan_name = ball_query, 'torch scan'
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    def timeit(fn, *args):
+        fn(*args)
+        if device.type == 'cuda': torch.cuda.synchronize()
+        tic = time.time()
+        for _ in range(3):
+            out = fn(*args)
+        if device.type == 'cuda': torch.cuda.synchronize()
+        return (time.time() - tic) / 3, out
+
+    print('%8s %12s %12s %8s' % ('points', scan_name, 'grid', 'speedup'))
+    for N in [20000, 50000, 100000, 200000, 400000]:
+        extent = 5.0 * (N / 20000.0)**(1 / 3.0) # 20k points in a 5m cube
+        xyz = torch.rand(1, N, 3, device=device) * extent
+        new_xyz = xyz[:, torch.randperm(N, device=device)[:2048]].contiguous()
+        t_scan, scan_inds = timeit(scan_fn, new_xyz, xyz, 0.2, 64)
+        t_grid, grid_inds = timeit(ball_query_grid, new_xyz, xyz, 0.2, 64)
+        assert torch.equal(scan_inds.int(), grid_inds)
+        print('%8d %11.1fms %11.1fms %7.1fx' % (N, 1000 * t_scan, 1000 * t_grid, t_scan / t_grid))
@@ -1,28 +1,39 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
-# 
+#
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+from torch.utils.cpp_extension import BuildExtension, CUDAExtension, CppExtension, CUDA_HOME
 import glob
 
 _ext_src_root = "_ext_src"
-_ext_sources = glob.glob("{}/src/*.cpp".format(_ext_src_root)) + glob.glob(
-    "{}/src/*.cu".format(_ext_src_root)
-)
 _ext_headers = glob.glob("{}/include/*".format(_ext_src_root))
 
+# Build the CPU kernels only when there is no CUDA toolkit (or when asked to)
+_with_cuda = CUDA_HOME is not None and os.environ.get("POINTNET2_CPU_ONLY", "0") != "1"
+
+_ext_sources = glob.glob("{}/src/*.cpp".format(_ext_src_root))
+_extra_compile_args = {
+    "cxx": ["-O2", "-fopenmp", "-I{}".format("{}/include".format(_ext_src_root))],
+}
+if _with_cuda:
+    _ext_sources += glob.glob("{}/src/*.cu".format(_ext_src_root))
+    _extra_compile_args["cxx"] += ["-DWITH_CUDA"]
+    _extra_compile_args["nvcc"] = ["-O2", "-DWITH_CUDA", "-I{}".format("{}/include".format(_ext_src_root))]
+    Extension = CUDAExtension
+else:
+    Extension = CppExtension
+
 setup(
     name='pointnet2',
     ext_modules=[
-        CUDAExtension(
+        Extension(
             name='pointnet2._ext',
             sources=_ext_sources,
-            extra_compile_args={
-                "cxx": ["-O2", "-I{}".format("{}/include".format(_ext_src_root))],
-                "nvcc": ["-O2", "-I{}".format("{}/include".format(_ext_src_root))],
-            },
+            extra_compile_args=_extra_compile_args,
+            extra_link_args=["-fopenmp"],
         )
     ],
     cmdclass={
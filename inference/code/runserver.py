@@ -9,6 +9,8 @@ import open3d as o3d
 import math
 import argparse
 import importlib
+import threading
+import signal
 from os import environ
 from os import path
 
@@ -22,7 +24,6 @@ from scipy.special import softmax
 
 import torch
 import torch.nn as nn
-import torch.optim as optim
 
 from _version import __version__
 
@@ -31,17 +32,32 @@ ROOT_DIR = BASE_DIR
 sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 sys.path.append(os.path.join(ROOT_DIR, 'models'))
 sys.path.append(os.path.join(ROOT_DIR, 'data'))
-from pc_util import random_sampling, read_ply
+from pc_util import random_sampling, voxel_downsample, read_ply, read_point_buffer
 from ap_helper import parse_predictions
 from detection_dataset import DC # dataset config
+from votenet import VoteNet, dump_results
+from model_registry import ModelRegistry
+from batch_scheduler import BatchScheduler
+from config_cache import ConfigCache
 
 
 app = Flask(__name__)
 
+# Number of points sampled from every cloud, unless set per model in the modelconfig.json
+NUM_POINT = 20000
+
+# Content type of raw point buffer uploads (see pc_util.write_point_buffer)
+POINT_BUFFER_MIMETYPE = 'application/x-point-buffer'
+
+DETECT_CONFIG_DICT = {'remove_empty_box': True, 'use_3d_nms': True, 'nms_iou': 0.25,
+    'use_old_type_nms': False, 'cls_nms': False, 'per_class_proposal': False,
+    'batch_nms': True, 'conf_thresh': 0.15, 'dataset_config': DC}
+
+# Configuration files are parsed once, changes are picked up after at most a second or on SIGHUP
+config_cache = ConfigCache(check_interval=1.0)
+
 def get_appsetting():
-    with open('appsettings.json') as config_file:
-        data = json.load(config_file)
-    return data
+    return config_cache.load('appsettings.json')
 
 def get_model_path():
     config = get_appsetting()
@@ -82,33 +98,136 @@ logger = create_logger()
 logger.info('PyTorch Web-API started.')
 
 
+def index_models_config(conf):
+    return conf, {model['id']: model for model in conf['models']}
+
 def get_models_config():
     #returns all models from the config file
-    with open(get_model_path() + '/modelconfig.json') as config_file:
-        data = json.load(config_file)
-    return data
+    return config_cache.load(get_model_path() + '/modelconfig.json', index_models_config)[0]
 
 def get_object_from_config(model_id):
-    #returns a specific model (by model_id)
-    with open(get_model_path() + '/modelconfig.json') as config_file:
-        conf = json.load(config_file)
-    for model in conf['models']:
-        if model['id'] == model_id:
-            return model    
+    #returns a specific model (by model_id), None if there is no such model
+    return config_cache.load(get_model_path() + '/modelconfig.json', index_models_config)[1].get(model_id)
+
+def reload_config(signum, frame):
+    logger.info('SIGHUP received, reloading the configuration files.')
+    config_cache.invalidate()
+
+# Signal handlers can only be installed from the main thread (and not on Windows)
+if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, reload_config)
     
+def build_model(model_conf):
+    ''' Construct an untrained VoteNet for a model of the config '''
+    net = VoteNet(num_proposal=256, input_feature_dim=1, vote_factor=1,
+        sampling='seed_fps', num_class=DC.num_class,
+        num_heading_bin=DC.num_heading_bin,
+        num_size_cluster=DC.num_size_cluster,
+        mean_size_arr=DC.mean_size_arr)
+    return net
+
+def create_model_registry():
+    config = get_appsetting()
+    memoryBudget = config['WebApiSettings'].get('ModelMemoryBudgetMB')
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    return ModelRegistry(build_model, device, memory_budget_mb=memoryBudget, logger=logger)
+
+model_registry = create_model_registry()
+
+def get_model(model_id, model_conf):
+    ''' returns the resident network of a model, loads it on first use '''
+    checkpoint_path = os.path.join(get_model_path(), model_conf['model_path'])
+    return model_registry.get(model_id, model_conf, checkpoint_path)
+
+def run_detection_batch(model_id, point_clouds):
+    ''' Forward a batch of preprocessed clouds through a model
+    :point_clouds list of (N,C) arrays with the same N
+    return: list with the parsed predictions of each cloud
+    '''
+    net = get_model(model_id, get_object_from_config(model_id))
+    pc = np.stack(point_clouds, 0)
+    inputs = {'point_clouds': torch.from_numpy(pc).to(model_registry.device)}
+    tic = time.time()
+    with torch.no_grad():
+        end_points = net(inputs)
+    toc = time.time()
+    print('Inference time: %f (batch size: %d)'%(toc-tic, len(point_clouds)))
+    end_points['point_clouds'] = inputs['point_clouds']
+    return parse_predictions(end_points, DETECT_CONFIG_DICT)
+
+def create_batch_scheduler():
+    config = get_appsetting()
+    maxBatchSize = config['WebApiSettings'].get('MaxBatchSize', 8)
+    maxBatchWaitMs = config['WebApiSettings'].get('MaxBatchWaitMs', 10)
+    return BatchScheduler(run_detection_batch, max_batch_size=maxBatchSize, max_wait_ms=maxBatchWaitMs)
+
+batch_scheduler = create_batch_scheduler()
+
+class Warmup(object):
+    ''' Loads every model of the config and runs synthetic forward passes in a background thread,
+    the server reports ready once all models went through it '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.thread = None
+        self.status = {} # {model_id: 'pending' | 'warming' | 'ready' | 'failed'}
+        self.done = threading.Event()
+
+    def start(self):
+        ''' Start the warm-up once, later calls return immediately '''
+        with self._lock:
+            if self.thread is not None:
+                return
+            self.status = {model['id']: 'pending' for model in get_models_config()['models']}
+            self.thread = threading.Thread(target=self.run, name='warmup')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        config = get_appsetting()
+        iterations = config['WebApiSettings'].get('WarmupIterations', 3)
+        maxBatchSize = config['WebApiSettings'].get('MaxBatchSize', 8)
+        tic = time.time()
+        for model_conf in get_models_config()['models']:
+            model_id = model_conf['id']
+            if model_conf['type'] != '3d_detection':
+                self.status[model_id] = 'ready'
+                continue
+            self.status[model_id] = 'warming'
+            try:
+                self.warm_up_model(model_conf, iterations, maxBatchSize)
+                self.status[model_id] = 'ready'
+            except Exception as error:
+                self.status[model_id] = 'failed'
+                logger.error('Warm-up of model %s failed: %s'%(model_id, str(error)), exc_info=True)
+        logger.info('Warm-up finished in %.1fs: %s'%(time.time()-tic, self.status))
+        self.done.set()
+
+    def warm_up_model(self, model_conf, iterations, max_batch_size):
+        ''' Load the model and forward synthetic clouds of the production point count,
+        with batch size 1 and the largest batch the scheduler forms '''
+        get_model(model_conf['id'], model_conf)
+        num_point = model_conf.get('num_point', NUM_POINT)
+        rng = np.random.RandomState(0)
+        point_cloud = rng.rand(2*num_point, 3) * np.array([2.0, 2.0, 1.0])
+        pc = preprocess_point_cloud(point_cloud, model_conf)[0]
+        for i in range(iterations):
+            run_detection_batch(model_conf['id'], [pc])
+        if iterations > 0 and max_batch_size > 1:
+            run_detection_batch(model_conf['id'], [pc] * max_batch_size)
+
+    def ready(self):
+        return self.done.is_set()
+
+warmup = Warmup()
+
 def check_model_id(model_id):
     '''validates model id
     :model_id empty --> HTTP 400
     :model_id not in the config.json --> HTTP 404
     '''
-    conf = get_models_config()
-    registered_models=[]
-    for x in conf['models']:
-        registered_models.append(x['id'])
-    
     if not model_id:
         return abort(400, 'Model_ID is missing')
-    elif model_id not in registered_models:
+    elif get_object_from_config(model_id) is None:
         return abort(404, 'Model with ID not found')
     else:
         pass
@@ -123,6 +242,24 @@ def get_cloud(request):
     except KeyError:
         return abort(400, 'KeyError') 
 
+def get_point_cloud(request):
+    '''get the point cloud from the request, a PLY file upload or a raw point buffer body
+    :malformed or corrupt point buffer --> HTTP 400
+    :point buffer codec not installed --> HTTP 415
+    return: (N,3) or (N,6) array
+    '''
+    if request.mimetype == POINT_BUFFER_MIMETYPE:
+        try:
+            return read_point_buffer(request.get_data(cache=False))
+        except ValueError as e:
+            return abort(400, str(e))
+        except ImportError as e:
+            return abort(415, 'Point buffer compression not supported: %s'%(str(e)))
+    #get and validate cloud file
+    cloud_file = get_cloud(request)
+    #check_file(cloud_file)
+    return read_ply(cloud_file)
+
 def check_file(cloud_file):
     '''checks the image file format
     :wrong format --> HTTP 415
@@ -143,15 +280,23 @@ def create_response(content):
     )
     return response
 
-def preprocess_point_cloud(point_cloud):
-    ''' Prepare the numpy point cloud (N,3) for forward pass '''
+def preprocess_point_cloud(point_cloud, model_conf):
+    ''' Prepare the numpy point cloud (N,3) for forward pass
+    Clouds are first reduced to one point per voxel of the model's 'voxel_size' (if set),
+    then 'num_point' points are sampled (default: NUM_POINT)
+    :no points with finite coordinates --> HTTP 400
+    '''
     point_cloud = point_cloud[:,0:3] # do not use color for now
+    point_cloud = point_cloud[np.isfinite(point_cloud).all(1)] # invalid depth of RealSense/ZED clouds
+    if len(point_cloud) == 0:
+        return abort(400, 'The point cloud has no valid points.')
+    if model_conf.get('voxel_size'):
+        point_cloud = voxel_downsample(point_cloud, model_conf['voxel_size'])
     floor_height = np.percentile(point_cloud[:,2],0.99)
     height = point_cloud[:,2] - floor_height
     point_cloud = np.concatenate([point_cloud, np.expand_dims(height, 1)],1) # (N,4) or (N,7)
-    #point_cloud = random_sampling(point_cloud, FLAGS.num_point)
-    point_cloud = random_sampling(point_cloud, 20000)
-    pc = np.expand_dims(point_cloud.astype(np.float32), 0) # (1,40000,4)
+    point_cloud = random_sampling(point_cloud, model_conf.get('num_point', NUM_POINT))
+    pc = np.expand_dims(point_cloud.astype(np.float32), 0) # (1,num_point,4)
     return pc
 
 @app.route('/api/models', methods=['GET'])
@@ -180,52 +325,13 @@ def detect_cloud():
     else:
         return abort(400, 'The desired model does not support detection.')
 
-    #get and validate cloud file
-    cloud_file = get_cloud(request)
-    #check_file(cloud_file)
-
-    checkpoint_path = os.path.join(get_model_path(), model_conf['model_path'])
-
-    eval_config_dict = {'remove_empty_box': True, 'use_3d_nms': True, 'nms_iou': 0.25,
-        'use_old_type_nms': False, 'cls_nms': False, 'per_class_proposal': False,
-        'conf_thresh': 0.15, 'dataset_config': DC}
-
-    # Init the model and optimzier
-    MODEL = importlib.import_module('votenet') # import network module
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    net = MODEL.VoteNet(num_proposal=256, input_feature_dim=1, vote_factor=1,
-        sampling='seed_fps', num_class=DC.num_class,
-        num_heading_bin=DC.num_heading_bin,
-        num_size_cluster=DC.num_size_cluster,
-        mean_size_arr=DC.mean_size_arr).to(device)
-    print('Constructed model.')
-    
-    # Load checkpoint
-    optimizer = optim.Adam(net.parameters(), lr=0.01)
-    checkpoint = torch.load(checkpoint_path)
-    net.load_state_dict(checkpoint['model_state_dict'])
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-    epoch = checkpoint['epoch']
-    print("Loaded checkpoint %s (epoch: %d)"%(checkpoint_path, epoch))
-   
-    # Load and preprocess input point cloud 
-    net.eval() # set model to eval mode (for bn and dp)
-    
+    # Load and preprocess input point cloud
+    point_cloud = get_point_cloud(request)
+    pc = preprocess_point_cloud(point_cloud, model_conf)
+    print('Loaded point cloud data: %d points'%(point_cloud.shape[0]))
 
-    point_cloud = read_ply(cloud_file)
-    pc = preprocess_point_cloud(point_cloud)
-    print('Loaded point cloud data: %s'%(cloud_file))
-   
-    # Model inference
-    inputs = {'point_clouds': torch.from_numpy(pc).to(device)}
-    tic = time.time()
-    with torch.no_grad():
-        end_points = net(inputs)
-    
-    toc = time.time()
-    print('Inference time: %f'%(toc-tic))
-    end_points['point_clouds'] = inputs['point_clouds']
-    pred_map_cls = parse_predictions(end_points, eval_config_dict)
+    # Model inference, batched with concurrent requests for the same model
+    pred_map_cls = [batch_scheduler.submit(model_id, pc[0])]
     logger.debug(pred_map_cls)
     print('Finished detection. %d object detected.'%(len(pred_map_cls[0])))
 
@@ -256,44 +362,16 @@ def detect_cloud_dump():
     else:
         return abort(400, 'The desired model does not support detection.')
 
-    #get and validate cloud file
-    cloud_file = get_cloud(request)
-    #check_file(cloud_file)
-
-    checkpoint_path = os.path.join(get_model_path(), model_conf['model_path'])
-
-    eval_config_dict = {'remove_empty_box': True, 'use_3d_nms': True, 'nms_iou': 0.25,
-        'use_old_type_nms': False, 'cls_nms': False, 'per_class_proposal': False,
-        'conf_thresh': 0.15, 'dataset_config': DC}
+    # Get the resident model (loaded once, kept in eval mode)
+    net = get_model(model_id, model_conf)
 
-    # Init the model and optimzier
-    MODEL = importlib.import_module('votenet') # import network module
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    net = MODEL.VoteNet(num_proposal=256, input_feature_dim=1, vote_factor=1,
-        sampling='seed_fps', num_class=DC.num_class,
-        num_heading_bin=DC.num_heading_bin,
-        num_size_cluster=DC.num_size_cluster,
-        mean_size_arr=DC.mean_size_arr).to(device)
-    print('Constructed model.')
-    
-    # Load checkpoint
-    optimizer = optim.Adam(net.parameters(), lr=0.01)
-    checkpoint = torch.load(checkpoint_path)
-    net.load_state_dict(checkpoint['model_state_dict'])
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-    epoch = checkpoint['epoch']
-    print("Loaded checkpoint %s (epoch: %d)"%(checkpoint_path, epoch))
-   
-    # Load and preprocess input point cloud 
-    net.eval() # set model to eval mode (for bn and dp)
-    
-
-    point_cloud = read_ply(cloud_file)
-    pc = preprocess_point_cloud(point_cloud)
-    print('Loaded point cloud data: %s'%(cloud_file))
+    # Load and preprocess input point cloud
+    point_cloud = get_point_cloud(request)
+    pc = preprocess_point_cloud(point_cloud, model_conf)
+    print('Loaded point cloud data: %d points'%(point_cloud.shape[0]))
    
     # Model inference
-    inputs = {'point_clouds': torch.from_numpy(pc).to(device)}
+    inputs = {'point_clouds': torch.from_numpy(pc).to(model_registry.device)}
     tic = time.time()
     with torch.no_grad():
         end_points = net(inputs)
@@ -301,13 +379,13 @@ def detect_cloud_dump():
     toc = time.time()
     print('Inference time: %f'%(toc-tic))
     end_points['point_clouds'] = inputs['point_clouds']
-    pred_map_cls = parse_predictions(end_points, eval_config_dict)
+    pred_map_cls = parse_predictions(end_points, DETECT_CONFIG_DICT)
     logger.debug(pred_map_cls)
     print('Finished detection. %d object detected.'%(len(pred_map_cls[0])))
 
     dump_dir = os.path.join('../dump/')
     if not os.path.exists(dump_dir): os.mkdir(dump_dir) 
-    MODEL.dump_results(end_points, dump_dir, DC, True)
+    dump_results(end_points, dump_dir, DC, True)
     print('Dumped detection results to folder %s'%(dump_dir))
 
     output = []
@@ -319,6 +397,25 @@ def detect_cloud_dump():
     
     return jsonify(output)
 
+@app.route('/api/stats/batching', methods=['GET'])
+def get_batching_stats():
+    ''' Request for getting the micro-batching statistics per model
+    return: JSON of queue depth, batch size and queue depth histograms
+    '''
+    output = json.dumps(batch_scheduler.stats(), separators=(',', ':'))
+    return create_response(output)
+
+@app.route('/api/health/ready', methods=['GET'])
+def get_ready():
+    ''' Readiness probe, ready once all models are loaded and warmed up
+    return: JSON of the warm-up status per model, HTTP 503 while warming up
+    '''
+    output = json.dumps({'ready': warmup.ready(), 'models': warmup.status}, separators=(',', ':'))
+    response = create_response(output)
+    if not warmup.ready():
+        response.status_code = 503
+    return response
+
 @app.route('/api/version', methods=['GET'])
 def get_api_version():
     ''' Request for getting the current API version
@@ -332,6 +429,8 @@ def get_api_version():
 
 @app.before_request
 def before_request():
+    # Servers that import the app (e.g. uwsgi) start the warm-up with the first request
+    warmup.start()
     logger.debug(request.method + request.path)
 
 @app.after_request
@@ -377,7 +476,9 @@ if __name__ == '__main__':
         parser.parse_args(['--version'])
     else:
         from waitress import serve
-        serve(app, host="0.0.0.0", port=8080)
+        warmup.start()
+        serverThreads = get_appsetting()['WebApiSettings'].get('ServerThreads', 4)
+        serve(app, host="0.0.0.0", port=8080, threads=serverThreads)
     '''
     if args == 'version':
         parser.parse_args(['--version'])
@@ -0,0 +1,108 @@
+''' Testing the vectorized oriented box IoU and rotated NMS. '''
+
+import torch
+import numpy as np
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from box_util import get_3d_box, box3d_iou, box3d_iou_batch, box3d_iou_batch_torch
+from nms import nms_3d_rotated_batch
+
+def _random_boxes(rng, n, spread=1.0):
+    return np.stack([get_3d_box(rng.rand(3)*1.5+0.2, rng.rand()*2*np.pi-np.pi,
+        rng.rand(3)*spread) for _ in range(n)]) # n,8,3
+
+def test_box3d_iou_batch():
+    rng = np.random.RandomState(0)
+    corners1 = _random_boxes(rng, 30)
+    corners2 = _random_boxes(rng, 40)
+    iou, iou_2d = box3d_iou_batch(corners1, corners2)
+    assert iou.shape == (30, 40) and iou_2d.shape == (30, 40)
+    ref = np.array([[box3d_iou(c1, c2) for c2 in corners2] for c1 in corners1]) # N,M,2
+    assert (ref[:,:,0] > 0).sum() > 100
+    assert np.allclose(iou, ref[:,:,0], atol=1e-9)
+    assert np.allclose(iou_2d, ref[:,:,1], atol=1e-9)
+
+def test_box3d_iou_batch_special_cases():
+    rng = np.random.RandomState(1)
+    corners = _random_boxes(rng, 10)
+    iou, iou_2d = box3d_iou_batch(corners, corners)
+    assert np.allclose(np.diag(iou), 1) and np.allclose(np.diag(iou_2d), 1)
+    # Same footprint rotated by 90 degrees
+    box1 = get_3d_box((1,1,1), 0, (0,0,0))
+    box2 = get_3d_box((1,1,1), np.pi/2, (0,0,0))
+    assert np.allclose(box3d_iou_batch(box1[None], box2[None])[0], 1)
+    # Half overlap along one axis, no overlap at all, no height overlap
+    box3 = get_3d_box((1,1,1), 0, (0.5,0,0))
+    box4 = get_3d_box((1,1,1), 0, (3,0,0))
+    box5 = get_3d_box((1,1,1), 0, (0,2,0))
+    iou, iou_2d = box3d_iou_batch(box1[None], np.stack([box3, box4, box5]))
+    assert np.allclose(iou[0], [1/3., 0, 0])
+    assert np.allclose(iou_2d[0], [1/3., 0, 1])
+
+def test_box3d_iou_batch_torch():
+    rng = np.random.RandomState(2)
+    corners1 = _random_boxes(rng, 30)
+    corners2 = _random_boxes(rng, 40)
+    iou, iou_2d = box3d_iou_batch(corners1, corners2)
+    iou_t, iou_2d_t = box3d_iou_batch_torch(torch.from_numpy(corners1), torch.from_numpy(corners2))
+    assert np.allclose(iou_t.numpy(), iou, atol=1e-9)
+    assert np.allclose(iou_2d_t.numpy(), iou_2d, atol=1e-9)
+    iou_t, iou_2d_t = box3d_iou_batch_torch(torch.from_numpy(corners1).float(),
+        torch.from_numpy(corners2).float())
+    assert np.allclose(iou_t.numpy(), iou, atol=1e-4)
+    assert np.allclose(iou_2d_t.numpy(), iou_2d, atol=1e-4)
+
+def test_nms_3d_rotated_batch():
+    rng = np.random.RandomState(3)
+    B, K, thresh = 2, 50, 0.25
+    corners = np.stack([_random_boxes(rng, K, 3.0) for _ in range(B)]) # B,K,8,3
+    scores = rng.rand(B, K)
+    classes = rng.randint(0, 3, (B, K))
+    valid = rng.rand(B, K) > 0.2
+    for cls_nms in [False, True]:
+        keep = nms_3d_rotated_batch(torch.from_numpy(corners), torch.from_numpy(scores), thresh,
+            classes=torch.from_numpy(classes) if cls_nms else None,
+            valid=torch.from_numpy(valid.astype(np.uint8))==1).numpy()
+        for b in range(B):
+            iou = box3d_iou_batch(corners[b], corners[b])[0]
+            pick = []
+            for i in np.argsort(-scores[b]):
+                if valid[b,i] and all(iou[j,i] <= thresh or (cls_nms and classes[b,j] != classes[b,i]) \
+                    for j in pick):
+                    pick.append(i)
+            assert sorted(pick) == list(np.where(keep[b])[0])
+
+if __name__=='__main__':
+    test_box3d_iou_batch()
+    test_box3d_iou_batch_special_cases()
+    test_box3d_iou_batch_torch()
+    test_nms_3d_rotated_batch()
+
+    # Throughput in box pairs per second
+    import time
+    rng = np.random.RandomState(0)
+    corners1 = _random_boxes(rng, 256, 3.0)
+    corners2 = _random_boxes(rng, 256, 3.0)
+    tic = time.time()
+    for i in range(16):
+        for j in range(16):
+            box3d_iou(corners1[i], corners2[j])
+    print('box3d_iou:                     %9.0f pairs/s'%(16*16/(time.time()-tic)))
+    tic = time.time()
+    box3d_iou_batch(corners1, corners2)
+    print('box3d_iou_batch:               %9.0f pairs/s'%(256*256/(time.time()-tic)))
+    for dtype in [torch.float64, torch.float32]:
+        devices = ['cpu', 'cuda'] if torch.cuda.is_available() else ['cpu']
+        for device in devices:
+            t1 = torch.from_numpy(corners1).to(device, dtype)
+            t2 = torch.from_numpy(corners2).to(device, dtype)
+            box3d_iou_batch_torch(t1, t2)
+            if device == 'cuda': torch.cuda.synchronize()
+            tic = time.time()
+            box3d_iou_batch_torch(t1, t2)
+            if device == 'cuda': torch.cuda.synchronize()
+            print('box3d_iou_batch_torch (%s, %s): %9.0f pairs/s'%(str(dtype)[6:], device,
+                256*256/(time.time()-tic)))
@@ -66,87 +66,110 @@ def get_iou(bb1, bb2):
     iou3d = calc_iou(bb1, bb2)
     return iou3d
 
-from box_util import box3d_iou
+def get_iou_batch(bbs1, bbs2):
+    """ IoU matrix (N,M) of axis aligned boxes given by (N,6) and (M,6)
+        center and lengths, same values as calc_iou """
+    min_max = np.minimum(bbs1[:,None,0:3] + bbs1[:,None,3:6]/2, bbs2[None,:,0:3] + bbs2[None,:,3:6]/2)
+    max_min = np.maximum(bbs1[:,None,0:3] - bbs1[:,None,3:6]/2, bbs2[None,:,0:3] - bbs2[None,:,3:6]/2)
+    side = min_max - max_min # N,M,3
+    intersection = side[:,:,0] * side[:,:,1] * side[:,:,2]
+    intersection[(side <= 0).any(2)] = 0
+    vol1 = bbs1[:,3] * bbs1[:,4] * bbs1[:,5]
+    vol2 = bbs2[:,3] * bbs2[:,4] * bbs2[:,5]
+    union = vol1[:,None] + vol2[None,:] - intersection
+    return 1.0*intersection / union
+
+from box_util import box3d_iou, box3d_iou_batch
 def get_iou_obb(bb1,bb2):
     iou3d, iou2d = box3d_iou(bb1,bb2)
     return iou3d
 
+def get_iou_obb_batch(bbs1, bbs2):
+    """ IoU matrix (N,M) of oriented boxes given by (N,8,3) and (M,8,3) corners """
+    iou3d, iou2d = box3d_iou_batch(bbs1, bbs2)
+    return iou3d
+
+# Pairwise IoU functions with a vectorized counterpart that computes the
+# IoU matrix between all predictions and GT boxes of an image at once
+BATCH_IOU_FUNCS = {get_iou: get_iou_batch, get_iou_obb: get_iou_obb_batch}
+
 def get_iou_main(get_iou_func, args):
     return get_iou_func(*args)
 
-def eval_det_cls(pred, gt, ovthresh=0.25, use_07_metric=False, get_iou_func=get_iou):
-    """ Generic functions to compute precision/recall for object detection
-        for a single class.
+def get_iou_matrix(get_iou_func, bbs1, bbs2):
+    """ IoU matrix (N,M) between two stacks of boxes, in one batched call if
+        get_iou_func has a vectorized counterpart """
+    if get_iou_func in BATCH_IOU_FUNCS:
+        return BATCH_IOU_FUNCS[get_iou_func](bbs1, bbs2)
+    return np.array([[get_iou_main(get_iou_func, (bb1, bb2)) for bb2 in bbs2] \
+        for bb1 in bbs1]).reshape(len(bbs1), len(bbs2))
+
+def match_img_dets(boxes, gt_boxes, get_iou_func=get_iou):
+    """ Best GT box of every detection of one image.
+        Output:
+            ovmax: numpy array of len(boxes), IoU with the best GT box (-inf
+                if there is none)
+            jmax: numpy array of len(boxes), index of that GT box
+    """
+    nd_img = len(boxes)
+    BBGT = np.array(gt_boxes).astype(float)
+    if BBGT.shape[0] == 0:
+        return np.full(nd_img, -np.inf), np.zeros(nd_img, dtype=np.int64)
+    BB = np.array(boxes).astype(float) # (nd_img,4 or 8,3 or 6)
+    overlaps = get_iou_matrix(get_iou_func, BB, BBGT) # nd_img,ngt
+    jmax = np.argmax(overlaps, 1)
+    return overlaps[np.arange(nd_img), jmax], jmax
+
+def match_dets(pred, gt, get_iou_func=get_iou):
+    """ Overlap of every detection with its best GT box, sorted by confidence.
         Input:
             pred: map of {img_id: [(bbox, score)]} where bbox is numpy array
             gt: map of {img_id: [bbox]}
-            ovthresh: scalar, iou threshold
-            use_07_metric: bool, if True use VOC07 11 point method
         Output:
-            rec: numpy array of length nd
-            prec: numpy array of length nd
-            ap: scalar, average precision
+            ovmax: numpy array of length nd, IoU with the best GT box of the
+                same image (-inf if the image has none)
+            gt_inds: numpy array of length nd, index of that GT box among all
+                GT boxes
+            npos: number of GT boxes
     """
-
-    # construct gt objects
-    class_recs = {} # {img_id: {'bbox': bbox list, 'det': matched list}}
+    gt_offset = {}
     npos = 0
     for img_id in gt.keys():
-        bbox = np.array(gt[img_id])
-        det = [False] * len(bbox)
-        npos += len(bbox)
-        class_recs[img_id] = {'bbox': bbox, 'det': det}
-    # pad empty list to all other imgids
-    for img_id in pred.keys():
-        if img_id not in gt:
-            class_recs[img_id] = {'bbox': np.array([]), 'det': []}
+        gt_offset[img_id] = npos
+        npos += len(gt[img_id])
 
-    # construct dets
-    image_ids = []
+    # one IoU matrix per image, in the order the detections are listed
     confidence = []
-    BB = []
+    ovmax = []
+    gt_inds = []
     for img_id in pred.keys():
-        for box,score in pred[img_id]:
-            image_ids.append(img_id)
-            confidence.append(score)
-            BB.append(box)
+        if len(pred[img_id]) == 0:
+            continue
+        confidence += [score for box,score in pred[img_id]]
+        ovmax_img, jmax = match_img_dets([box for box,score in pred[img_id]],
+            gt.get(img_id, []), get_iou_func)
+        ovmax.append(ovmax_img)
+        gt_inds.append(gt_offset.get(img_id, 0) + jmax)
     confidence = np.array(confidence)
-    BB = np.array(BB) # (nd,4 or 8,3 or 6)
+    ovmax = np.concatenate(ovmax) if len(ovmax) else np.zeros(0)
+    gt_inds = np.concatenate(gt_inds) if len(gt_inds) else np.zeros(0, dtype=np.int64)
 
     # sort by confidence
     sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
-    BB = BB[sorted_ind, ...]
-    image_ids = [image_ids[x] for x in sorted_ind]
+    return ovmax[sorted_ind], gt_inds[sorted_ind], npos
 
+def eval_matched_dets(ovmax, gt_inds, npos, ovthresh=0.25, use_07_metric=False):
+    """ Precision/recall from the output of match_dets.
+        A detection is a TP if it overlaps its best GT box by more than
+        ovthresh and no detection with a higher score claimed that box.
+    """
     # go down dets and mark TPs and FPs
-    nd = len(image_ids)
+    nd = len(ovmax)
     tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        #if d%100==0: print(d)
-        R = class_recs[image_ids[d]]
-        bb = BB[d,...].astype(float)
-        ovmax = -np.inf
-        BBGT = R['bbox'].astype(float)
-
-        if BBGT.size > 0:
-            # compute overlaps
-            for j in range(BBGT.shape[0]):
-                iou = get_iou_main(get_iou_func, (bb, BBGT[j,...]))
-                if iou > ovmax:
-                    ovmax = iou
-                    jmax = j
-
-        #print d, ovmax
-        if ovmax > ovthresh:
-            if not R['det'][jmax]:
-                tp[d] = 1.
-                R['det'][jmax] = 1
-            else:
-                fp[d] = 1.
-        else:
-            fp[d] = 1.
+    hits = np.where(ovmax > ovthresh)[0]
+    _, first_hits = np.unique(gt_inds[hits], return_index=True)
+    tp[hits[first_hits]] = 1.
+    fp = 1. - tp
 
     # compute precision recall
     fp = np.cumsum(fp)
@@ -160,8 +183,28 @@ def eval_det_cls(pred, gt, ovthresh=0.25, use_07_metric=False, get_iou_func=get_
 
     return rec, prec, ap
 
+def eval_det_cls(pred, gt, ovthresh=0.25, use_07_metric=False, get_iou_func=get_iou):
+    """ Generic functions to compute precision/recall for object detection
+        for a single class.
+        Input:
+            pred: map of {img_id: [(bbox, score)]} where bbox is numpy array
+            gt: map of {img_id: [bbox]}
+            ovthresh: scalar, iou threshold
+            use_07_metric: bool, if True use VOC07 11 point method
+        Output:
+            rec: numpy array of length nd
+            prec: numpy array of length nd
+            ap: scalar, average precision
+    """
+    ovmax, gt_inds, npos = match_dets(pred, gt, get_iou_func)
+    return eval_matched_dets(ovmax, gt_inds, npos, ovthresh, use_07_metric)
+
 def eval_det_cls_wrapper(arguments):
     pred, gt, ovthresh, use_07_metric, get_iou_func = arguments
+    if isinstance(ovthresh, (list, tuple)):
+        # overlaps are computed once and shared by all thresholds
+        ovmax, gt_inds, npos = match_dets(pred, gt, get_iou_func)
+        return [eval_matched_dets(ovmax, gt_inds, npos, thresh, use_07_metric) for thresh in ovthresh]
     rec, prec, ap = eval_det_cls(pred, gt, ovthresh, use_07_metric, get_iou_func)
     return (rec, prec, ap)
 
@@ -206,51 +249,138 @@ def eval_det(pred_all, gt_all, ovthresh=0.25, use_07_metric=False, get_iou_func=
     
     return rec, prec, ap 
 
+import atexit
+import multiprocessing
 from multiprocessing import Pool
-def eval_det_multiprocessing(pred_all, gt_all, ovthresh=0.25, use_07_metric=False, get_iou_func=get_iou):
+
+_POOLS = {} # {processes: Pool}
+def get_pool(processes=None):
+    """ Long-lived worker pool shared by all evaluations of the process,
+        with one worker per CPU by default. There is one pool per size, a
+        pool is never replaced while results queued on it are pending """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes not in _POOLS:
+        if not _POOLS:
+            atexit.register(close_pool)
+        _POOLS[processes] = Pool(processes=processes)
+    return _POOLS[processes]
+
+def close_pool():
+    while _POOLS:
+        _POOLS.popitem()[1].terminate()
+
+def match_scan(pred_list, gt_list, get_iou_func=get_iou):
+    """ Per class matching of the detections of one scan to its GT boxes.
+        Input:
+            pred_list: [(classname, bbox, score)]
+            gt_list: [(classname, bbox)]
+        Output:
+            {classname: (confidence, ovmax, jmax, ngt)} where the arrays have
+            one entry per detection of the class (see match_img_dets), classes
+            with detections first
+    """
+    pred = {}
+    gt = {}
+    for classname, bbox, score in pred_list:
+        pred.setdefault(classname, []).append((bbox,score))
+    for classname, bbox in gt_list:
+        gt.setdefault(classname, []).append(bbox)
+    ret = {}
+    for classname in pred:
+        ovmax, jmax = match_img_dets([bbox for bbox,score in pred[classname]],
+            gt.get(classname, []), get_iou_func)
+        ret[classname] = ([score for bbox,score in pred[classname]], ovmax, jmax,
+            len(gt.get(classname, [])))
+    for classname in gt:
+        if classname not in ret:
+            ret[classname] = ([], np.zeros(0), np.zeros(0, dtype=np.int64), len(gt[classname]))
+    return ret
+
+def match_scans(arguments):
+    """ match_scan for a list of (pred_list, gt_list), the unit of work sent to the pool """
+    scans, get_iou_func = arguments
+    return [match_scan(pred_list, gt_list, get_iou_func) for pred_list, gt_list in scans]
+
+def eval_matched_scans(matches, ovthresh=0.25, use_07_metric=False):
+    """ Precision/recall for every class from the output of match_scan for
+        all scans, in scan order.
+        Output:
+            rec: {classname: rec}, 0 for classes without detections
+            prec: {classname: prec_all}
+            ap: {classname: scalar}
+            (lists of them, one per threshold, if ovthresh is a list)
+    """
+    # classes with detections come first, like in eval_det
+    classnames = []
+    for pred_only in [True, False]:
+        for match in matches:
+            for classname in match:
+                if (len(match[classname][0]) > 0 or not pred_only) and classname not in classnames:
+                    classnames.append(classname)
+
+    ovthresh_list = ovthresh if isinstance(ovthresh, (list, tuple)) else [ovthresh]
+    rec = [{} for _ in ovthresh_list]
+    prec = [{} for _ in ovthresh_list]
+    ap = [{} for _ in ovthresh_list]
+    for classname in classnames:
+        confidence = []
+        ovmax = []
+        gt_inds = []
+        npos = 0
+        for match in matches:
+            if classname not in match:
+                continue
+            confidence_scan, ovmax_scan, jmax, ngt = match[classname]
+            confidence += confidence_scan
+            ovmax.append(ovmax_scan)
+            gt_inds.append(npos + jmax)
+            npos += ngt
+        for t in range(len(ovthresh_list)):
+            if len(confidence) == 0:
+                rec[t][classname] = 0
+                prec[t][classname] = 0
+                ap[t][classname] = 0
+                continue
+            # sort by confidence
+            sorted_ind = np.argsort(-np.array(confidence))
+            rec[t][classname], prec[t][classname], ap[t][classname] = eval_matched_dets(
+                np.concatenate(ovmax)[sorted_ind], np.concatenate(gt_inds)[sorted_ind],
+                npos, ovthresh_list[t], use_07_metric)
+
+    if isinstance(ovthresh, (list, tuple)):
+        return rec, prec, ap
+    return rec[0], prec[0], ap[0]
+
+def eval_det_multiprocessing(pred_all, gt_all, ovthresh=0.25, use_07_metric=False, get_iou_func=get_iou,
+    num_workers=None):
     """ Generic functions to compute precision/recall for object detection
         for multiple classes.
         Input:
             pred_all: map of {img_id: [(classname, bbox, score)]}
             gt_all: map of {img_id: [(classname, bbox)]}
-            ovthresh: scalar, iou threshold
+            ovthresh: scalar, iou threshold, or a list of them to evaluate
+                with a single IoU computation per prediction-GT pair
             use_07_metric: bool, if true use VOC07 11 point method
+            num_workers: [optional] size of the shared worker pool, the scans
+                are split in chunks across the workers
         Output:
             rec: {classname: rec}
             prec: {classname: prec_all}
             ap: {classname: scalar}
+            (lists of them, one per threshold, if ovthresh is a list)
     """
-    pred = {} # map {classname: pred}
-    gt = {} # map {classname: gt}
-    for img_id in pred_all.keys():
-        for classname, bbox, score in pred_all[img_id]:
-            if classname not in pred: pred[classname] = {}
-            if img_id not in pred[classname]:
-                pred[classname][img_id] = []
-            if classname not in gt: gt[classname] = {}
-            if img_id not in gt[classname]:
-                gt[classname][img_id] = []
-            pred[classname][img_id].append((bbox,score))
-    for img_id in gt_all.keys():
-        for classname, bbox in gt_all[img_id]:
-            if classname not in gt: gt[classname] = {}
-            if img_id not in gt[classname]:
-                gt[classname][img_id] = []
-            gt[classname][img_id].append(bbox)
-
-    rec = {}
-    prec = {}
-    ap = {}
-    p = Pool(processes=10)
-    ret_values = p.map(eval_det_cls_wrapper, [(pred[classname], gt[classname], ovthresh, use_07_metric, get_iou_func) for classname in gt.keys() if classname in pred])
-    p.close()
-    for i, classname in enumerate(gt.keys()):
-        if classname in pred:
-            rec[classname], prec[classname], ap[classname] = ret_values[i]
-        else:
-            rec[classname] = 0
-            prec[classname] = 0
-            ap[classname] = 0
-        print(classname, ap[classname])
+    img_ids = list(pred_all.keys()) + [img_id for img_id in gt_all.keys() if img_id not in pred_all]
+    scans = [(pred_all.get(img_id, []), gt_all.get(img_id, [])) for img_id in img_ids]
+    num_workers = num_workers or multiprocessing.cpu_count()
+    p = get_pool(num_workers)
+    chunk_size = max(1, int(np.ceil(len(scans) / (4.0*num_workers))))
+    matches = []
+    for ret in p.map(match_scans, [(scans[i:i+chunk_size], get_iou_func) \
+        for i in range(0, len(scans), chunk_size)]):
+        matches += ret
+    rec, prec, ap = eval_matched_scans(matches, ovthresh, use_07_metric)
+    for classname in (ap[0] if isinstance(ovthresh, (list, tuple)) else ap).keys():
+        print(classname, [ap_t[classname] for ap_t in ap] if isinstance(ovthresh, (list, tuple)) else ap[classname])
     
-    return rec, prec, ap 
+    return rec, prec, ap
@@ -4,7 +4,9 @@
 # LICENSE file in the root directory of this source tree.
 
 import numpy as np
+import torch
 from pc_util import bbox_corner_dist_measure
+from box_util import box3d_iou_batch_torch
 
 # boxes are axis aigned 2D boxes of shape (n,5) in FLOAT numbers with (x1,y1,x2,y2,score)
 ''' Ref: https://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
@@ -155,6 +157,97 @@ def nms_3d_faster_samecls(boxes, overlap_threshold, old_type=False):
     return pick
 
 
+def nms_batch(boxes, scores, overlap_threshold, old_type=False, classes=None, valid=None):
+    """ Greedy NMS for a whole batch of axis aligned boxes with torch ops.
+    Same picks as nms_2d_faster/nms_3d_faster/nms_3d_faster_samecls, but the
+    pairwise overlaps of all boxes are computed at once and the greedy
+    suppression is resolved by a vectorized sweep over keep masks.
+
+    Args:
+        boxes: (B,K,2*D) tensor of (min coords, max coords), D is 2 or 3
+        scores: (B,K) tensor
+        overlap_threshold: boxes with IoU (IoBox2Area if old_type) above it
+            are suppressed by a box with a higher score
+        classes: [optional] (B,K) tensor, class-aware NMS if given: boxes of
+            different classes are moved apart by a per-class offset so that
+            they never overlap
+        valid: [optional] (B,K) mask tensor, boxes to consider
+    Returns:
+        keep: (B,K) mask tensor of the picked boxes (dtype of a comparison)
+    """
+    D = boxes.shape[2] // 2
+    if classes is not None:
+        span = boxes.max() - boxes.min() + 1
+        boxes = boxes + (classes.to(boxes.dtype) * span).unsqueeze(2)
+    if valid is None:
+        valid = torch.ones_like(scores) > 0
+    # Sort by descending score, so box i can only be suppressed by boxes j < i
+    order = torch.argsort(scores, 1, descending=True)
+    boxes = torch.gather(boxes, 1, order.unsqueeze(2).expand(-1,-1,2*D))
+    valid = torch.gather(valid, 1, order)
+
+    inter = None # B,K,K, accumulated one axis at a time
+    for d in range(D):
+        side = torch.min(boxes[:,:,None,D+d], boxes[:,None,:,D+d]) - \
+            torch.max(boxes[:,:,None,d], boxes[:,None,:,d])
+        side.clamp_(min=0)
+        inter = side if inter is None else inter.mul_(side)
+    area = torch.prod(boxes[:,:,D:]-boxes[:,:,:D], 2) # B,K
+    if old_type:
+        overlap = inter / area[:,None,:]
+    else:
+        overlap = inter / (area[:,:,None] + area[:,None,:] - inter)
+    keep = _nms_sweep(overlap, valid, overlap_threshold)
+    return torch.zeros_like(keep).scatter_(1, order, keep)
+
+def nms_3d_rotated_batch(corners, scores, overlap_threshold, classes=None, valid=None):
+    """ Greedy NMS for a whole batch of boxes rotated about the up axis.
+    Like nms_batch, but the overlap is the IoU of the oriented boxes
+    (box_util.box3d_iou_batch_torch) instead of their axis aligned extents.
+
+    Args:
+        corners: (B,K,8,3) tensor of box corners, up direction is negative Y
+        scores: (B,K) tensor
+        classes, valid: [optional] (B,K) tensors, see nms_batch
+    Returns:
+        keep: (B,K) mask tensor of the picked boxes
+    """
+    B, K = scores.shape
+    if classes is not None:
+        span = corners.max() - corners.min() + 1
+        offset = torch.zeros_like(corners)
+        offset[:,:,:,0] = (classes.to(corners.dtype) * span).unsqueeze(2)
+        corners = corners + offset
+    if valid is None:
+        valid = torch.ones_like(scores) > 0
+    order = torch.argsort(scores, 1, descending=True)
+    corners = torch.gather(corners, 1, order[:,:,None,None].expand(-1,-1,8,3))
+    valid = torch.gather(valid, 1, order)
+    overlap = torch.stack([box3d_iou_batch_torch(corners[i], corners[i])[0] for i in range(B)], 0)
+    keep = _nms_sweep(overlap, valid, overlap_threshold)
+    return torch.zeros_like(keep).scatter_(1, order, keep)
+
+def _nms_sweep(overlap, valid, overlap_threshold):
+    """ Greedy suppression of (B,K) boxes sorted by descending score, given
+    their (B,K,K) pairwise overlaps. Returns the keep mask in sorted order. """
+    K = valid.shape[1]
+    # suppress[b,j,i]: box j suppresses box i if j is kept
+    suppress = (overlap > overlap_threshold) & \
+        (torch.ones(K, K, device=overlap.device).triu(1) > 0)
+
+    # Box i is kept iff it is valid and no kept box with a higher score
+    # suppresses it. Starting from all valid boxes, every sweep fixes at
+    # least the next box in score order, usually far fewer than K sweeps are
+    # needed until the masks stop changing.
+    keep = valid
+    for _ in range(K):
+        new_keep = valid & ~(suppress & keep.unsqueeze(2)).any(1)
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
 def nms_crnr_dist(boxes, conf, overlap_threshold):
         
     I = np.argsort(conf)
@@ -9,7 +9,9 @@ Author: Charles R. Qi and Or Litany
 """
 
 import os
+import io
 import sys
+import struct
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(BASE_DIR)
 
@@ -42,6 +44,24 @@ def random_sampling(pc, num_sample, replace=None, return_choices=False):
     else:
         return pc[choices]
 
+def voxel_downsample(pc, voxel_size):
+    """ Input is NxC, output is MxC with the mean of the points in every occupied
+        voxel of a grid with voxel_size, binned by the first three (XYZ) columns.
+        Points with non-finite coordinates (e.g. invalid depth) are dropped.
+    """
+    pc = pc[np.isfinite(pc[:,0:3]).all(1)]
+    if len(pc) == 0:
+        return pc
+    voxels = np.floor((pc[:,0:3] - pc[:,0:3].min(0)) / voxel_size).astype(np.int64) # N,3
+    dims = voxels.max(0) + 1
+    keys = (voxels[:,0]*dims[1] + voxels[:,1])*dims[2] + voxels[:,2]
+    _, inds, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    inds = inds.reshape(-1)
+    out = np.empty((len(counts), pc.shape[1]), dtype=pc.dtype)
+    for i in range(pc.shape[1]):
+        out[:,i] = np.bincount(inds, weights=pc[:,i], minlength=len(counts)) / counts
+    return out
+
 # ----------------------------------------
 # Point Cloud/Volume Conversions
 # ----------------------------------------
@@ -190,13 +210,158 @@ def point_cloud_to_image(points, imgsize, radius=1.0, num_sample=128):
 # Point cloud IO
 # ----------------------------------------
 
-def read_ply(filename):
-    """ read XYZ point cloud from filename PLY file """
-    plydata = PlyData.read(filename)
-    pc = plydata['vertex'].data
-    pc_array = np.array([[x, y, z] for x,y,z in pc])
-    return pc_array
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+PLY_BYTE_ORDER = {'ascii': '=', 'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+def read_ply_header(f):
+    """ Parse the header of a binary file object up to end_header. Returns format, a list of
+    (element name, count, [(property name, type or None for lists)]) and the raw header """
+    header = [f.readline()]
+    if header[0].strip() != b'ply':
+        raise ValueError('Not a PLY file')
+    fmt = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('PLY header without end_header')
+        header.append(line)
+        words = line.decode('ascii').split()
+        if not words or words[0] in ['comment', 'obj_info']:
+            continue
+        if words[0] == 'end_header':
+            return fmt, elements, b''.join(header)
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            prop_type = None if words[1] == 'list' else PLY_TYPES[words[1]]
+            elements[-1][2].append((words[-1], prop_type))
+
+def _columns_as_float32(vertex, names):
+    """ (N,len(names)) float32 array of fields of a structured array, a view if possible """
+    offsets = [vertex.dtype.fields[name][1] for name in names]
+    if all(vertex.dtype.fields[name][0] == np.dtype(np.float32) for name in names) and \
+        offsets == list(range(offsets[0], offsets[0]+4*len(names), 4)):
+        return np.ndarray((len(vertex), len(names)), np.float32, vertex, offsets[0], (vertex.dtype.itemsize, 4))
+    pc = np.empty((len(vertex), len(names)), dtype=np.float32)
+    for i, name in enumerate(names):
+        pc[:,i] = vertex[name]
+    return pc
+
+def read_ply(filename, color=False):
+    """ read XYZ (N,3) point cloud from a PLY file name, file object or bytes,
+    or XYZRGB (N,6) with color=True (colors as stored, e.g. 0-255 for uchar).
 
+    The vertex block of binary files is mapped into a structured array without
+    per point python work, XYZ is returned as read-only float32 view where possible.
+    Files with list properties before or in the vertex element are read by plyfile.
+
+    Returns float32 points (float64 before the structured reader). The array may be a
+    read-only view of the file data, use np.array(pc) before modifying it in place.
+    """
+    names = ['x', 'y', 'z'] + (['red', 'green', 'blue'] if color else [])
+    if isinstance(filename, bytes):
+        f = io.BytesIO(filename)
+    elif isinstance(filename, str):
+        f = open(filename, 'rb')
+    else:
+        f = filename
+    try:
+        fmt, elements, header = read_ply_header(f)
+        data = f.read()
+    finally:
+        if isinstance(filename, str):
+            f.close()
+
+    if 'vertex' not in [name for name, _, _ in elements]:
+        raise ValueError('PLY file without vertex element')
+
+    # Skip the elements before the vertex element
+    skip = 0
+    for name, count, props in elements:
+        if name == 'vertex':
+            break
+        if any(prop_type is None for _, prop_type in props):
+            skip = None
+            break
+        skip += count if fmt == 'ascii' else count*np.dtype([(p, t) for p, t in props]).itemsize
+    if skip is None or any(prop_type is None for _, prop_type in props):
+        vertex = PlyData.read(io.BytesIO(header + data))['vertex'].data
+        return _columns_as_float32(vertex, names)
+
+    if fmt == 'ascii':
+        lines = data.split(b'\n', skip+count)
+        values = np.array(b' '.join(lines[skip:skip+count]).split(), dtype=np.float64)
+        values = values.reshape(count, len(props))
+        prop_names = [p for p, _ in props]
+        return values[:,[prop_names.index(name) for name in names]].astype(np.float32)
+    byte_order = PLY_BYTE_ORDER[fmt]
+    vertex = np.frombuffer(data, dtype=np.dtype([(p, byte_order+t) for p, t in props]), count=count, offset=skip)
+    return _columns_as_float32(vertex, names)
+
+# Raw point buffer: 12 byte header and little endian float32 (N,C) points, C is 3 (XYZ) or 6 (XYZRGB).
+# The header holds magic, version, C, codec (0: none, 1: zstd, 2: lz4 frame) and N, only the
+# points after the header are compressed.
+POINT_BUFFER_HEADER = struct.Struct('<4sBBBxI')
+POINT_BUFFER_MAGIC = b'PTS\x00'
+POINT_BUFFER_VERSION = 1
+POINT_BUFFER_CODECS = ['none', 'zstd', 'lz4']
+
+def write_point_buffer(points, codec='none'):
+    """ Serialize (N,3) or (N,6) points into a raw point buffer """
+    assert(points.ndim == 2 and points.shape[1] in [3, 6])
+    data = np.ascontiguousarray(points, dtype='<f4').tobytes()
+    if codec == 'zstd':
+        import zstandard
+        data = zstandard.ZstdCompressor().compress(data)
+    elif codec == 'lz4':
+        import lz4.frame
+        data = lz4.frame.compress(data)
+    header = POINT_BUFFER_HEADER.pack(POINT_BUFFER_MAGIC, POINT_BUFFER_VERSION, points.shape[1],
+        POINT_BUFFER_CODECS.index(codec), points.shape[0])
+    return header + data
+
+def read_point_buffer(data):
+    """ (N,C) float32 points of a raw point buffer, a read-only view of the (decompressed) bytes.
+    Raises ValueError for malformed or corrupt buffers and ImportError if the codec module is not installed. """
+    if len(data) < POINT_BUFFER_HEADER.size:
+        raise ValueError('Point buffer shorter than its header')
+    magic, version, num_channel, codec, num_point = POINT_BUFFER_HEADER.unpack_from(data)
+    if magic != POINT_BUFFER_MAGIC or version != POINT_BUFFER_VERSION:
+        raise ValueError('Not a point buffer of version %d'%(POINT_BUFFER_VERSION))
+    if num_channel not in [3, 6] or codec >= len(POINT_BUFFER_CODECS):
+        raise ValueError('Point buffer with %d channels and codec %d'%(num_channel, codec))
+    size = num_point*num_channel*4
+    offset = POINT_BUFFER_HEADER.size
+    # Decompression is bounded by the expected size, so a small body cannot inflate to
+    # arbitrary memory, one byte more than expected is enough to detect longer payloads
+    if POINT_BUFFER_CODECS[codec] == 'zstd':
+        import zstandard
+        try:
+            # decompress() trusts the content size of the frame header, a stream read is bounded
+            with zstandard.ZstdDecompressor().stream_reader(memoryview(data)[offset:]) as reader:
+                data = reader.read(size+1)
+        except zstandard.ZstdError as e:
+            raise ValueError('Corrupt zstd point buffer: %s'%(str(e)))
+        offset = 0
+    elif POINT_BUFFER_CODECS[codec] == 'lz4':
+        import lz4.frame
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            data = decompressor.decompress(memoryview(data)[offset:], max_length=size+1)
+        except RuntimeError as e:
+            raise ValueError('Corrupt lz4 point buffer: %s'%(str(e)))
+        if len(data) <= size and not decompressor.eof:
+            raise ValueError('Truncated lz4 point buffer')
+        offset = 0
+    if len(data) - offset != size:
+        raise ValueError('Point buffer with %d bytes of points, expected %d'%(len(data) - offset, size))
+    return np.frombuffer(data, dtype='<f4', count=num_point*num_channel, offset=offset).reshape(num_point, num_channel)
 
 def write_ply(points, filename, text=True):
     """ input: Nx3, write points to filename as PLY format. """
@@ -3,6 +3,9 @@ import pyrealsense2 as rs
 import yaml
 import os.path
 import os, sys, inspect, math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 import numpy as np
 import cv2
 
@@ -16,7 +19,8 @@ Example usage:
     to get all possible Frames:
     python3 extract_data_realsense.py filename.bag 1
 
-the --length argument is not always working as expected
+    to get every 10th frame of the seconds 20 to 50 of the recording:
+    python3 extract_data_realsense.py filename.bag 10 --start 20 --length 30
 """
 
 RS_CONFIG_FILE = os.path.dirname(__file__) + '../raw_data/realsense/config.yml'
@@ -42,8 +46,10 @@ def get_file_count():
 def count_frames():
     """Count the number of frames resulting from camera FPS and extraction interval."""
     stream_cfg = read_config()
-    count = args.length*stream_cfg['depth']['fps']/args.interval
-    return int(math.floor(count * 1) *0.5 / 1)
+    count = int(math.ceil(args.length*stream_cfg['depth']['fps']/float(args.interval)))
+    if args.max_frames is not None:
+        count = min(count, args.max_frames)
+    return count
 
 def read_format(stream_cfg):
     """Read the format of the depth and color stream."""
@@ -76,7 +82,9 @@ def initialize_device(file: str):
     pipeline = rs.pipeline()
     config.enable_stream(rs.stream.depth, stream_cfg['depth']['width'],stream_cfg['depth']['height'], depth_format, stream_cfg['depth']['fps'])
     config.enable_stream(rs.stream.color, stream_cfg['color']['width'],stream_cfg['color']['height'], color_format, stream_cfg['color']['fps'])
-    pipeline.start(config)
+    profile = pipeline.start(config)
+    # Without real time playback the recording waits for the extractor instead of dropping frames
+    profile.get_device().as_playback().set_real_time(False)
     return pipeline
 
 def write_calib(intrin, extrin):
@@ -89,27 +97,85 @@ def write_calib(intrin, extrin):
         yaml.dump(calib, file)
     return
 
+def write_ply(filename, vertices, colors):
+    """Write vertices (N,3) with uint8 colors (N,3) as binary little endian .ply file."""
+    cloud = np.empty(len(vertices), dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+        ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    cloud['x'], cloud['y'], cloud['z'] = vertices[:,0], vertices[:,1], vertices[:,2]
+    cloud['red'], cloud['green'], cloud['blue'] = colors[:,0], colors[:,1], colors[:,2]
+    header = ('ply\nformat binary_little_endian 1.0\ncomment pointcloud saved from Realsense bag\n'
+        'element vertex %d\nproperty float x\nproperty float y\nproperty float z\n'
+        'property uchar red\nproperty uchar green\nproperty uchar blue\nend_header\n' % len(cloud))
+    with open(filename, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(cloud.tobytes())
+
+def write_frame(i, vertices, texcoords, depth_image, color_image):
+    """Encode and write point cloud, depth map and color image of one frame, runs on a writer thread."""
+    # Same as rs.points.export_to_ply: drop points without depth, color of the nearest texture pixel
+    valid = np.any(np.abs(vertices) >= 1e-6, axis=1)
+    height, width = color_image.shape[:2]
+    x = np.clip((texcoords[valid,0]*width + 0.5).astype(np.int32), 0, width-1)
+    y = np.clip((texcoords[valid,1]*height + 0.5).astype(np.int32), 0, height-1)
+    write_ply(CLOUD_DIR + str(i).zfill(4) + '.ply', vertices[valid], color_image[y,x])
+
+    cv2.imwrite(DEPTH_DIR + str(i).zfill(4) + ".png", depth_image)
+    cv2.imwrite(IMAGE_DIR + str(i).zfill(4) + ".jpg", cv2.cvtColor(color_image, cv2.COLOR_RGB2BGR))
+
+def frame_position(timestamp, start_timestamp):
+    """Position of a frame relative to the extracted part of the recording: -1 before, 0 within, 1 after."""
+    elapsed = (timestamp - start_timestamp) / 1000.0 - args.start
+    if elapsed < 0:
+        return -1
+    if args.length is not None and elapsed >= args.length:
+        return 1
+    return 0
+
 def extract_data(pl):
     """Extract depth maps, color images and point clouds from recording
 
+    The playback thread only waits for, aligns and copies the frames. Encoding and writing
+    the files runs on a pool of writer threads, at most 2*writers frames are pending, after
+    that the playback waits for the writers.
+
     Parameters:
     pipeline : Pipeline stream from recording
    """
     global CALIB_FILE
 
     pipeline = pl
+    align = rs.align(rs.stream.color)
+    pc = rs.pointcloud()
+    writers = ThreadPoolExecutor(args.writers)
+    pending = threading.BoundedSemaphore(2*args.writers)
+    errors = []
+
+    def frame_written(future):
+        pending.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    #get file count to properly continue extracting files if there are extracted files from previous .bag file
+    i = get_file_count() + 1
+    j = 0
+    n = 0
+    start_timestamp = None
     try:
-        #get file count to properly continue extracting files if there are extracted files from previous .bag file
-        i = get_file_count() + 1
-        j = 1
-        while True:
-            for x in range(args.interval):
-                pipeline.wait_for_frames()
-            
+        while args.max_frames is None or j < args.max_frames:
             frames = pipeline.wait_for_frames()
+            if start_timestamp is None:
+                start_timestamp = frames.get_timestamp()
+            position = frame_position(frames.get_timestamp(), start_timestamp)
+            if position > 0 or errors:
+                break
+            if position < 0:
+                continue
+            #keep every interval-th frame of the extracted part
+            n += 1
+            if (n-1) % args.interval != 0:
+                continue
 
             #stream alignment
-            align = rs.align(rs.stream.color)
             frames = align.process(frames)
 
             #get depth and color frames
@@ -124,30 +190,29 @@ def extract_data(pl):
                 extrin = color_frame.profile.get_extrinsics_to(color_frame.profile)
                 write_calib(intrin, extrin)
 
-            #instatiate pointcloud
-            pc = rs.pointcloud()
-            points = rs.points()
-
-            #transform to numpy arrays
-            depth_image = np.asanyarray(depth_frame.get_data())
-            color_image = np.asanyarray(color_frame.get_data())
-
-            #get and save point clouds in .ply format
+            #calculate point cloud, copy everything out of the frames as they go back to the pool
             pc.map_to(color_frame)
             points = pc.calculate(depth_frame)
-            print("Extracting frame:", i)
-            points.export_to_ply(CLOUD_DIR + str(i).zfill(4) + '.ply', color_frame)
+            vertices = np.asanyarray(points.get_vertices()).view(np.float32).reshape(-1, 3).copy()
+            texcoords = np.asanyarray(points.get_texture_coordinates()).view(np.float32).reshape(-1, 2).copy()
+            depth_image = np.asanyarray(depth_frame.get_data()).copy()
+            color_image = np.asanyarray(color_frame.get_data()).copy()
 
-            #save image and depth map
-            cv2.imwrite(DEPTH_DIR + str(i).zfill(4) + ".png", depth_image)
-            cv2.imwrite(IMAGE_DIR + str(i).zfill(4) + ".jpg", cv2.cvtColor(color_image, cv2.COLOR_RGB2BGR))
+            print("Extracting frame:", i)
+            pending.acquire()
+            future = writers.submit(write_frame, i, vertices, texcoords, depth_image, color_image)
+            future.add_done_callback(frame_written)
 
             i += 1
             j += 1
     except (RuntimeError):
-        print('End of recording. Extracted frames: ' + str(j-1))
+        print('End of recording.')
     finally:
-        pass
+        writers.shutdown(wait=True)
+        pipeline.stop()
+    if errors:
+        raise errors[0]
+    print('Extracted frames: ' + str(j))
 
 
 def main():
@@ -165,15 +230,20 @@ def main():
 
     #If all data is extracted it can be zipped using this function
     if args.compress is not None:
-        zipping.create_zip_archive_stage_one(args.compress)
+        zipping.create_zip_archive_stage_one(args.compress, codec=args.codec, level=args.level)
     else: pass
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()  
     parser.add_argument("file", type=str, help=".Bag file to read")
     parser.add_argument("interval", type=int, help="How many frames to save: lower = more data / higher = less data")
-    parser.add_argument("-l", "--length", type=int, help="Length of the recording (in Seconds)")
+    parser.add_argument("-l", "--length", type=float, help="Length of the extracted part of the recording (in Seconds)")
+    parser.add_argument("-s", "--start", type=float, default=0, help="Start of the extracted part of the recording (in Seconds)")
+    parser.add_argument("-m", "--max_frames", type=int, help="Maximum number of extracted frames")
+    parser.add_argument("-w", "--writers", type=int, default=multiprocessing.cpu_count(), help="Number of threads encoding and writing the extracted frames")
     parser.add_argument("-c", "--compress", type=str, help="Specify archive name to compress extracted files.")
+    parser.add_argument("--codec", type=str, default='deflate', choices=list(zipping.CODECS.keys()), help="Compression of the archive, .jpg/.png files are always stored.")
+    parser.add_argument("--level", type=int, help="Compression level of the archive, default of the codec if not specified.")
     args = parser.parse_args()
     
     main()
\ No newline at end of file
@@ -1,5 +1,7 @@
 import os, shutil, sys
 import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from natsort import natsorted
 import cv2
 import yaml
@@ -90,34 +92,70 @@ def write_calib(fx, fy, cx, cy):
     return
 
 
-def extract_images(size_x, size_y):
-    i = 1
-    for filename in natsorted(os.listdir(FILES_DIR)):
-        if filename.startswith('ZED_image'):
-            print('Extracting image ' + str(i))
-            img = cv2.imread(FILES_DIR + filename, 1)
-            crop_img = img[0:0+size_x, 0:0+size_y]
-            cv2.imwrite(IMAGE_DIR + str(i).zfill(4) + '.jpg',crop_img)
-            i += 1
-        else: pass
+FICLONE = 0x40049409 # Linux ioctl to share the extents of a file (reflink) on btrfs, xfs, ...
 
-def extract_clouds():
-    i = 1
+def classify_files():
+    """Sort the recorded files into images, clouds and depth maps with a single directory scan."""
+    files = {'image': [], 'cloud': [], 'depth': []}
     for filename in natsorted(os.listdir(FILES_DIR)):
-        if filename.startswith('Cloud'):
-            print('Extracting point cloud ' + str(i))
-            shutil.copy2(FILES_DIR + filename, CLOUD_DIR + str(i).zfill(4) + '.ply')
-            i += 1
-        else: pass
-
-def extract_depth():
-    i = 1
-    for filename in natsorted(os.listdir(FILES_DIR)):
-        if filename.startswith('Depth') and filename.endswith('.png'):
-            print('Extracting depth map ' + str(i))
-            shutil.copy2(FILES_DIR + filename, DEPTH_DIR + str(i).zfill(4) + '.png')
-            i += 1
+        if filename.startswith('ZED_image'):
+            files['image'].append(filename)
+        elif filename.startswith('Cloud'):
+            files['cloud'].append(filename)
+        elif filename.startswith('Depth') and filename.endswith('.png'):
+            files['depth'].append(filename)
         else: pass
+    return files
+
+def reflink(src, dst):
+    """Copy-on-write clone of a file, raises OSError where the platform or filesystem does not support it."""
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def link_file(src, dst, mode='auto'):
+    """Reflink, hardlink or copy src to dst, 'auto' uses the first of these the filesystem supports."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode in ['auto', 'reflink']:
+        try:
+            return reflink(src, dst)
+        except (OSError, ImportError):
+            if mode == 'reflink': raise
+    if mode in ['auto', 'hardlink']:
+        try:
+            return os.link(src, dst)
+        except OSError:
+            if mode == 'hardlink': raise
+    shutil.copy2(src, dst)
+
+def extract_image(filename, i, size_x, size_y):
+    img = cv2.imread(FILES_DIR + filename, 1)
+    crop_img = img[0:0+size_x, 0:0+size_y]
+    cv2.imwrite(IMAGE_DIR + str(i).zfill(4) + '.jpg',crop_img)
+
+def extract_files(size_x, size_y):
+    """Crop images and link clouds and depth maps on a thread pool, files of each kind are numbered from 1."""
+    files = classify_files()
+    with ThreadPoolExecutor(args.workers) as pool:
+        futures = {}
+        for i, filename in enumerate(files['image'], 1):
+            futures[pool.submit(extract_image, filename, i, size_x, size_y)] = 'image ' + str(i)
+        for i, filename in enumerate(files['cloud'], 1):
+            futures[pool.submit(link_file, FILES_DIR + filename, CLOUD_DIR + str(i).zfill(4) + '.ply',
+                args.link)] = 'point cloud ' + str(i)
+        for i, filename in enumerate(files['depth'], 1):
+            futures[pool.submit(link_file, FILES_DIR + filename, DEPTH_DIR + str(i).zfill(4) + '.png',
+                args.link)] = 'depth map ' + str(i)
+        for future in as_completed(futures):
+            future.result()
+            print('Extracted ' + futures[future])
 
 
 def main():
@@ -130,19 +168,21 @@ def main():
         fx, fy, cx, cy = extract_calib(args.resolution)
         write_calib(fx, fy, cx, cy)
     size_x, size_y = define_image_size(args.resolution)
-    extract_images(size_x, size_y)
-    extract_clouds()
-    extract_depth()
+    extract_files(size_x, size_y)
 
     #If all data is extracted it can be zipped using this function
     if args.compress is not None:
-        zipping.create_zip_archive_stage_one(args.compress)
+        zipping.create_zip_archive_stage_one(args.compress, codec=args.codec, level=args.level)
     else: pass
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()  
     parser.add_argument("resolution", type=str, choices=['2k','fhd', 'hd', 'vga'],help="Resolution of recorded RGB-D frames.")
     parser.add_argument("-c", "--compress", type=str, help="Specify archive name to compress extracted files.")
+    parser.add_argument("--codec", type=str, default='deflate', choices=list(zipping.CODECS.keys()), help="Compression of the archive, .jpg/.png files are always stored.")
+    parser.add_argument("--level", type=int, help="Compression level of the archive, default of the codec if not specified.")
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(), help="Number of threads cropping images and linking files.")
+    parser.add_argument("-l", "--link", type=str, default='auto', choices=['auto', 'reflink', 'hardlink', 'copy'], help="How clouds and depth maps are extracted, 'auto' uses the first of reflink, hardlink and copy the filesystem supports.")
     args = parser.parse_args()
 
     main()
\ No newline at end of file
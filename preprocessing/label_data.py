@@ -9,7 +9,7 @@ sys.path.append('../')
 from utils import prompt, zipping
 
 
-DATA_DIR = 'processed_data/cloud/'
+DATA_DIR = 'processed_data/'
 LABEL_DIR = 'processed_data/label_3d/'
 
 
@@ -86,9 +86,13 @@ def clean_up():
         elif item.endswith('.ply'):
             os.remove(item)
 
-def label_loop(filename):
+def read_cloud(source, filename):
+    with source.local_path('cloud/' + filename) as path:
+        return o3d.io.read_point_cloud(path)
+
+def label_loop(source, filename):
     print('Filename: ' + filename)
-    pcd = o3d.io.read_point_cloud(DATA_DIR + filename)
+    pcd = read_cloud(source, filename)
     
     pick_points(pcd)
     obj = get_final_object_cloud()
@@ -97,9 +101,9 @@ def label_loop(filename):
     write_to_json(file_name=filename,class_name=class_name,center = center,wlh = wlh,add=False)
     clean_up()
 
-def label_loop_more_objects(filename):
+def label_loop_more_objects(source, filename):
     print('Filename: ' + filename)
-    pcd = o3d.io.read_point_cloud(DATA_DIR + filename)
+    pcd = read_cloud(source, filename)
     pick_points(pcd)
     obj = get_final_object_cloud()
     center, wlh = get_bb_values(obj)
@@ -110,7 +114,7 @@ def label_loop_more_objects(filename):
     if answer == False:
         pass
     else:
-        label_loop_more_objects(filename)
+        label_loop_more_objects(source, filename)
 
 
 def main():
@@ -118,29 +122,23 @@ def main():
     if not os.path.exists(LABEL_DIR):
         os.makedirs(LABEL_DIR) 
 
-    # Check if compressed data should be used - If yes, the 'data/' folder is emptied first and the archive is extracted into it
-    if args.compressed_data is not None:
-        for root, dirs, files in os.walk(DATA_DIR):
-            for f in files:
-                os.unlink(os.path.join(root, f))
-            for d in dirs:
-                shutil.rmtree(os.path.join(root, d))
-        zipping.read_zip_archive(args.compressed_data)
+    # Check if compressed data should be used - If yes, the clouds are read straight from the archive
+    source = zipping.DataSource(DATA_DIR, args.compressed_data)
 
     existing_labels = check_existing_label() 
 
     # Skip first n clouds when they have been already labeled
     # After that, perform labeling
-    for filename in natsorted(os.listdir(DATA_DIR))[existing_labels:]:
-        label_loop(filename)
+    for filename in natsorted(source.listdir('cloud'))[existing_labels:]:
+        label_loop(source, filename)
         answer = prompt.main(message = 'Are there other objects within the point cloud (y/n)?')
         if answer == False:
             pass
         else:
-            label_loop_more_objects(filename)
+            label_loop_more_objects(source, filename)
     
     if args.compress is not None:
-        zipping.create_zip_archive_stage_three(args.compress)
+        zipping.create_zip_archive_stage_three(args.compress, codec=args.codec, level=args.level, source=source)
     else: pass
 
     
@@ -150,6 +148,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()  
     parser.add_argument("-cd", "--compressed_data", type=str, help="Specify archive name to load extraced files from.")
     parser.add_argument("-c", "--compress", type=str, help="Specify archive name to compress extracted files.")
+    parser.add_argument("--codec", type=str, default='deflate', choices=list(zipping.CODECS.keys()), help="Compression of the archive, .jpg/.png files are always stored.")
+    parser.add_argument("--level", type=int, help="Compression level of the archive, default of the codec if not specified.")
     args = parser.parse_args()
 
     main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os, shutil, sys
 import open3d as o3d
 import argparse
+import multiprocessing
 from natsort import natsorted
 import numpy as np
 from distutils.dir_util import copy_tree
@@ -19,68 +20,110 @@ Example usage:
 
 DATA_DIR = 'data/'
 PROCESSED_DATA_DIR = 'processed_data/'
-
-def processing_loop():
-    i = 1
-    for filename in natsorted(os.listdir(DATA_DIR + 'cloud/')):
-        print('----- Processing point cloud ' + str(i) + ' -----')
-        pcd = o3d.io.read_point_cloud(DATA_DIR + 'cloud/' + filename)
-        print('Points before transformation: ' + str(len(pcd.points)))
+# Partially written clouds, next to processed_data/ (same filesystem for os.replace) so that
+# neither the later stages nor the stage two archive pick them up
+TMP_CLOUD_DIR = 'processed_data_tmp/'
+
+def process_cloud(job):
+    """Downsample, remove outliers and rotate one cloud, returns the point counts after each step."""
+    filename, params, source = job
+    with source.local_path('cloud/' + filename) as path:
+        pcd = o3d.io.read_point_cloud(path)
+    counts = [len(pcd.points)]
+    if params['demonstration']:
         o3d.io.write_point_cloud(PROCESSED_DATA_DIR + 'demonstration/' + 'downsampled_' + filename, pcd) ###
 
-        # Function to downsample input pointcloud into output pointcloud with a voxel
-        pcd = pcd.voxel_down_sample(voxel_size=args.voxel_size)
-        print('Points after downsample: ' + str(len(pcd.points)))
+    # Function to downsample input pointcloud into output pointcloud with a voxel
+    pcd = pcd.voxel_down_sample(voxel_size=params['voxel_size'])
+    counts.append(len(pcd.points))
 
-        # Function to remove points that are further away from their neighbors in average
-        pcd = pcd.remove_statistical_outlier(nb_neighbors=args.nb_neighbors,std_ratio=args.std_ratio)
-        pcd = pcd[0]
-        print('Points after outlier removal: ' + str(len(pcd.points)))
+    # Function to remove points that are further away from their neighbors in average
+    pcd = pcd.remove_statistical_outlier(nb_neighbors=params['nb_neighbors'],std_ratio=params['std_ratio'])
+    pcd = pcd[0]
+    counts.append(len(pcd.points))
+    if params['demonstration']:
         o3d.io.write_point_cloud(PROCESSED_DATA_DIR + 'demonstration/' + 'outlier_removed_' + filename, pcd) ###
-        
-        # Point cloud rotation --> votenet expects z=up, y=forward, x=right-ward
-        # Function rotate() seems to have bugs in o3d 0.9.0, only trial and error works
-        print('Rotating point cloud')
-        pcd = pcd.rotate(pcd.get_rotation_matrix_from_xyz([args.rotation_x,args.rotation_y,args.rotation_z]), center=False)
 
-        o3d.io.write_point_cloud(PROCESSED_DATA_DIR + 'cloud/' + filename, pcd)
-        i += 1
+    # Point cloud rotation --> votenet expects z=up, y=forward, x=right-ward
+    # Function rotate() seems to have bugs in o3d 0.9.0, only trial and error works
+    pcd = pcd.rotate(pcd.get_rotation_matrix_from_xyz(params['rotation']), center=False)
+
+    # Write to a temporary file first, an interrupted run must not leave an output that looks up to date
+    tmp_filename = TMP_CLOUD_DIR + filename
+    try:
+        o3d.io.write_point_cloud(tmp_filename, pcd)
+        os.replace(tmp_filename, PROCESSED_DATA_DIR + 'cloud/' + filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return filename, counts
+
+def is_up_to_date(source, filename):
+    """Output of a cloud exists and is newer than its input."""
+    out_filename = PROCESSED_DATA_DIR + 'cloud/' + filename
+    return os.path.exists(out_filename) and \
+        os.path.getmtime(out_filename) >= source.getmtime('cloud/' + filename)
+
+def processing_loop(source):
+    """Process all clouds in a pool of worker processes, clouds with an up to date output are skipped."""
+    filenames = natsorted(source.listdir('cloud'))
+    if not args.force:
+        filenames = [filename for filename in filenames if not is_up_to_date(source, filename)]
+    print('Processing ' + str(len(filenames)) + ' point clouds with ' + str(args.workers) + ' workers')
+    params = {'voxel_size': args.voxel_size, 'nb_neighbors': args.nb_neighbors, 'std_ratio': args.std_ratio,
+        'rotation': [args.rotation_x, args.rotation_y, args.rotation_z], 'demonstration': args.demonstration}
+    jobs = [(filename, params, source) for filename in filenames]
+    if args.workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap_unordered(process_cloud, jobs)
+    else:
+        pool = None
+        results = map(process_cloud, jobs)
+    for i, (filename, counts) in enumerate(results):
+        print('[%d/%d] %s: %d points, %d after downsample, %d after outlier removal' % ((i+1, len(jobs), filename) + tuple(counts)))
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 def make_directories():
     """Make directories for output."""
     if not os.path.exists(PROCESSED_DATA_DIR + 'cloud/'):
         os.makedirs(PROCESSED_DATA_DIR + 'cloud/')
-    if not os.path.exists(PROCESSED_DATA_DIR + 'demonstration/'):
+    # Clouds left behind by a killed run are incomplete
+    shutil.rmtree(TMP_CLOUD_DIR, ignore_errors=True)
+    os.makedirs(TMP_CLOUD_DIR)
+    if args.demonstration and not os.path.exists(PROCESSED_DATA_DIR + 'demonstration/'):
         os.makedirs(PROCESSED_DATA_DIR + 'demonstration/')
     if not os.path.exists(PROCESSED_DATA_DIR + 'image/'):
         os.makedirs(PROCESSED_DATA_DIR + 'image/')
     if not os.path.exists(PROCESSED_DATA_DIR + 'depth/'):
         os.makedirs(PROCESSED_DATA_DIR + 'depth/')
 
-def copy_remaining_files():
+def copy_remaining_files(source):
     """Copy remaining files into 'processed_data/'."""
     print('Copying images, depth maps and calib.yml')
-    copy_tree(DATA_DIR + 'image/', PROCESSED_DATA_DIR + 'image/')
-    copy_tree(DATA_DIR + 'depth/', PROCESSED_DATA_DIR + 'depth/')
-    shutil.copy2(DATA_DIR + 'calib.yml', PROCESSED_DATA_DIR + 'calib.yml')
+    if source.archive_path is None:
+        copy_tree(DATA_DIR + 'image/', PROCESSED_DATA_DIR + 'image/')
+        copy_tree(DATA_DIR + 'depth/', PROCESSED_DATA_DIR + 'depth/')
+        shutil.copy2(DATA_DIR + 'calib.yml', PROCESSED_DATA_DIR + 'calib.yml')
+        return
+    for subdir in ['image', 'depth']:
+        for filename in source.listdir(subdir):
+            source.copy(subdir + '/' + filename, PROCESSED_DATA_DIR + subdir + '/' + filename)
+    source.copy('calib.yml', PROCESSED_DATA_DIR + 'calib.yml')
 
 def main():
     
-    # Check if compressed data should be used - If yes, the 'data/' folder is emptied first and the archive is extracted into it
-    if args.compressed_data is not None:
-        for root, dirs, files in os.walk(DATA_DIR):
-            for f in files:
-                os.unlink(os.path.join(root, f))
-            for d in dirs:
-                shutil.rmtree(os.path.join(root, d))
-        zipping.read_zip_archive(args.compressed_data)
+    # Check if compressed data should be used - If yes, the files are read straight from the archive
+    source = zipping.DataSource(DATA_DIR, args.compressed_data)
 
     make_directories()
-    processing_loop()    
-    copy_remaining_files()
+    processing_loop(source)    
+    copy_remaining_files(source)
     
     if args.compress is not None:
-        zipping.create_zip_archive_stage_two(args.compress)
+        zipping.create_zip_archive_stage_two(args.compress, codec=args.codec, level=args.level)
     else: pass
 
 
@@ -95,6 +138,11 @@ if __name__ == "__main__":
     parser.add_argument("-rz", "--rotation_z", type=int, default= 0, help="Specify angle for rotation around z-axis.")
     parser.add_argument("-cd", "--compressed_data", type=str, help="Specify archive name to load extraced files from.")
     parser.add_argument("-c", "--compress", type=str, help="Specify archive name to compress extracted files.")
+    parser.add_argument("--codec", type=str, default='deflate', choices=list(zipping.CODECS.keys()), help="Compression of the archive, .jpg/.png files are always stored.")
+    parser.add_argument("--level", type=int, help="Compression level of the archive, default of the codec if not specified.")
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(), help="Number of point clouds processed in parallel.")
+    parser.add_argument("-d", "--demonstration", action="store_true", help="Also write the downsampled and outlier removed clouds to 'processed_data/demonstration/'.")
+    parser.add_argument("-f", "--force", action="store_true", help="Process all clouds, by default clouds whose output is newer than the input are skipped.")
     args = parser.parse_args()
 
     main()
\ No newline at end of file
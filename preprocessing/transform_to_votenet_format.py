@@ -37,28 +37,40 @@ def make_directories():
     if not os.path.exists(DUMP_CALIB_DIR):
         os.makedirs(DUMP_CALIB_DIR)
     
-def write_point_clouds():
-
-    for filename in natsorted(os.listdir(CLOUD_DIR)):
-        print('Transforming cloud ' + filename + ' to ' + filename.strip('.ply') + '.txt')
-        pcd = o3d.io.read_point_cloud(CLOUD_DIR + filename)
-        o3d.io.write_point_cloud(DUMP_CLOUD_DIR + filename.strip('.ply') + ".xyzrgb", pcd)
+def write_point_clouds(source, cloud_format='txt'):
+    """Write clouds as .txt (XYZRGB text), .npy (float32 XYZRGB array) or .ply (binary PLY)"""
+
+    for filename in natsorted(source.listdir('cloud')):
+        print('Transforming cloud ' + filename + ' to ' + filename.strip('.ply') + '.' + cloud_format)
+        with source.local_path('cloud/' + filename) as path:
+            pcd = o3d.io.read_point_cloud(path)
+        if cloud_format == 'npy':
+            points = np.asarray(pcd.points)
+            # Clouds without colors get black points, like the XYZRGB text the txt format writes
+            colors = np.asarray(pcd.colors) if pcd.has_colors() else np.zeros_like(points)
+            cloud = np.hstack((points, colors))
+            np.save(DUMP_CLOUD_DIR + filename.strip('.ply') + '.npy', cloud.astype(np.float32))
+        elif cloud_format == 'ply':
+            o3d.io.write_point_cloud(DUMP_CLOUD_DIR + filename.strip('.ply') + '.ply', pcd, write_ascii=False)
+        else:
+            o3d.io.write_point_cloud(DUMP_CLOUD_DIR + filename.strip('.ply') + ".xyzrgb", pcd)
     for filename in natsorted(os.listdir(DUMP_CLOUD_DIR)):
-        os.rename(DUMP_CLOUD_DIR + filename, DUMP_CLOUD_DIR + filename.strip('.xyzrgb') + '.txt')
+        if filename.endswith('.xyzrgb'):
+            os.rename(DUMP_CLOUD_DIR + filename, DUMP_CLOUD_DIR + filename.strip('.xyzrgb') + '.txt')
 
-def write_images():
+def write_images(source):
 
-    for filename in natsorted(os.listdir(IMAGE_DIR)):
+    for filename in natsorted(source.listdir('image')):
         print('Copying image ' + filename)
-        shutil.copyfile(IMAGE_DIR + filename, DUMP_IMAGE_DIR + filename)
+        source.copy('image/' + filename, DUMP_IMAGE_DIR + filename)
 
-def write_labels():
+def write_labels(source):
     """Combine 2D and 3D labels and write into one .txt file"""
 
-    for two_d_filename in natsorted(os.listdir(LABEL_2D_DIR)):
+    for two_d_filename in natsorted(source.listdir('label_2d')):
         print('Transforming label ' + two_d_filename + ' to ' + two_d_filename.strip('.json') + '.txt')
 
-        with open(LABEL_2D_DIR + two_d_filename) as f:
+        with source.open('label_2d/' + two_d_filename) as f:
                 data = json.load(f)
         
         class_name = data[0]['ObjectClassName']
@@ -70,9 +82,9 @@ def write_labels():
         label_2d = [class_name, x_top_left, y_top_left, x_bottom_right, y_bottom_right]
         np.savetxt(DUMP_LABEL_DIR + two_d_filename.strip('.json') + '.txt', label_2d, newline = ' ', fmt='%s')      
 
-    for three_d_filename in natsorted(os.listdir(LABEL_3D_DIR)):
+    for three_d_filename in natsorted(source.listdir('label_3d')):
 
-        with open(LABEL_3D_DIR + three_d_filename) as f:
+        with source.open('label_3d/' + three_d_filename) as f:
                 data = json.load(f)
         
         centroid_x = data['objects'][0]['centroid']['x']
@@ -95,9 +107,9 @@ def write_labels():
 
         np.savetxt(DUMP_LABEL_DIR + three_d_filename.strip('.json') + '.txt', label, newline = ' ', fmt='%s') 
 
-def write_calib():
+def write_calib(source):
 
-    with open(CALIB_FILE) as file:
+    with source.open('calib.yml') as file:
         calib = yaml.load(file, Loader=yaml.FullLoader)
 
     extrin = np.asarray(calib[1]['extrin'])
@@ -137,25 +149,19 @@ def write_split_files():
 
 def main():
 
-    # Check if compressed data should be used - If yes, the 'data/' folder is emptied first and the archive is extracted into it
-    if args.compressed_data is not None:
-        for root, dirs, files in os.walk(DATA_DIR):
-            for f in files:
-                os.unlink(os.path.join(root, f))
-            for d in dirs:
-                shutil.rmtree(os.path.join(root, d))
-        zipping.read_zip_archive(args.compressed_data)
+    # Check if compressed data should be used - If yes, the files are read straight from the archive
+    source = zipping.DataSource(DATA_DIR, args.compressed_data)
 
     make_directories()
-    write_point_clouds()
-    write_images()
-    write_labels()
-    write_calib()
+    write_point_clouds(source, args.cloud_format)
+    write_images(source)
+    write_labels(source)
+    write_calib(source)
     write_split_files()
-    shutil.copyfile(OBJECTCLASSES_FILE, DUMP_OBJECTCLASSES_FILE)
+    source.copy('objectclasses.json', DUMP_OBJECTCLASSES_FILE)
 
     if args.compressed_data is not None:
-        zipping.create_zip_archive_stage_four(args.compress)
+        zipping.create_zip_archive_stage_four(args.compress, codec=args.codec, level=args.level)
         shutil.rmtree(DUMP_DIR)
     
 
@@ -165,6 +171,9 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--compress", type=str, help="Specify archive name to compress transformed files.")
     parser.add_argument("-s", "--split", type=float, default = 0.9, help="Specify train/(test) split size.")
     parser.add_argument("-cd", "--compressed_data", type=str, help="Specify archive name to load extraced files from.")
+    parser.add_argument("--codec", type=str, default='deflate', choices=list(zipping.CODECS.keys()), help="Compression of the archive, .jpg/.png files are always stored.")
+    parser.add_argument("--level", type=int, help="Compression level of the archive, default of the codec if not specified.")
+    parser.add_argument("-f", "--cloud_format", type=str, default='txt', choices=['txt', 'npy', 'ply'], help="Specify point cloud file format, binary .npy/.ply are parsed much faster than .txt.")
     args = parser.parse_args()
 
     main()
\ No newline at end of file
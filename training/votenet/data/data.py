@@ -17,13 +17,18 @@ import numpy as np
 import sys
 import cv2
 import json
+import time
+import shutil
+import hashlib
 import argparse
+from multiprocessing import Pool, cpu_count
 from PIL import Image
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(BASE_DIR)
 sys.path.append(os.path.join(BASE_DIR, '../utils/'))
 import pc_util
 import utils
+from packed_data import PackedDatasetWriter, PackedDataset
 
 
 OBJECTCLASSES_JSON = 'trainval/objectclasses.json'
@@ -65,9 +70,16 @@ class data_object(object):
         img_filename = os.path.join(self.image_dir, '%04d.jpg'%(idx))
         return utils.load_image(img_filename)
 
+    def get_depth_filename(self, idx):
+        ''' First existing cloud file of a scan, binary formats are preferred over text '''
+        for ext in utils.DEPTH_EXTENSIONS:
+            depth_filename = os.path.join(self.depth_dir, '%04d%s'%(idx, ext))
+            if os.path.exists(depth_filename):
+                return depth_filename
+        return os.path.join(self.depth_dir, '%04d.txt'%(idx))
+
     def get_depth(self, idx): 
-        depth_filename = os.path.join(self.depth_dir, '%04d.txt'%(idx))
-        return utils.load_depth_points(depth_filename)
+        return utils.load_depth_points(self.get_depth_filename(idx))
 
     def get_calibration(self, idx):
         calib_filename = os.path.join(self.calib_dir, '%04d.txt'%(idx))
@@ -174,19 +186,176 @@ def data_viz(data_dir, dump_dir=os.path.join(BASE_DIR, 'data_viz_dump')):
         print('Type anything to continue to the next sample...')
         input()
 
-def extract_data(idx_filename, split, output_folder, num_point=20000,
+def compute_point_votes(pc, centroids, masks):
+    """ Ground truth votes of all points for K objects at once.
+
+    A point votes for the centroids of (up to) three objects whose OBB contains
+    it, in object order: the first object fills all three votes, the second
+    one replaces the second vote and every further object the third one.
+
+    Args:
+        pc: (N,3+C) points
+        centroids: (K,3) object centroids
+        masks: (K,N) bool, True if the point is in the object's OBB
+    Returns:
+        point_votes: (N,10) vote mask, then three votes (offsets to the centroids)
+    """
+    N = pc.shape[0]
+    K = masks.shape[0]
+    point_votes = np.zeros((N,10)) # 3 votes and 1 vote mask 
+    if K == 0:
+        return point_votes
+    num_boxes = np.cumsum(masks, 0) # K,N number of boxes up to object k containing the point
+    inside = num_boxes[-1] > 0
+    # Object of each vote slot: first box, second box, last box
+    first = np.argmax(masks, 0)
+    second = np.where(num_boxes[-1] >= 2, np.argmax(num_boxes >= 2, 0), first)
+    last = np.where(num_boxes[-1] >= 3, K-1-np.argmax(masks[::-1], 0), first)
+    pc_inside = pc[inside,0:3]
+    point_votes[inside,0] = 1
+    point_votes[inside,1:4] = centroids[first[inside]] - pc_inside
+    point_votes[inside,4:7] = centroids[second[inside]] - pc_inside
+    point_votes[inside,7:10] = centroids[last[inside]] - pc_inside
+    return point_votes
+
+def extract_scan(dataset, data_idx, num_point=20000,
     type_whitelist=DEFAULT_TYPE_WHITELIST,
     save_votes=False, skip_empty_scene=True):
+    """ Subsampled point cloud, boxes and (optionally) votes of one scan,
+    see extract_data.
+
+    Returns:
+        (pc, obbs, point_votes) of shapes (N,6), (K,8) and (N,10) (None
+        without save_votes), None if the scene is skipped
+    """
+    objects = dataset.get_label_objects(data_idx)
+
+    # Skip scenes with 0 object
+    if skip_empty_scene and (len(objects)==0 or \
+        len([obj for obj in objects if obj.classname in type_whitelist])==0):
+            return None
+
+    object_list = []
+    for obj in objects:
+        if obj.classname not in type_whitelist: continue
+        obb = np.zeros((8))
+        obb[0:3] = obj.centroid
+        # Note that compared with that in data_viz, we do not time 2 to l,w.h
+        # neither do we flip the heading angle
+        obb[3:6] = np.array([obj.l,obj.w,obj.h])
+        obb[6] = obj.heading_angle
+        obb[7] = utils.type2class[obj.classname]
+        object_list.append(obb)
+    if len(object_list)==0:
+        obbs = np.zeros((0,8))
+    else:
+        obbs = np.vstack(object_list) # (K,8)
+
+    pc_upright_depth = dataset.get_depth(data_idx)
+    pc_upright_depth_subsampled = pc_util.random_sampling(pc_upright_depth, num_point)
+
+    point_votes = None
+    if save_votes:
+        centroids = []
+        masks = []
+        for obj in objects:
+            if obj.classname not in type_whitelist: continue
+            try:
+                # Find all points in this object's OBB
+                box3d_pts_3d = utils.my_compute_box_3d(obj.centroid,
+                    np.array([obj.l,obj.w,obj.h]), obj.heading_angle)
+                masks.append(utils.extract_pc_in_box3d(\
+                    pc_upright_depth_subsampled, box3d_pts_3d)[1])
+                centroids.append(obj.centroid)
+            except:
+                print('ERROR ----',  data_idx, obj.classname)
+        point_votes = compute_point_votes(pc_upright_depth_subsampled,
+            np.array(centroids).reshape(-1,3), np.array(masks).reshape(-1,
+            pc_upright_depth_subsampled.shape[0]))
+    return pc_upright_depth_subsampled, obbs, point_votes
+
+def scan_files(output_folder, data_idx, save_votes=False):
+    """ Per scan output files of extract_data """
+    names = ['%04d_pc.npz', '%04d_bbox.npy'] + (['%04d_votes.npz'] if save_votes else [])
+    return [os.path.join(output_folder, name%(data_idx)) for name in names]
+
+def save_scan(output_folder, data_idx, pc, obbs, point_votes=None):
+    np.savez_compressed(os.path.join(output_folder,'%04d_pc.npz'%(data_idx)),
+        pc=pc)
+    np.save(os.path.join(output_folder, '%04d_bbox.npy'%(data_idx)), obbs)
+    if point_votes is not None:
+        np.savez_compressed(os.path.join(output_folder, '%04d_votes.npz'%(data_idx)),
+            point_votes = point_votes)
+
+MANIFEST_FILENAME = 'manifest.json'
+
+def file_signature(filename, old_signature=None):
+    """ mtime, size and SHA-1 of a file. The hash of old_signature is reused
+    if mtime and size did not change. """
+    st = os.stat(filename)
+    if old_signature is not None and old_signature['mtime'] == st.st_mtime \
+        and old_signature['size'] == st.st_size:
+        return old_signature
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            sha1.update(chunk)
+    return {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': sha1.hexdigest()}
+
+def load_manifest(output_folder):
+    filename = os.path.join(output_folder, MANIFEST_FILENAME)
+    if not os.path.exists(filename):
+        return {'params': None, 'scans': {}}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def save_manifest(output_folder, manifest):
+    # Write and rename, an interrupted run must not leave a broken manifest
+    filename = os.path.join(output_folder, MANIFEST_FILENAME)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+_EXTRACT_DATASET = None
+def _init_extract_worker(split, reseed=True):
+    global _EXTRACT_DATASET
+    _EXTRACT_DATASET = data_object('./trainval', split)
+    if reseed:
+        np.random.seed() # forked workers would all draw the same subsamples
+
+def _extract_scan_worker(arguments):
+    data_idx, output_folder, kwargs = arguments
+    ret = extract_scan(_EXTRACT_DATASET, data_idx, **kwargs)
+    if output_folder is not None and ret is not None:
+        # per scan files are written by the worker, only the arrays of packed
+        # datasets are sent back
+        save_scan(output_folder, data_idx, *ret)
+        ret = True
+    return data_idx, ret
+
+def extract_data(idx_filename, split, output_folder, num_point=20000,
+    type_whitelist=DEFAULT_TYPE_WHITELIST,
+    save_votes=False, skip_empty_scene=True, packed=False,
+    num_workers=1, force=False):
     """ Extract scene point clouds and 
     bounding boxes (centroids, box sizes, heading angles, semantic classes).
     Dumped point clouds and boxes are in upright depth coord.
 
+    Scans are processed by a pool of num_workers processes. A manifest in the
+    output folder records the size, mtime and hash of the cloud and label file
+    of every scan, scans whose inputs did not change since the last run are
+    not generated again (unless force is set).
+
     Args:
         idx_filename: a TXT file where each line is an int number (index)
         split: training or testing
         save_votes: whether to compute and save Ground truth votes.
         use_v1: use the SUN RGB-D V1 data
         skip_empty_scene: if True, skip scenes that contain no object (no objet in whitelist)
+        packed: if True, write all scans to the packed files of packed_data.py
+            instead of the per scan files below
+        num_workers: number of processes
+        force: if True, regenerate all scans
 
     Dumps:
         <id>_pc.npz of (N,6) where N is for number of subsampled points and 6 is
@@ -202,69 +371,102 @@ def extract_data(idx_filename, split, output_folder, num_point=20000,
 
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
-
+    kwargs = {'num_point': num_point, 'type_whitelist': type_whitelist,
+        'save_votes': save_votes, 'skip_empty_scene': skip_empty_scene}
+    params = dict(kwargs, split=split, packed=packed)
+    manifest = load_manifest(output_folder)
+    if force or manifest['params'] != params:
+        manifest = {'params': params, 'scans': {}}
+    old_packed = None
+    if packed and os.path.exists(os.path.join(output_folder, 'index.npz')):
+        old_packed = PackedDataset(output_folder)
+
+    # Find the scans whose inputs changed
+    scans = {}
+    stale_list = []
     for data_idx in data_idx_list:
-        print('------------- ', data_idx)
-        objects = dataset.get_label_objects(data_idx)
-
-        # Skip scenes with 0 object
-        if skip_empty_scene and (len(objects)==0 or \
-            len([obj for obj in objects if obj.classname in type_whitelist])==0):
-                continue
-
-        object_list = []
-        for obj in objects:
-            if obj.classname not in type_whitelist: continue
-            obb = np.zeros((8))
-            obb[0:3] = obj.centroid
-            # Note that compared with that in data_viz, we do not time 2 to l,w.h
-            # neither do we flip the heading angle
-            obb[3:6] = np.array([obj.l,obj.w,obj.h])
-            obb[6] = obj.heading_angle
-            obb[7] = utils.type2class[obj.classname]
-            object_list.append(obb)
-        if len(object_list)==0:
-            obbs = np.zeros((0,8))
-        else:
-            obbs = np.vstack(object_list) # (K,8)
-
-        pc_upright_depth = dataset.get_depth(data_idx)
-        pc_upright_depth_subsampled = pc_util.random_sampling(pc_upright_depth, num_point)
-
-        np.savez_compressed(os.path.join(output_folder,'%04d_pc.npz'%(data_idx)),
-            pc=pc_upright_depth_subsampled)
-        np.save(os.path.join(output_folder, '%04d_bbox.npy'%(data_idx)), obbs)
-       
-        if save_votes:
-            N = pc_upright_depth_subsampled.shape[0]
-            point_votes = np.zeros((N,10)) # 3 votes and 1 vote mask 
-            point_vote_idx = np.zeros((N)).astype(np.int32) # in the range of [0,2]
-            indices = np.arange(N)
-            for obj in objects:
-                if obj.classname not in type_whitelist: continue
-                try:
-                    # Find all points in this object's OBB
-                    box3d_pts_3d = utils.my_compute_box_3d(obj.centroid,
-                        np.array([obj.l,obj.w,obj.h]), obj.heading_angle)
-                    pc_in_box3d,inds = utils.extract_pc_in_box3d(\
-                        pc_upright_depth_subsampled, box3d_pts_3d)
-                    # Assign first dimension to indicate it is in an object box
-                    point_votes[inds,0] = 1
-                    # Add the votes (all 0 if the point is not in any object's OBB)
-                    votes = np.expand_dims(obj.centroid,0) - pc_in_box3d[:,0:3]
-                    sparse_inds = indices[inds] # turn dense True,False inds to sparse number-wise inds
-                    for i in range(len(sparse_inds)):
-                        j = sparse_inds[i]
-                        point_votes[j, int(point_vote_idx[j]*3+1):int((point_vote_idx[j]+1)*3+1)] = votes[i,:]
-                        # Populate votes with the fisrt vote
-                        if point_vote_idx[j] == 0:
-                            point_votes[j,4:7] = votes[i,:]
-                            point_votes[j,7:10] = votes[i,:]
-                    point_vote_idx[inds] = np.minimum(2, point_vote_idx[inds]+1)
-                except:
-                    print('ERROR ----',  data_idx, obj.classname)
-            np.savez_compressed(os.path.join(output_folder, '%04d_votes.npz'%(data_idx)),
-                point_votes = point_votes)
+        scan_name = '%04d'%(data_idx)
+        old_scan = manifest['scans'].get(scan_name, {})
+        scan = {'written': False}
+        for key, filename in [('cloud', dataset.get_depth_filename(data_idx)),
+            ('label', os.path.join(dataset.label_dir, '%04d.txt'%(data_idx)))]:
+            scan[key] = file_signature(filename, old_scan.get(key))
+        up_to_date = all(key in old_scan and scan[key]['sha1'] == old_scan[key]['sha1'] \
+            for key in ['cloud', 'label'])
+        if up_to_date and old_scan['written']:
+            # outputs must still be there
+            if packed:
+                up_to_date = old_packed is not None and scan_name in old_packed.scan_inds
+            else:
+                up_to_date = all(os.path.exists(filename) for filename in \
+                    scan_files(output_folder, data_idx, save_votes))
+        scan['written'] = up_to_date and old_scan['written']
+        scans[scan_name] = scan
+        if not up_to_date:
+            stale_list.append(data_idx)
+    stale = set(stale_list)
+    manifest['scans'] = {scan_name: manifest['scans'][scan_name] \
+        for scan_name in manifest['scans'] if scan_name in scans}
+    print('%s: %d scans, %d to generate'%(output_folder, len(data_idx_list), len(stale_list)))
+
+    tasks = [(data_idx, None if packed else output_folder, kwargs) for data_idx in stale_list]
+    if num_workers > 1 and len(tasks) > 1:
+        pool = Pool(num_workers, _init_extract_worker, (split,))
+        # packed files are written in scan order
+        results = pool.imap(_extract_scan_worker, tasks) if packed else \
+            pool.imap_unordered(_extract_scan_worker, tasks)
+    else:
+        pool = None
+        _init_extract_worker(split, reseed=False)
+        results = map(_extract_scan_worker, tasks)
+
+    def update_manifest(data_idx, written):
+        scan_name = '%04d'%(data_idx)
+        manifest['scans'][scan_name] = dict(scans[scan_name], written=written)
+
+    tic = time.time()
+    num_done = 0
+    def report_progress(data_idx):
+        print('[%d/%d] %04d  %.2f scans/s'%(num_done, len(stale_list), data_idx,
+            num_done/max(time.time()-tic, 1e-9)))
+
+    if packed:
+        # Unchanged scans are copied from the previous packed files
+        tmp_folder = output_folder.rstrip('/') + '_tmp'
+        packed_writer = PackedDatasetWriter(tmp_folder)
+        for data_idx in data_idx_list:
+            scan_name = '%04d'%(data_idx)
+            if data_idx in stale:
+                _, ret = next(results)
+                num_done += 1
+                report_progress(data_idx)
+                update_manifest(data_idx, ret is not None)
+            else:
+                manifest['scans'][scan_name] = scans[scan_name]
+                ret = old_packed.get(scan_name) if scans[scan_name]['written'] else None
+            if ret is not None:
+                packed_writer.add(scan_name, *ret)
+        packed_writer.close()
+        save_manifest(tmp_folder, manifest)
+        old_packed = None
+        shutil.rmtree(output_folder)
+        os.rename(tmp_folder, output_folder)
+    else:
+        for scan_name in scans:
+            if int(scan_name) not in stale:
+                manifest['scans'][scan_name] = scans[scan_name]
+        for data_idx, ret in results:
+            num_done += 1
+            report_progress(data_idx)
+            update_manifest(data_idx, ret is not None)
+            if num_done % 20 == 0: # resume from here if interrupted
+                save_manifest(output_folder, manifest)
+        save_manifest(output_folder, manifest)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print('%s: generated %d scans in %.1fs (%.2f scans/s)'%(output_folder, num_done,
+        time.time()-tic, num_done/max(time.time()-tic, 1e-9)))
 
     
 def get_box3d_dim_statistics(idx_filename,
@@ -358,6 +560,9 @@ if __name__=='__main__':
     parser.add_argument('--viz', action='store_true', help='Run data visualization.')
     parser.add_argument('--compute_median_size', action='store_true', help='Compute median 3D bounding box sizes for each class.')
     parser.add_argument('--gen_data', action='store_true', help='Generate dataset.')
+    parser.add_argument('--packed', action='store_true', help='Generate the dataset in the packed binary format.')
+    parser.add_argument('--num_workers', type=int, default=cpu_count(), help='Number of processes for dataset generation [default: number of CPUs].')
+    parser.add_argument('--force', action='store_true', help='Regenerate all scans, also those whose inputs did not change.')
     args = parser.parse_args()   
 
     if args.viz:
@@ -371,9 +576,11 @@ if __name__=='__main__':
     if args.gen_data:
         extract_data(os.path.join(BASE_DIR, 'trainval/train_data_idx.txt'),
             split = 'training',
-            output_folder = os.path.join(BASE_DIR, 'data_pc_bbox_votes_50k_train'),
-            save_votes=True, num_point=50000, skip_empty_scene=False)
+            output_folder = os.path.join(BASE_DIR, 'data_pc_bbox_votes_50k_train' + ('_packed' if args.packed else '')),
+            save_votes=True, num_point=50000, skip_empty_scene=False, packed=args.packed,
+            num_workers=args.num_workers, force=args.force)
         extract_data(os.path.join(BASE_DIR, 'trainval/val_data_idx.txt'),
             split = 'training',
-            output_folder = os.path.join(BASE_DIR, 'data_pc_bbox_votes_50k_val'),
-            save_votes=True, num_point=50000, skip_empty_scene=False)
+            output_folder = os.path.join(BASE_DIR, 'data_pc_bbox_votes_50k_val' + ('_packed' if args.packed else '')),
+            save_votes=True, num_point=50000, skip_empty_scene=False, packed=args.packed,
+            num_workers=args.num_workers, force=args.force)
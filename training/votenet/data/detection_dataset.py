@@ -33,6 +33,7 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 import pc_util
 import utils
 from model_util import DatasetConfig
+from packed_data import PackedDataset
 
 DC = DatasetConfig() # dataset specific config
 MAX_NUM_OBJ = 8 # maximum number of objects allowed per scene
@@ -40,14 +41,22 @@ MEAN_COLOR_RGB = np.array([0.5,0.5,0.5]) # sunrgbd color is in 0~1
 
 class DetectionVotesDataset(Dataset):
     def __init__(self, split_set='train', num_points=50000,
-        use_color=False, use_height=False, augment=False, scan_idx_list=None):
+        use_color=False, use_height=False, augment=False, scan_idx_list=None,
+        packed=False):
 
         assert(num_points<=50000)
         self.data_path = os.path.join(ROOT_DIR,'data/data_pc_bbox_votes_50k_%s'%(split_set))
 
         self.raw_data_path = os.path.join(ROOT_DIR, 'data/trainval')
-        self.scan_names = sorted(list(set([os.path.basename(x)[0:4] \
-            for x in os.listdir(self.data_path)])))
+        if packed:
+            # Packed binary files written by data.py --gen_data --packed
+            self.data_path += '_packed'
+            self.packed_data = PackedDataset(self.data_path)
+            self.scan_names = sorted(self.packed_data.scan_names)
+        else:
+            self.packed_data = None
+            self.scan_names = sorted(list(set([os.path.basename(x)[0:4] \
+                for x in os.listdir(self.data_path) if x.endswith('_pc.npz')])))
         if scan_idx_list is not None:
             self.scan_names = [self.scan_names[i] for i in scan_idx_list]
         self.num_points = num_points
@@ -77,9 +86,19 @@ class DetectionVotesDataset(Dataset):
             max_gt_bboxes: unused
         """
         scan_name = self.scan_names[idx]
-        point_cloud = np.load(os.path.join(self.data_path, scan_name)+'_pc.npz')['pc'] # Nx6
-        bboxes = np.load(os.path.join(self.data_path, scan_name)+'_bbox.npy') # K,8
-        point_votes = np.load(os.path.join(self.data_path, scan_name)+'_votes.npz')['point_votes'] # Nx10
+        if self.packed_data is not None:
+            # Zero-copy views of the memory mapped files, only copied if they
+            # are modified in place below
+            point_cloud, bboxes, point_votes = self.packed_data.get(scan_name) # Nx6, K,8, Nx10
+            if self.use_color or self.augment:
+                point_cloud = np.array(point_cloud)
+            if self.augment:
+                bboxes = np.array(bboxes)
+                point_votes = np.array(point_votes)
+        else:
+            point_cloud = np.load(os.path.join(self.data_path, scan_name)+'_pc.npz')['pc'] # Nx6
+            bboxes = np.load(os.path.join(self.data_path, scan_name)+'_bbox.npy') # K,8
+            point_votes = np.load(os.path.join(self.data_path, scan_name)+'_votes.npz')['point_votes'] # Nx10
 
         if not self.use_color:
             point_cloud = point_cloud[:,0:3]
@@ -261,7 +280,22 @@ def get_sem_cls_statistics():
             sem_cls_cnt[sem_cls[j]] += 1
     print(sem_cls_cnt)
 
+def benchmark_loader(split_set='train', num_samples=200):
+    """ Loader throughput of the per scan files and of the packed format """
+    import time
+    for packed in [False, True]:
+        d = DetectionVotesDataset(split_set, num_points=20000, use_height=True,
+            augment=True, packed=packed)
+        num_samples = min(num_samples, len(d))
+        tic = time.time()
+        for i in range(num_samples):
+            d[i]
+        print('%s: %.1f samples/s'%('packed' if packed else 'npz', num_samples/(time.time()-tic)))
+
 if __name__=='__main__':
+    if '--benchmark' in sys.argv:
+        benchmark_loader()
+        exit()
     d = DetectionVotesDataset(use_height=True, use_color=True, augment=True)
     sample = d[200]
     print(sample['vote_label'].shape, sample['vote_label_mask'].shape)
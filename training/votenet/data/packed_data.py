@@ -0,0 +1,100 @@
+''' Packed binary format of an extracted dataset split.
+
+Instead of three compressed files per scan (<id>_pc.npz, <id>_bbox.npy,
+<id>_votes.npz) all scans of a split are stored in a few flat files, so a
+sample is read by slicing memory mapped arrays without any decompression:
+
+    pc.bin      float32 (P,C)  points of all scans, XYZ and RGB in upright depth coord
+    votes.bin   float32 (P,10) vote mask and three votes of every point (optional)
+    bbox.bin    float64 (B,8)  boxes of all scans, same layout as <id>_bbox.npy
+    index.npz   scan_names (S,), pc_offsets (S+1,), bbox_offsets (S+1,), pc_dim, has_votes
+
+Scan i owns the rows pc_offsets[i]:pc_offsets[i+1] of pc.bin and votes.bin
+and the rows bbox_offsets[i]:bbox_offsets[i+1] of bbox.bin.
+'''
+
+import os
+import numpy as np
+
+PC_DTYPE = np.float32
+VOTES_DTYPE = np.float32
+BBOX_DTYPE = np.float64
+NUM_VOTE_COLUMNS = 10
+NUM_BBOX_COLUMNS = 8
+
+class PackedDatasetWriter(object):
+    ''' Appends scans to the packed files of a folder, the index is written by close() '''
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+        self.files = {name: open(os.path.join(output_folder, '%s.bin'%(name)), 'wb') \
+            for name in ['pc', 'votes', 'bbox']}
+        self.scan_names = []
+        self.pc_offsets = [0]
+        self.bbox_offsets = [0]
+        self.pc_dim = None
+        self.has_votes = None
+
+    def add(self, scan_name, pc, bboxes, point_votes=None):
+        ''' pc: (N,C), bboxes: (K,8), point_votes: (N,10) or None for all scans '''
+        if self.pc_dim is None:
+            self.pc_dim = pc.shape[1]
+            self.has_votes = point_votes is not None
+        assert(pc.shape[1] == self.pc_dim and (point_votes is not None) == self.has_votes)
+        bboxes = np.reshape(bboxes, (-1, NUM_BBOX_COLUMNS))
+        self.files['pc'].write(np.ascontiguousarray(pc, dtype=PC_DTYPE).tobytes())
+        self.files['bbox'].write(np.ascontiguousarray(bboxes, dtype=BBOX_DTYPE).tobytes())
+        if self.has_votes:
+            assert(point_votes.shape == (pc.shape[0], NUM_VOTE_COLUMNS))
+            self.files['votes'].write(np.ascontiguousarray(point_votes, dtype=VOTES_DTYPE).tobytes())
+        self.scan_names.append(scan_name)
+        self.pc_offsets.append(self.pc_offsets[-1] + pc.shape[0])
+        self.bbox_offsets.append(self.bbox_offsets[-1] + bboxes.shape[0])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        np.savez(os.path.join(self.output_folder, 'index.npz'),
+            scan_names=np.array(self.scan_names, dtype=str),
+            pc_offsets=np.array(self.pc_offsets, dtype=np.int64),
+            bbox_offsets=np.array(self.bbox_offsets, dtype=np.int64),
+            pc_dim=self.pc_dim if self.pc_dim is not None else 6,
+            has_votes=bool(self.has_votes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class PackedDataset(object):
+    ''' Read-only access to the packed files of a folder through np.memmap '''
+    def __init__(self, folder):
+        index = np.load(os.path.join(folder, 'index.npz'))
+        self.scan_names = [str(name) for name in index['scan_names']]
+        self.scan_inds = {name: i for i, name in enumerate(self.scan_names)}
+        self.pc_offsets = index['pc_offsets']
+        self.bbox_offsets = index['bbox_offsets']
+        self.pc = _memmap(os.path.join(folder, 'pc.bin'), PC_DTYPE,
+            self.pc_offsets[-1], int(index['pc_dim']))
+        self.bbox = _memmap(os.path.join(folder, 'bbox.bin'), BBOX_DTYPE,
+            self.bbox_offsets[-1], NUM_BBOX_COLUMNS)
+        self.votes = _memmap(os.path.join(folder, 'votes.bin'), VOTES_DTYPE,
+            self.pc_offsets[-1], NUM_VOTE_COLUMNS) if bool(index['has_votes']) else None
+
+    def __len__(self):
+        return len(self.scan_names)
+
+    def get(self, scan_name):
+        ''' Read-only views (N,C), (K,8) and (N,10) (None without votes) of one scan '''
+        i = self.scan_inds[scan_name]
+        pc_slice = slice(self.pc_offsets[i], self.pc_offsets[i+1])
+        bboxes = self.bbox[self.bbox_offsets[i]:self.bbox_offsets[i+1]]
+        point_votes = self.votes[pc_slice] if self.votes is not None else None
+        return self.pc[pc_slice], bboxes, point_votes
+
+def _memmap(filename, dtype, num_rows, num_cols):
+    if num_rows == 0: # empty files can not be mapped
+        return np.zeros((0, num_cols), dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(int(num_rows), num_cols))
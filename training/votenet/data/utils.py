@@ -216,8 +216,27 @@ def read_label(label_filename):
 def load_image(img_filename):
     return cv2.imread(img_filename)
 
+DEPTH_EXTENSIONS = ['.npy', '.ply', '.txt'] # binary formats first, they are parsed much faster
+
 def load_depth_points(depth_filename):
-    depth = np.loadtxt(depth_filename)
+    ''' Read a (N,6) XYZRGB (or (N,3) XYZ) cloud, the format is detected by the extension:
+        .npy float32 array, .ply binary or ascii PLY with uint8 or float colors, otherwise text '''
+    ext = os.path.splitext(depth_filename)[1].lower()
+    if ext == '.npy':
+        depth = np.load(depth_filename).astype(np.float64)
+    elif ext == '.ply':
+        from plyfile import PlyData
+        vertex = PlyData.read(depth_filename)['vertex'].data
+        names = ['x', 'y', 'z']
+        if 'red' in vertex.dtype.names:
+            names += ['red', 'green', 'blue']
+        depth = np.zeros((len(vertex), len(names)))
+        for i, name in enumerate(names):
+            depth[:,i] = vertex[name]
+        if len(names) == 6 and vertex.dtype['red'] == np.uint8:
+            depth[:,3:6] /= 255.0
+    else:
+        depth = np.loadtxt(depth_filename)
     return depth
 
 def random_shift_box2d(box2d, shift_ratio=0.1):
@@ -241,9 +260,62 @@ def in_hull(p, hull):
         hull = Delaunay(hull)
     return hull.find_simplex(p)>=0
 
+def points_in_boxes3d(pc, boxes3d):
+    ''' Test all points against all oriented boxes at once.
+    Points are rotated into the frame spanned by the edges at corner 0 of
+    each box (corners 1, 3 and 4, as in my_compute_box_3d and
+    box_util.get_3d_box), scaled by the edge lengths and compared against the
+    half-extents. Computed in the precision of pc (at least float32).
+
+    Input:
+        pc: (N,3+C) points
+        boxes3d: (K,8,3) box corners
+    Output:
+        masks: (K,N) bool, masks[k,n] is True if point n is inside box k
+        counts: (K,) number of points inside each box
+    '''
+    dtype = np.promote_types(pc.dtype, np.float32)
+    center = np.mean(boxes3d, 1) # (K,3)
+    edges = boxes3d[:,[1,3,4],:] - boxes3d[:,[0],:] # (K,3,3), one edge per row
+    to_box = np.linalg.inv(edges) # (p-center) @ to_box is in [-0.5,0.5]^3 inside the box
+    # Homogeneous points so that a single product also subtracts the center
+    proj = np.concatenate((to_box, -np.matmul(center[:,None,:], to_box)), 1).astype(dtype) # (K,4,3)
+    pc_h = np.ones((4, pc.shape[0]), dtype=dtype)
+    pc_h[0:3,:] = pc[:,0:3].T
+    masks = np.abs(np.dot(proj[:,:,0], pc_h)) <= 0.5 # (K,N)
+    for axis in range(1,3):
+        coord = np.dot(proj[:,:,axis], pc_h)
+        masks &= np.abs(coord, out=coord) <= 0.5
+    return masks, np.count_nonzero(masks, 1)
+
+def points_in_boxes3d_torch(pc, boxes3d):
+    ''' Batched torch version of points_in_boxes3d, runs on the device of pc.
+    Input:
+        pc: (B,N,3+C) tensor
+        boxes3d: (B,K,8,3) tensor of box corners
+    Output:
+        masks: (B,K,N) bool tensor
+        counts: (B,K) long tensor
+    '''
+    import torch
+    boxes3d = boxes3d.to(pc.device).double()
+    center = torch.mean(boxes3d, 2) # (B,K,3)
+    edges = boxes3d[:,:,[1,3,4],:] - boxes3d[:,:,[0],:] # (B,K,3,3)
+    to_box = torch.inverse(edges.view(-1,3,3)).view(edges.shape)
+    proj = torch.cat((to_box, -torch.matmul(center.unsqueeze(2), to_box)), 2).to(pc.dtype) # (B,K,4,3)
+    pc_h = torch.cat((pc[:,:,0:3], torch.ones_like(pc[:,:,0:1])), 2) # (B,N,4)
+    masks = []
+    for i in range(pc.shape[0]): # one cloud and axis at a time to bound the (K,N) buffers
+        mask = torch.mm(proj[i,:,:,0], pc_h[i].t()).abs_() <= 0.5 # (K,N)
+        for axis in range(1,3):
+            mask &= torch.mm(proj[i,:,:,axis], pc_h[i].t()).abs_() <= 0.5
+        masks.append(mask)
+    masks = torch.stack(masks, 0)
+    return masks, masks.long().sum(2)
+
 def extract_pc_in_box3d(pc, box3d):
     ''' pc: (N,3), box3d: (8,3) '''
-    box3d_roi_inds = in_hull(pc[:,0:3], box3d)
+    box3d_roi_inds = points_in_boxes3d(pc, box3d[None,:,:])[0][0]
     return pc[box3d_roi_inds,:], box3d_roi_inds
 
 
@@ -349,3 +421,35 @@ def load_zipped_pickle(filename):
     with gzip.open(filename, 'rb') as f:
         loaded_object = pickle.load(f)
         return loaded_object
+
+def benchmark_load_depth_points(num_points=1000000):
+    ''' Parse time per million points of the text and binary cloud formats '''
+    import time
+    import tempfile
+    from plyfile import PlyData, PlyElement
+    cloud = np.random.rand(num_points, 6)
+    cloud[:,0:3] *= 4
+    cloud[:,3:6] = np.round(cloud[:,3:6]*255)/255
+    tmp_dir = tempfile.mkdtemp()
+    np.savetxt(os.path.join(tmp_dir, 'cloud.txt'), cloud, fmt='%.10f')
+    np.save(os.path.join(tmp_dir, 'cloud.npy'), cloud.astype(np.float32))
+    vertex = np.zeros(num_points, dtype=[('x','f4'), ('y','f4'), ('z','f4'),
+        ('red','u1'), ('green','u1'), ('blue','u1')])
+    for i, name in enumerate(['x', 'y', 'z']):
+        vertex[name] = cloud[:,i]
+    for i, name in enumerate(['red', 'green', 'blue']):
+        vertex[name] = np.round(cloud[:,3+i]*255)
+    PlyData([PlyElement.describe(vertex, 'vertex')]).write(os.path.join(tmp_dir, 'cloud.ply'))
+    for ext in ['.txt', '.npy', '.ply']:
+        filename = os.path.join(tmp_dir, 'cloud'+ext)
+        tic = time.time()
+        depth = load_depth_points(filename)
+        toc = time.time() - tic
+        assert(depth.shape == cloud.shape and np.allclose(depth, cloud, atol=1e-6))
+        print('%s: %8.3f s per million points, %7.1f MB'%(ext, toc*1e6/num_points,
+            os.path.getsize(filename)/1e6))
+        os.remove(filename)
+    os.rmdir(tmp_dir)
+
+if __name__=='__main__':
+    benchmark_load_depth_points()
@@ -47,6 +47,8 @@ parser.add_argument('--nms_iou', type=float, default=0.25, help='NMS IoU thresho
 parser.add_argument('--conf_thresh', type=float, default=0.05, help='Filter out predictions with obj prob less than it. [default: 0.05]')
 parser.add_argument('--faster_eval', action='store_true', help='Faster evaluation by skippling empty bounding box removal.')
 parser.add_argument('--shuffle_dataset', action='store_true', help='Shuffle the dataset (random order).')
+parser.add_argument('--packed_data', action='store_true', help='Read the dataset from the packed binary files (data.py --gen_data --packed).')
+parser.add_argument('--ap_workers', type=int, default=2, help='Processes matching the predictions for AP while the next batches are evaluated, 0 to match in the main process [default: 2]')
 FLAGS = parser.parse_args()
 
 if FLAGS.use_cls_nms:
@@ -80,7 +82,8 @@ if FLAGS.dataset == 'standard':
     from model_util import DatasetConfig
     DATASET_CONFIG = DatasetConfig()
     TEST_DATASET = DetectionVotesDataset('val', num_points=NUM_POINT,
-        augment=False, use_color=FLAGS.use_color, use_height=(not FLAGS.no_height))
+        augment=False, use_color=FLAGS.use_color, use_height=(not FLAGS.no_height),
+        packed=FLAGS.packed_data)
 else:
     print('Unknown dataset %s. Exiting...'%(FLAGS.dataset))
     exit(-1)
@@ -128,8 +131,8 @@ CONFIG_DICT = {'remove_empty_box': (not FLAGS.faster_eval), 'use_3d_nms': FLAGS.
 
 def evaluate_one_epoch():
     stat_dict = {}
-    ap_calculator_list = [APCalculator(iou_thresh, DATASET_CONFIG.class2type) \
-        for iou_thresh in AP_IOU_THRESHOLDS]
+    # One calculator for all thresholds, the IoUs are computed only once
+    ap_calculator = APCalculator(AP_IOU_THRESHOLDS, DATASET_CONFIG.class2type, num_workers=FLAGS.ap_workers)
     net.eval() # set model to eval mode (for bn and dp)
     for batch_idx, batch_data_label in enumerate(TEST_DATALOADER):
         if batch_idx % 10 == 0:
@@ -160,8 +163,7 @@ def evaluate_one_epoch():
 
         batch_pred_map_cls = parse_predictions(end_points, CONFIG_DICT) 
         batch_gt_map_cls = parse_groundtruths(end_points, CONFIG_DICT) 
-        for ap_calculator in ap_calculator_list:
-            ap_calculator.step(batch_pred_map_cls, batch_gt_map_cls)
+        ap_calculator.step(batch_pred_map_cls, batch_gt_map_cls)
     
         # Dump evaluation results for visualization
         if batch_idx == 0:
@@ -172,9 +174,8 @@ def evaluate_one_epoch():
         log_string('eval mean %s: %f'%(key, stat_dict[key]/(float(batch_idx+1))))
 
     # Evaluate average precision
-    for i, ap_calculator in enumerate(ap_calculator_list):
+    for i, metrics_dict in enumerate(ap_calculator.compute_metrics()):
         print('-'*10, 'iou_thresh: %f'%(AP_IOU_THRESHOLDS[i]), '-'*10)
-        metrics_dict = ap_calculator.compute_metrics()
         for key in metrics_dict:
             log_string('eval %s: %f'%(key, metrics_dict[key]))
 
@@ -37,7 +37,7 @@ def decode_scores(net, end_points, num_class, num_heading_bin, num_size_cluster,
     size_residuals_normalized = net_transposed[:,:,5+num_heading_bin*2+num_size_cluster:5+num_heading_bin*2+num_size_cluster*4].view([batch_size, num_proposal, num_size_cluster, 3]) # Bxnum_proposalxnum_size_clusterx3
     end_points['size_scores'] = size_scores
     end_points['size_residuals_normalized'] = size_residuals_normalized
-    end_points['size_residuals'] = size_residuals_normalized * torch.from_numpy(mean_size_arr.astype(np.float32)).cuda().unsqueeze(0).unsqueeze(0)
+    end_points['size_residuals'] = size_residuals_normalized * torch.from_numpy(mean_size_arr.astype(np.float32)).to(net.device).unsqueeze(0).unsqueeze(0)
 
     sem_cls_scores = net_transposed[:,:,5+num_heading_bin*2+num_size_cluster*4:] # Bxnum_proposalx10
     end_points['sem_cls_scores'] = sem_cls_scores
@@ -96,7 +96,7 @@ class ProposalModule(nn.Module):
             # Random sampling from the votes
             num_seed = end_points['seed_xyz'].shape[1]
             batch_size = end_points['seed_xyz'].shape[0]
-            sample_inds = torch.randint(0, num_seed, (batch_size, self.num_proposal), dtype=torch.int).cuda()
+            sample_inds = torch.randint(0, num_seed, (batch_size, self.num_proposal), dtype=torch.int, device=xyz.device)
             xyz, features, _ = self.vote_aggregation(xyz, features, sample_inds)
         else:
             log_string('Unknown sampling strategy: %s. Exiting!'%(self.sampling))
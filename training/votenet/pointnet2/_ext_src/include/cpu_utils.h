@@ -0,0 +1,22 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+//
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#ifndef _CPU_UTILS_H
+#define _CPU_UTILS_H
+
+#include <ATen/ATen.h>
+
+#include <algorithm>
+
+#define CPU_TASK_WORK 32768
+
+// Number of outer iterations handed to one at::parallel_for task so that a
+// task covers roughly CPU_TASK_WORK inner iterations.
+inline int64_t cpu_grain_size(int64_t work_per_iter) {
+  return std::max<int64_t>(1,
+                           CPU_TASK_WORK / std::max<int64_t>(1, work_per_iter));
+}
+
+#endif
@@ -4,7 +4,9 @@
 // LICENSE file in the root directory of this source tree.
 
 #pragma once
+#ifdef WITH_CUDA
 #include <ATen/cuda/CUDAContext.h>
+#endif
 #include <torch/extension.h>
 
 #define CHECK_CUDA(x)                                          \
@@ -0,0 +1,43 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+//
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/Parallel.h>
+
+#include "cpu_utils.h"
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3)
+// output: idx(b, m, nsample)
+void query_ball_point_cpu_kernel_wrapper(int b, int n, int m, float radius,
+                                         int nsample, const float *new_xyz,
+                                         const float *xyz, int *idx) {
+  const float radius2 = radius * radius;
+  const int64_t grain = cpu_grain_size(n);
+  at::parallel_for(0, b * m, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bm = start; bm < end; ++bm) {
+      const int i = bm / m;
+      const float *pts = xyz + i * n * 3;
+      const float new_x = new_xyz[bm * 3 + 0];
+      const float new_y = new_xyz[bm * 3 + 1];
+      const float new_z = new_xyz[bm * 3 + 2];
+      int *out = idx + bm * nsample;
+      for (int k = 0, cnt = 0; k < n && cnt < nsample; ++k) {
+        const float x = pts[k * 3 + 0];
+        const float y = pts[k * 3 + 1];
+        const float z = pts[k * 3 + 2];
+        const float d2 = (new_x - x) * (new_x - x) + (new_y - y) * (new_y - y) +
+                         (new_z - z) * (new_z - z);
+        if (d2 < radius2) {
+          if (cnt == 0) {
+            for (int l = 0; l < nsample; ++l) {
+              out[l] = k;
+            }
+          }
+          out[cnt] = k;
+          ++cnt;
+        }
+      }
+    }
+  });
+}
@@ -0,0 +1,106 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+//
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/Parallel.h>
+
+#include "cpu_utils.h"
+
+// input: unknown(b, n, 3) known(b, m, 3)
+// output: dist2(b, n, 3), idx(b, n, 3)
+void three_nn_cpu_kernel_wrapper(int b, int n, int m, const float *unknown,
+                                 const float *known, float *dist2, int *idx) {
+  const int64_t grain = cpu_grain_size(m);
+  at::parallel_for(0, b * n, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bn = start; bn < end; ++bn) {
+      const int i = bn / n;
+      const float *pts = known + i * m * 3;
+      const float ux = unknown[bn * 3 + 0];
+      const float uy = unknown[bn * 3 + 1];
+      const float uz = unknown[bn * 3 + 2];
+
+      double best1 = 1e40, best2 = 1e40, best3 = 1e40;
+      int besti1 = 0, besti2 = 0, besti3 = 0;
+      for (int k = 0; k < m; ++k) {
+        const float x = pts[k * 3 + 0];
+        const float y = pts[k * 3 + 1];
+        const float z = pts[k * 3 + 2];
+        const float d =
+            (ux - x) * (ux - x) + (uy - y) * (uy - y) + (uz - z) * (uz - z);
+        if (d < best1) {
+          best3 = best2;
+          besti3 = besti2;
+          best2 = best1;
+          besti2 = besti1;
+          best1 = d;
+          besti1 = k;
+        } else if (d < best2) {
+          best3 = best2;
+          besti3 = besti2;
+          best2 = d;
+          besti2 = k;
+        } else if (d < best3) {
+          best3 = d;
+          besti3 = k;
+        }
+      }
+      dist2[bn * 3 + 0] = best1;
+      dist2[bn * 3 + 1] = best2;
+      dist2[bn * 3 + 2] = best3;
+
+      idx[bn * 3 + 0] = besti1;
+      idx[bn * 3 + 1] = besti2;
+      idx[bn * 3 + 2] = besti3;
+    }
+  });
+}
+
+// input: points(b, c, m), idx(b, n, 3), weight(b, n, 3)
+// output: out(b, c, n)
+void three_interpolate_cpu_kernel_wrapper(int b, int c, int m, int n,
+                                          const float *points, const int *idx,
+                                          const float *weight, float *out) {
+  const int64_t grain = cpu_grain_size(3 * n);
+  at::parallel_for(0, b * c, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bc = start; bc < end; ++bc) {
+      const int i = bc / c;
+      const float *points_row = points + bc * m;
+      const int *idx_b = idx + i * n * 3;
+      const float *weight_b = weight + i * n * 3;
+      float *out_row = out + bc * n;
+      for (int j = 0; j < n; ++j) {
+        out_row[j] = points_row[idx_b[j * 3 + 0]] * weight_b[j * 3 + 0] +
+                     points_row[idx_b[j * 3 + 1]] * weight_b[j * 3 + 1] +
+                     points_row[idx_b[j * 3 + 2]] * weight_b[j * 3 + 2];
+      }
+    }
+  });
+}
+
+// input: grad_out(b, c, n), idx(b, n, 3), weight(b, n, 3)
+// output: grad_points(b, c, m)
+// Every (b, c) row of grad_points is owned by exactly one task, so the
+// scatter-add needs no atomics.
+void three_interpolate_grad_cpu_kernel_wrapper(int b, int c, int n, int m,
+                                               const float *grad_out,
+                                               const int *idx,
+                                               const float *weight,
+                                               float *grad_points) {
+  const int64_t grain = cpu_grain_size(3 * n);
+  at::parallel_for(0, b * c, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bc = start; bc < end; ++bc) {
+      const int i = bc / c;
+      const float *grad_out_row = grad_out + bc * n;
+      const int *idx_b = idx + i * n * 3;
+      const float *weight_b = weight + i * n * 3;
+      float *grad_points_row = grad_points + bc * m;
+      for (int j = 0; j < n; ++j) {
+        const float g = grad_out_row[j];
+        grad_points_row[idx_b[j * 3 + 0]] += g * weight_b[j * 3 + 0];
+        grad_points_row[idx_b[j * 3 + 1]] += g * weight_b[j * 3 + 1];
+        grad_points_row[idx_b[j * 3 + 2]] += g * weight_b[j * 3 + 2];
+      }
+    }
+  });
+}
@@ -0,0 +1,151 @@
+// Copyright (c) Facebook, Inc. and its affiliates.
+//
+// This source code is licensed under the MIT license found in the
+// LICENSE file in the root directory of this source tree.
+
+#include <ATen/Parallel.h>
+
+#include "cpu_utils.h"
+
+#include <vector>
+
+// input: points(b, c, n) idx(b, m)
+// output: out(b, c, m)
+void gather_points_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                      const float *points, const int *idx,
+                                      float *out) {
+  const int64_t grain = cpu_grain_size(npoints);
+  at::parallel_for(0, b * c, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bc = start; bc < end; ++bc) {
+      const int i = bc / c;
+      const float *points_row = points + bc * n;
+      const int *idx_row = idx + i * npoints;
+      float *out_row = out + bc * npoints;
+      for (int j = 0; j < npoints; ++j) {
+        out_row[j] = points_row[idx_row[j]];
+      }
+    }
+  });
+}
+
+// input: grad_out(b, c, m) idx(b, m)
+// output: grad_points(b, c, n)
+// Every (b, c) row of grad_points is owned by exactly one task, so the
+// scatter-add needs no atomics.
+void gather_points_grad_cpu_kernel_wrapper(int b, int c, int n, int npoints,
+                                           const float *grad_out,
+                                           const int *idx, float *grad_points) {
+  const int64_t grain = cpu_grain_size(npoints);
+  at::parallel_for(0, b * c, grain, [&](int64_t start, int64_t end) {
+    for (int64_t bc = start; bc < end; ++bc) {
+      const int i = bc / c;
+      const float *grad_out_row = grad_out + bc * npoints;
+      const int *idx_row = idx + i * npoints;
+      float *grad_points_row = grad_points + bc * n;
+      for (int j = 0; j < npoints; ++j) {
+        grad_points_row[idx_row[j]] += grad_out_row[j];
+      }
+    }
+  });
+}
+
+// Minimum number of points handed to one task of the furthest point sampling
+// distance update, smaller chunks cost more in scheduling than they save.
+#define FPS_MIN_CHUNK 2048
+
+// Update the distances of points [start, end) of one cloud to the set of
+// sampled points with the newly sampled point (x1, y1, z1). Returns the index
+// of the furthest point of the range (the first one on ties) and its distance.
+static inline void fps_update_range(const float *pts, float *dists,
+                                    int64_t start, int64_t end, float x1,
+                                    float y1, float z1, float *best_out,
+                                    int *besti_out) {
+  int besti = 0;
+  float best = -1;
+  for (int64_t k = start; k < end; ++k) {
+    const float x2 = pts[k * 3 + 0];
+    const float y2 = pts[k * 3 + 1];
+    const float z2 = pts[k * 3 + 2];
+    const float mag = (x2 * x2) + (y2 * y2) + (z2 * z2);
+    if (mag <= 1e-3) continue;
+
+    const float d = (x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1) +
+                    (z2 - z1) * (z2 - z1);
+    const float d2 = std::min(d, dists[k]);
+    dists[k] = d2;
+    if (d2 > best) {
+      best = d2;
+      besti = k;
+    }
+  }
+  *best_out = best;
+  *besti_out = besti;
+}
+
+// Furthest point sampling of one cloud. With num_chunks > 1 the distance
+// update and argmax of every step run in parallel over chunks of the points,
+// followed by a max reduction over the chunks in index order, so the result
+// is identical to the serial loop.
+static void fps_cloud(int n, int m, const float *pts, float *dists, int *out,
+                      int64_t num_chunks) {
+  const int64_t chunk = (n + num_chunks - 1) / num_chunks;
+  std::vector<float> chunk_best(num_chunks);
+  std::vector<int> chunk_besti(num_chunks);
+
+  int old = 0;
+  out[0] = old;
+  for (int j = 1; j < m; ++j) {
+    const float x1 = pts[old * 3 + 0];
+    const float y1 = pts[old * 3 + 1];
+    const float z1 = pts[old * 3 + 2];
+    if (num_chunks == 1) {
+      fps_update_range(pts, dists, 0, n, x1, y1, z1, &chunk_best[0],
+                       &chunk_besti[0]);
+    } else {
+      at::parallel_for(0, num_chunks, 1, [&](int64_t start, int64_t end) {
+        for (int64_t t = start; t < end; ++t) {
+          fps_update_range(pts, dists, t * chunk,
+                           std::min<int64_t>(n, (t + 1) * chunk), x1, y1, z1,
+                           &chunk_best[t], &chunk_besti[t]);
+        }
+      });
+    }
+    int besti = 0;
+    float best = -1;
+    for (int64_t t = 0; t < num_chunks; ++t) {
+      if (chunk_best[t] > best) {
+        best = chunk_best[t];
+        besti = chunk_besti[t];
+      }
+    }
+    old = besti;
+    out[j] = old;
+  }
+}
+
+// Input dataset: (b, n, 3), tmp: (b, n)
+// Ouput idxs (b, m)
+// Same selection rule as the CUDA kernel: start at index 0 and skip points
+// with a squared norm <= 1e-3.
+// Batches with at least as many clouds as threads are parallelized over the
+// clouds, smaller batches (e.g. B=1 at inference) over the points of a cloud.
+void furthest_point_sampling_cpu_kernel_wrapper(int b, int n, int m,
+                                                const float *dataset,
+                                                float *temp, int *idxs) {
+  if (m <= 0) return;
+  const int64_t num_threads = at::get_num_threads();
+  if (b >= num_threads || n < 2 * FPS_MIN_CHUNK) {
+    at::parallel_for(0, b, 1, [&](int64_t start, int64_t end) {
+      for (int64_t i = start; i < end; ++i) {
+        fps_cloud(n, m, dataset + i * n * 3, temp + i * n, idxs + i * m, 1);
+      }
+    });
+    return;
+  }
+  const int64_t num_chunks =
+      std::min<int64_t>(num_threads, n / FPS_MIN_CHUNK);
+  for (int i = 0; i < b; ++i) {
+    fps_cloud(n, m, dataset + i * n * 3, temp + i * n, idxs + i * m,
+              num_chunks);
+  }
+}
@@ -5,6 +5,7 @@
 
 ''' Testing customized ops. '''
 
+import pytest
 import torch
 from torch.autograd import gradcheck
 import numpy as np
@@ -14,6 +15,7 @@ import sys
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(BASE_DIR)
 import pointnet2_utils
+import pointnet2_torch
 
 def test_interpolation_grad():
     batch_size = 1
@@ -29,5 +31,204 @@ def test_interpolation_grad():
     
     assert (gradcheck(interpolate_func, feats, atol=1e-1, rtol=1e-1))
 
+# ----------------------------------------
+# CPU kernels, checked against the CUDA kernels when a GPU is present
+# and against straightforward reference implementations otherwise.
+# pointnet2_utils falls back to the PyTorch backend when _ext is not built,
+# these tests are skipped then so they never pass as kernel coverage.
+# ----------------------------------------
+
+requires_ext = pytest.mark.skipif(pointnet2_utils.BACKEND != 'ext',
+    reason='pointnet2._ext is not built, the CPU kernels are not exercised')
+
+def _check_parity(cpu_out, ref_out, cuda_fn=None, atol=1e-5):
+    assert torch.allclose(cpu_out.float(), ref_out.float(), atol=atol)
+    if cuda_fn is not None and torch.cuda.is_available():
+        assert torch.allclose(cpu_out.float(), cuda_fn().cpu().float(), atol=atol)
+
+def _ref_furthest_point_sample(xyz, npoint):
+    xyz = xyz.numpy()
+    B, N, _ = xyz.shape
+    inds = np.zeros((B, npoint), dtype=np.int32)
+    for b in range(B):
+        valid = np.sum(xyz[b]**2, -1) > 1e-3
+        dists = np.full(N, 1e10, dtype=np.float32)
+        old = 0
+        for j in range(1, npoint):
+            d = np.sum((xyz[b] - xyz[b,old])**2, -1)
+            dists = np.where(valid, np.minimum(dists, d), dists)
+            old = int(np.argmax(np.where(valid, dists, -1)))
+            inds[b,j] = old
+    return torch.from_numpy(inds)
+
+def _ref_ball_query(radius, nsample, xyz, new_xyz):
+    B, npoint, _ = new_xyz.shape
+    inds = torch.zeros(B, npoint, nsample, dtype=torch.int32)
+    d2 = ((new_xyz.unsqueeze(2) - xyz.unsqueeze(1))**2).sum(-1)
+    for b in range(B):
+        for j in range(npoint):
+            found = torch.nonzero(d2[b,j] < radius**2).view(-1)[:nsample]
+            if len(found) > 0:
+                inds[b,j,:] = found[0]
+                inds[b,j,:len(found)] = found
+    return inds
+
+@requires_ext
+def test_furthest_point_sample_cpu():
+    xyz = torch.rand(2, 500, 3)
+    xyz[0,10] = 0 # points at the origin are never sampled
+    inds = pointnet2_utils.furthest_point_sample(xyz, 64)
+    _check_parity(inds, _ref_furthest_point_sample(xyz, 64),
+        lambda: pointnet2_utils.furthest_point_sample(xyz.cuda(), 64))
+    # a single large cloud is split into chunks of points over the threads
+    xyz = torch.rand(1, 20000, 3)
+    inds = pointnet2_utils.furthest_point_sample(xyz, 256)
+    _check_parity(inds, _ref_furthest_point_sample(xyz, 256),
+        lambda: pointnet2_utils.furthest_point_sample(xyz.cuda(), 256))
+
+@requires_ext
+def test_gather_operation_cpu():
+    feats = torch.randn(2, 5, 100, requires_grad=True)
+    idx = torch.randint(0, 100, (2, 30)).int()
+    out = pointnet2_utils.gather_operation(feats, idx)
+    ref = torch.gather(feats, 2, idx.long().unsqueeze(1).expand(-1, 5, -1))
+    _check_parity(out, ref, lambda: pointnet2_utils.gather_operation(feats.cuda(), idx.cuda()))
+    grad_out = torch.randn_like(out)
+    grad, = torch.autograd.grad(out, feats, grad_out)
+    grad_ref, = torch.autograd.grad(ref, feats, grad_out)
+    assert torch.allclose(grad, grad_ref, atol=1e-5)
+
+@requires_ext
+def test_ball_query_cpu():
+    xyz = torch.rand(2, 400, 3)
+    new_xyz = xyz[:, :50].contiguous()
+    inds = pointnet2_utils.ball_query(0.2, 16, xyz, new_xyz)
+    _check_parity(inds, _ref_ball_query(0.2, 16, xyz, new_xyz),
+        lambda: pointnet2_utils.ball_query(0.2, 16, xyz.cuda(), new_xyz.cuda()))
+
+@requires_ext
+def test_grouping_operation_cpu():
+    feats = torch.randn(2, 4, 100, requires_grad=True)
+    idx = torch.randint(0, 100, (2, 20, 8)).int()
+    out = pointnet2_utils.grouping_operation(feats, idx)
+    ref = torch.stack([feats[b][:, idx[b].long()] for b in range(2)], 0)
+    _check_parity(out, ref, lambda: pointnet2_utils.grouping_operation(feats.cuda(), idx.cuda()))
+    grad_out = torch.randn_like(out)
+    grad, = torch.autograd.grad(out, feats, grad_out)
+    grad_ref, = torch.autograd.grad(ref, feats, grad_out)
+    assert torch.allclose(grad, grad_ref, atol=1e-4)
+
+@requires_ext
+def test_three_nn_cpu():
+    unknown = torch.rand(2, 200, 3)
+    known = torch.rand(2, 50, 3)
+    dist, idx = pointnet2_utils.three_nn(unknown, known)
+    d2 = ((unknown.unsqueeze(2) - known.unsqueeze(1))**2).sum(-1)
+    ref_d2, ref_idx = torch.topk(d2, 3, dim=-1, largest=False)
+    _check_parity(idx, ref_idx, lambda: pointnet2_utils.three_nn(unknown.cuda(), known.cuda())[1])
+    _check_parity(dist, torch.sqrt(ref_d2), lambda: pointnet2_utils.three_nn(unknown.cuda(), known.cuda())[0])
+
+@requires_ext
+def test_three_interpolate_cpu():
+    feats = torch.randn(2, 6, 50, requires_grad=True)
+    idx = torch.randint(0, 50, (2, 120, 3)).int()
+    weight = torch.rand(2, 120, 3)
+    out = pointnet2_utils.three_interpolate(feats, idx, weight)
+    ref = torch.stack([(feats[b][:, idx[b].long()] * weight[b].unsqueeze(0)).sum(-1) for b in range(2)], 0)
+    _check_parity(out, ref, lambda: pointnet2_utils.three_interpolate(feats.cuda(), idx.cuda(), weight.cuda()))
+    grad_out = torch.randn_like(out)
+    grad, = torch.autograd.grad(out, feats, grad_out)
+    grad_ref, = torch.autograd.grad(ref, feats, grad_out)
+    assert torch.allclose(grad, grad_ref, atol=1e-4)
+
+# ----------------------------------------
+# Pure PyTorch backend, checked against the same references and against
+# the compiled extension when it is available.
+# ----------------------------------------
+
+def _ext_or_none(name):
+    try:
+        import pointnet2._ext as _ext
+    except ImportError:
+        return None
+    return getattr(_ext, name)
+
+def test_furthest_point_sample_torch():
+    xyz = torch.rand(2, 500, 3)
+    xyz[1,0] = 0
+    inds = pointnet2_torch.furthest_point_sampling(xyz, 64)
+    assert inds.dtype == torch.int32
+    _check_parity(inds, _ref_furthest_point_sample(xyz, 64))
+    ext_fn = _ext_or_none('furthest_point_sampling')
+    if ext_fn is not None:
+        _check_parity(inds, ext_fn(xyz, 64))
+
+def test_ball_query_torch():
+    xyz = torch.rand(2, 400, 3)
+    new_xyz = torch.cat([xyz[:, :50], torch.full((2, 2, 3), 5.0)], 1) # two empty balls
+    max_elements = pointnet2_torch.MAX_CHUNK_ELEMENTS
+    pointnet2_torch.MAX_CHUNK_ELEMENTS = 4000 # several query chunks
+    try:
+        inds = pointnet2_torch.ball_query(new_xyz, xyz, 0.2, 16)
+    finally:
+        pointnet2_torch.MAX_CHUNK_ELEMENTS = max_elements
+    assert inds.shape == (2, 52, 16) and inds.dtype == torch.int32
+    _check_parity(inds, _ref_ball_query(0.2, 16, xyz, new_xyz))
+    ext_fn = _ext_or_none('ball_query')
+    if ext_fn is not None:
+        _check_parity(inds, ext_fn(new_xyz, xyz, 0.2, 16))
+
+def test_ball_query_grid():
+    xyz = torch.rand(2, 3000, 3) * 2 - 1
+    new_xyz = torch.cat([xyz[:, :300], torch.full((2, 2, 3), 5.0)], 1) # two empty balls
+    max_elements = pointnet2_torch.MAX_CHUNK_ELEMENTS
+    pointnet2_torch.MAX_CHUNK_ELEMENTS = 5000 # several query chunks
+    try:
+        inds = pointnet2_torch.ball_query_grid(new_xyz, xyz, 0.15, 32)
+    finally:
+        pointnet2_torch.MAX_CHUNK_ELEMENTS = max_elements
+    assert inds.shape == (2, 302, 32) and inds.dtype == torch.int32
+    assert torch.equal(inds, pointnet2_torch.ball_query(new_xyz, xyz, 0.15, 32))
+    _check_parity(inds, _ref_ball_query(0.15, 32, xyz, new_xyz))
+
+def test_three_nn_torch():
+    unknown = torch.rand(2, 200, 3)
+    known = torch.rand(2, 50, 3)
+    dist2, idx = pointnet2_torch.three_nn(unknown, known)
+    d2 = ((unknown.unsqueeze(2) - known.unsqueeze(1))**2).sum(-1)
+    ref_d2, ref_idx = torch.topk(d2, 3, dim=-1, largest=False)
+    _check_parity(idx, ref_idx)
+    _check_parity(dist2, ref_d2)
+
+def test_gather_ops_torch():
+    feats = torch.randn(2, 4, 100)
+    idx = torch.randint(0, 100, (2, 20, 8)).int()
+    weight = torch.rand(2, 20, 3)
+    grouped = pointnet2_torch.group_points(feats, idx)
+    _check_parity(grouped, torch.stack([feats[b][:, idx[b].long()] for b in range(2)], 0))
+    _check_parity(pointnet2_torch.gather_points(feats, idx[:, :, 0]), grouped[:, :, :, 0])
+    interpolated = pointnet2_torch.three_interpolate(feats, idx[:, :, :3], weight)
+    _check_parity(interpolated, (grouped[:, :, :, :3] * weight.unsqueeze(1)).sum(-1))
+    # The gradients are the adjoints of the forward maps: <Ax, y> == <x, A'y>
+    grad_out = torch.randn_like(grouped)
+    lhs = (grouped * grad_out).sum()
+    rhs = (feats * pointnet2_torch.group_points_grad(grad_out, idx, 100)).sum()
+    assert torch.allclose(lhs, rhs, atol=1e-3)
+    grad_out = torch.randn_like(interpolated)
+    lhs = (interpolated * grad_out).sum()
+    rhs = (feats * pointnet2_torch.three_interpolate_grad(grad_out, idx[:, :, :3], weight, 100)).sum()
+    assert torch.allclose(lhs, rhs, atol=1e-3)
+
 if __name__=='__main__':
     test_interpolation_grad()
+    test_furthest_point_sample_cpu()
+    test_gather_operation_cpu()
+    test_ball_query_cpu()
+    test_grouping_operation_cpu()
+    test_three_nn_cpu()
+    test_three_interpolate_cpu()
+    test_furthest_point_sample_torch()
+    test_ball_query_torch()
+    test_ball_query_grid()
+    test_three_nn_torch()
+    test_gather_ops_torch()
@@ -15,22 +15,44 @@ import torch
 from torch.autograd import Function
 import torch.nn as nn
 import pytorch_utils as pt_utils
+import os
 import sys
+import warnings
 
 try:
     import builtins
 except:
     import __builtin__ as builtins
 
-try:
-    import pointnet2._ext as _ext
-except ImportError:
-    if not getattr(builtins, "__POINTNET2_SETUP__", False):
-        raise ImportError(
-            "Could not import _ext module.\n"
-            "Please see the setup instructions in the README: "
-            "https://github.com/erikwijmans/Pointnet2_PyTorch/blob/master/README.rst"
-        )
+# Operator backend: "ext" (compiled pointnet2._ext), "torch" (pure PyTorch,
+# see pointnet2_torch.py) or "auto" (ext if it can be imported, else torch)
+BACKEND = os.environ.get("POINTNET2_BACKEND", "auto").lower()
+assert BACKEND in ("auto", "ext", "torch"), \
+    "POINTNET2_BACKEND must be one of auto, ext, torch (got %s)" % BACKEND
+
+if BACKEND != "torch":
+    try:
+        import pointnet2._ext as _ext
+        BACKEND = "ext"
+    except ImportError:
+        if BACKEND == "ext" and not getattr(builtins, "__POINTNET2_SETUP__", False):
+            raise ImportError(
+                "Could not import _ext module.\n"
+                "Please see the setup instructions in the README: "
+                "https://github.com/erikwijmans/Pointnet2_PyTorch/blob/master/README.rst"
+            )
+        warnings.warn("Could not import pointnet2._ext, using the pure PyTorch backend.")
+        BACKEND = "torch"
+import pointnet2_torch
+if BACKEND == "torch":
+    _ext = pointnet2_torch
+
+# Ball query engine: "scan" (every center checks all points, kernel of the
+# selected backend) or "grid" (voxel hash grid, pointnet2_torch.ball_query_grid).
+# Both return the same indices; grid scales with the local point density.
+BALL_QUERY = os.environ.get("POINTNET2_BALL_QUERY", "scan").lower()
+assert BALL_QUERY in ("scan", "grid"), \
+    "POINTNET2_BALL_QUERY must be one of scan, grid (got %s)" % BALL_QUERY
 
 if False:
     # Workaround for type hints without depending on the `typing` module
@@ -279,7 +301,10 @@ class BallQuery(Function):
         torch.Tensor
             (B, npoint, nsample) tensor with the indicies of the features that form the query balls
         """
-        inds = _ext.ball_query(new_xyz, xyz, radius, nsample)
+        if BALL_QUERY == "grid":
+            inds = pointnet2_torch.ball_query_grid(new_xyz, xyz, radius, nsample)
+        else:
+            inds = _ext.ball_query(new_xyz, xyz, radius, nsample)
         ctx.mark_non_differentiable(inds)
         return inds
 
@@ -53,6 +53,7 @@ parser.add_argument('--num_target', type=int, default=256, help='Proposal number
 parser.add_argument('--vote_factor', type=int, default=1, help='Vote factor [default: 1]')
 parser.add_argument('--cluster_sampling', default='vote_fps', help='Sampling strategy for vote clusters: vote_fps, seed_fps, random [default: vote_fps]')
 parser.add_argument('--ap_iou_thresh', type=float, default=0.25, help='AP IoU threshold [default: 0.25]')
+parser.add_argument('--ap_workers', type=int, default=2, help='Processes matching the predictions for AP while the next batches are evaluated, 0 to match in the main process [default: 2]')
 parser.add_argument('--max_epoch', type=int, default=40, help='Epoch to run [default: 180]')
 parser.add_argument('--batch_size', type=int, default=1, help='Batch Size during training [default: 8]')
 parser.add_argument('--learning_rate', type=float, default=0.01, help='Initial learning rate [default: 0.001]')
@@ -65,6 +66,7 @@ parser.add_argument('--no_height', action='store_true', help='Do NOT use height
 parser.add_argument('--use_color', action='store_true', help='Use RGB color in input.')
 parser.add_argument('--overwrite', action='store_true', help='Overwrite existing log and dump folders.')
 parser.add_argument('--dump_results', action='store_true', help='Dump results.')
+parser.add_argument('--packed_data', action='store_true', help='Read the dataset from the packed binary files (data.py --gen_data --packed).')
 FLAGS = parser.parse_args()
 
 # ------------------------------------------------------------------------- GLOBAL CONFIG BEG
@@ -119,10 +121,10 @@ if FLAGS.dataset == 'standard':
     DATASET_CONFIG = DatasetConfig()
     TRAIN_DATASET = DetectionVotesDataset('train', num_points=NUM_POINT,
         augment=True,
-        use_color=FLAGS.use_color, use_height=(not FLAGS.no_height))
+        use_color=FLAGS.use_color, use_height=(not FLAGS.no_height), packed=FLAGS.packed_data)
     TEST_DATASET = DetectionVotesDataset('val', num_points=NUM_POINT,
         augment=False,
-        use_color=FLAGS.use_color, use_height=(not FLAGS.no_height))
+        use_color=FLAGS.use_color, use_height=(not FLAGS.no_height), packed=FLAGS.packed_data)
 else:
     print('Unknown dataset %s. Exiting...'%(FLAGS.dataset))
     exit(-1)
@@ -244,7 +246,7 @@ def train_one_epoch():
 def evaluate_one_epoch():
     stat_dict = {} # collect statistics
     ap_calculator = APCalculator(ap_iou_thresh=FLAGS.ap_iou_thresh,
-        class2type_map=DATASET_CONFIG.class2type)
+        class2type_map=DATASET_CONFIG.class2type, num_workers=FLAGS.ap_workers)
     net.eval() # set model to eval mode (for bn and dp)
     for batch_idx, batch_data_label in enumerate(TEST_DATALOADER):
         if batch_idx % 10 == 0:
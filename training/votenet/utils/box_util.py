@@ -116,6 +116,149 @@ def box3d_iou(corners1, corners2):
     iou = inter_vol / (vol1 + vol2 - inter_vol)
     return iou, iou_2d
 
+# -----------------------------------------------------------
+# Vectorized IoU of boxes rotated about the up axis
+# -----------------------------------------------------------
+def _box3d_iou_terms(corners):
+    ''' BEV rectangle (counter clockwise, as in box3d_iou), top and bottom
+    height and volume of (N,8,3) corners, up direction is negative Y '''
+    rect = corners[:,[3,2,1,0]][:,:,[0,2]] # (N,4,2)
+    x, y = rect[:,:,0], rect[:,:,1]
+    signed_area = 0.5*np.sum(x*np.roll(y,-1,1) - y*np.roll(x,-1,1), 1) # > 0 if counter clockwise
+    vol = np.sqrt(np.sum((corners[:,0,:]-corners[:,1,:])**2, 1)) * \
+        np.sqrt(np.sum((corners[:,1,:]-corners[:,2,:])**2, 1)) * \
+        np.sqrt(np.sum((corners[:,0,:]-corners[:,4,:])**2, 1))
+    return rect, signed_area, corners[:,0,1], corners[:,4,1], vol
+
+def _cross2d(a, b):
+    return a[...,0]*b[...,1] - a[...,1]*b[...,0]
+
+def box3d_iou_batch(corners1, corners2, eps=1e-8):
+    ''' Compute the 3D IoU of every pair of boxes, vectorized.
+    Same result as box3d_iou for boxes rotated about the up axis.
+
+    The BEV intersection of two convex quads is the convex polygon spanned
+    by the corners of each quad inside the other one and the crossings of
+    their edges. Its vertices are ordered by angle around their centroid and
+    the area follows from the shoelace formula.
+
+    Input:
+        corners1: numpy array (N,8,3), assume up direction is negative Y
+        corners2: numpy array (M,8,3), assume up direction is negative Y
+        eps: tolerance of the inside tests
+    Output:
+        iou: (N,M) 3D bounding box IoU
+        iou_2d: (N,M) bird's eye view 2D bounding box IoU
+    '''
+    rect1, area1, top1, bottom1, vol1 = _box3d_iou_terms(corners1)
+    rect2, area2, top2, bottom2, vol2 = _box3d_iou_terms(corners2)
+    p1 = rect1[:,None,:,None,:] # (N,1,4,1,2)
+    p2 = rect2[None,:,None,:,:] # (1,M,1,4,2)
+    e1 = np.roll(rect1,-1,1)[:,None,:,None,:] - p1 # edge i of box 1
+    e2 = np.roll(rect2,-1,1)[None,:,None,:,:] - p2 # edge j of box 2
+
+    # Corners of one box on the inner side of all edges of the other one
+    # (the sign of the area makes the test independent of the orientation)
+    in2 = np.all(_cross2d(e2, p1-p2)*np.sign(area2)[None,:,None,None] >= -eps, 3) # (N,M,4)
+    in1 = np.all(_cross2d(np.swapaxes(e1,2,3), np.swapaxes(p2-p1,2,3)) \
+        *np.sign(area1)[:,None,None,None] >= -eps, 3) # (N,M,4)
+    # Crossings of edge i of box 1 with edge j of box 2
+    denom = _cross2d(e1, e2) # (N,M,4,4)
+    parallel = np.abs(denom) < eps
+    denom = np.where(parallel, 1, denom)
+    t = _cross2d(p2-p1, e2)/denom
+    u = _cross2d(p2-p1, e1)/denom
+    crossing = ~parallel & (t >= -eps) & (t <= 1+eps) & (u >= -eps) & (u <= 1+eps)
+    crossing_pts = p1 + t[...,None]*e1
+
+    N, M = rect1.shape[0], rect2.shape[0]
+    pts = np.concatenate((np.broadcast_to(rect1[:,None], (N,M,4,2)),
+        np.broadcast_to(rect2[None], (N,M,4,2)), crossing_pts.reshape(N,M,16,2)), 2) # (N,M,24,2)
+    valid = np.concatenate((in2, in1, crossing.reshape(N,M,16)), 2) # (N,M,24)
+    num_valid = np.sum(valid, 2)
+    center = np.sum(pts*valid[...,None], 2) / np.maximum(num_valid, 1)[...,None]
+    angle = np.arctan2(pts[...,1]-center[...,None,1], pts[...,0]-center[...,None,0])
+    angle = np.where(valid, angle, np.inf) # invalid points go last
+    order = np.argsort(angle, 2)
+    pts = np.take_along_axis(pts, order[...,None], 2)
+    valid = np.take_along_axis(valid, order, 2)
+    # Invalid points repeat the first vertex, they add no area
+    pts = np.where(valid[...,None], pts, pts[:,:,:1,:])
+    x, y = pts[...,0], pts[...,1]
+    inter_area = 0.5*np.abs(np.sum(x*np.roll(y,-1,2) - y*np.roll(x,-1,2), 2))
+    inter_area = np.where(num_valid >= 3, inter_area, 0)
+
+    area1, area2 = np.abs(area1)[:,None], np.abs(area2)[None,:]
+    iou_2d = inter_area/(area1+area2-inter_area)
+    ymax = np.minimum(top1[:,None], top2[None,:])
+    ymin = np.maximum(bottom1[:,None], bottom2[None,:])
+    inter_vol = inter_area * np.maximum(0.0, ymax-ymin)
+    iou = inter_vol / (vol1[:,None] + vol2[None,:] - inter_vol)
+    return iou, iou_2d
+
+def box3d_iou_batch_torch(corners1, corners2, eps=None):
+    ''' Torch version of box3d_iou_batch, runs on the device of the inputs.
+    Input:
+        corners1: (N,8,3) tensor, corners2: (M,8,3) tensor
+        eps: tolerance of the inside tests, by default 1e-8 for float64
+            and 1e-5 for float32 inputs
+    Output:
+        iou, iou_2d: (N,M) tensors
+    '''
+    import torch
+    if eps is None:
+        eps = 1e-8 if corners1.dtype == torch.float64 else 1e-5
+    def terms(corners):
+        rect = corners[:,[3,2,1,0]][:,:,[0,2]]
+        x, y = rect[:,:,0], rect[:,:,1]
+        signed_area = 0.5*torch.sum(x*torch.roll(y,-1,1) - y*torch.roll(x,-1,1), 1)
+        vol = torch.norm(corners[:,0,:]-corners[:,1,:], dim=1) * \
+            torch.norm(corners[:,1,:]-corners[:,2,:], dim=1) * \
+            torch.norm(corners[:,0,:]-corners[:,4,:], dim=1)
+        return rect, signed_area, corners[:,0,1], corners[:,4,1], vol
+    rect1, area1, top1, bottom1, vol1 = terms(corners1)
+    rect2, area2, top2, bottom2, vol2 = terms(corners2)
+    p1 = rect1[:,None,:,None,:]
+    p2 = rect2[None,:,None,:,:]
+    e1 = torch.roll(rect1,-1,1)[:,None,:,None,:] - p1
+    e2 = torch.roll(rect2,-1,1)[None,:,None,:,:] - p2
+
+    in2 = (_cross2d(e2, p1-p2)*torch.sign(area2)[None,:,None,None] >= -eps).all(3)
+    in1 = (_cross2d(e1.transpose(2,3), (p2-p1).transpose(2,3)) \
+        *torch.sign(area1)[:,None,None,None] >= -eps).all(3)
+    denom = _cross2d(e1, e2)
+    parallel = denom.abs() < eps
+    denom = torch.where(parallel, torch.ones_like(denom), denom)
+    t = _cross2d(p2-p1, e2)/denom
+    u = _cross2d(p2-p1, e1)/denom
+    crossing = ~parallel & (t >= -eps) & (t <= 1+eps) & (u >= -eps) & (u <= 1+eps)
+    crossing_pts = p1 + t.unsqueeze(-1)*e1
+
+    N, M = rect1.shape[0], rect2.shape[0]
+    pts = torch.cat((rect1[:,None].expand(N,M,4,2), rect2[None].expand(N,M,4,2),
+        crossing_pts.reshape(N,M,16,2)), 2)
+    valid = torch.cat((in2, in1, crossing.reshape(N,M,16)), 2)
+    num_valid = valid.long().sum(2)
+    center = torch.sum(pts*valid.unsqueeze(-1).to(pts.dtype), 2) / \
+        num_valid.clamp(min=1).unsqueeze(-1).to(pts.dtype)
+    angle = torch.atan2(pts[...,1]-center[...,None,1], pts[...,0]-center[...,None,0])
+    angle = torch.where(valid, angle, torch.full_like(angle, float('inf')))
+    order = torch.argsort(angle, 2)
+    pts = torch.gather(pts, 2, order.unsqueeze(-1).expand(-1,-1,-1,2))
+    valid = torch.gather(valid, 2, order)
+    pts = torch.where(valid.unsqueeze(-1), pts, pts[:,:,:1,:].expand_as(pts))
+    x, y = pts[...,0], pts[...,1]
+    inter_area = 0.5*torch.sum(x*torch.roll(y,-1,2) - y*torch.roll(x,-1,2), 2).abs()
+    inter_area = torch.where(num_valid >= 3, inter_area, torch.zeros_like(inter_area))
+
+    area1, area2 = area1.abs()[:,None], area2.abs()[None,:]
+    iou_2d = inter_area/(area1+area2-inter_area)
+    ymax = torch.min(top1[:,None], top2[None,:])
+    ymin = torch.max(bottom1[:,None], bottom2[None,:])
+    inter_vol = inter_area * torch.clamp(ymax-ymin, min=0)
+    iou = inter_vol / (vol1[:,None] + vol2[None,:] - inter_vol)
+    return iou, iou_2d
+
 
 def get_iou(bb1, bb2):
     """
@@ -0,0 +1,117 @@
+''' Testing the IoU matrix based AP evaluation against the per detection loop. '''
+
+import time
+import numpy as np
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from box_util import get_3d_box
+import eval_det
+
+def _ref_eval_det_cls(pred, gt, ovthresh, use_07_metric, get_iou_func):
+    ''' VOC style greedy matching, one detection-GT pair at a time '''
+    class_recs = {img_id: {'bbox': np.array(gt[img_id]), 'det': [False]*len(gt[img_id])} for img_id in gt}
+    npos = sum(len(bbox) for bbox in gt.values())
+    dets = [(img_id, box, score) for img_id in pred for box, score in pred[img_id]]
+    confidence = np.array([score for _, _, score in dets])
+    tp = np.zeros(len(dets))
+    fp = np.zeros(len(dets))
+    for d, ind in enumerate(np.argsort(-confidence)):
+        img_id, bb, _ = dets[ind]
+        R = class_recs.get(img_id, {'bbox': np.array([]), 'det': []})
+        ovmax = -np.inf
+        for j in range(len(R['bbox'])):
+            iou = get_iou_func(bb.astype(float), R['bbox'][j].astype(float))
+            if iou > ovmax:
+                ovmax, jmax = iou, j
+        if ovmax > ovthresh and not R['det'][jmax]:
+            tp[d] = 1.
+            R['det'][jmax] = True
+        else:
+            fp[d] = 1.
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return rec, prec, eval_det.voc_ap(rec, prec, use_07_metric)
+
+def _random_dets(rng, make_box, num_img=40):
+    pred = {}
+    gt = {}
+    for img_id in range(num_img):
+        boxes = [make_box() for _ in range(rng.randint(0, 6))]
+        if img_id % 7 != 3: # some images without GT
+            gt[img_id] = boxes
+        # a few noisy detections per GT box, scores with ties, and false alarms
+        pred[img_id] = [(box + rng.randn(*box.shape)*0.15, np.round(rng.rand(), 2)) \
+            for box in boxes for _ in range(3)]
+        pred[img_id] += [(make_box(), rng.rand()) for _ in range(rng.randint(0, 3))]
+    return pred, gt
+
+def _check_eval_det_cls(pred, gt, get_iou_func):
+    for ovthresh in [0.1, 0.25, 0.5]:
+        for use_07_metric in [False, True]:
+            rec, prec, ap = eval_det.eval_det_cls(pred, gt, ovthresh, use_07_metric, get_iou_func)
+            ref_rec, ref_prec, ref_ap = _ref_eval_det_cls(pred, gt, ovthresh, use_07_metric, get_iou_func)
+            assert np.array_equal(rec, ref_rec)
+            assert np.array_equal(prec, ref_prec)
+            assert ap == ref_ap
+
+def test_eval_det_cls_obb():
+    rng = np.random.RandomState(0)
+    make_box = lambda: get_3d_box(rng.rand(3)+0.5, rng.rand()*2*np.pi, rng.rand(3)*4)
+    pred, gt = _random_dets(rng, make_box)
+    _check_eval_det_cls(pred, gt, eval_det.get_iou_obb)
+
+def test_eval_det_cls_axis_aligned():
+    rng = np.random.RandomState(1)
+    make_box = lambda: np.concatenate([rng.rand(3)*4, rng.rand(3)+0.5])
+    pred, gt = _random_dets(rng, make_box)
+    _check_eval_det_cls(pred, gt, eval_det.get_iou)
+    # IoU functions without a vectorized counterpart go through a pairwise loop
+    _check_eval_det_cls(pred, gt, lambda bb1, bb2: eval_det.get_iou(bb1, bb2))
+
+def test_eval_det_multiprocessing_thresholds():
+    rng = np.random.RandomState(2)
+    make_box = lambda: get_3d_box(rng.rand(3)+0.5, rng.rand()*2*np.pi, rng.rand(3)*4)
+    pred_all = {}
+    gt_all = {}
+    pred_cls = {}
+    gt_cls = {}
+    for classname in range(3):
+        pred_cls[classname], gt_cls[classname] = _random_dets(rng, make_box, 10)
+        for img_id in pred_cls[classname]:
+            pred_all.setdefault(img_id, []).extend([(classname, box, score) \
+                for box, score in pred_cls[classname][img_id]])
+        for img_id in gt_cls[classname]:
+            gt_all.setdefault(img_id, []).extend([(classname, box) for box in gt_cls[classname][img_id]])
+    gt_all[0].append((3, make_box())) # class without predictions
+    thresholds = [0.25, 0.5]
+    for num_workers in [1, 2]:
+        rec, prec, ap = eval_det.eval_det_multiprocessing(pred_all, gt_all, thresholds,
+            get_iou_func=eval_det.get_iou_obb, num_workers=num_workers)
+        for t, ovthresh in enumerate(thresholds):
+            assert sorted(ap[t].keys()) == [0, 1, 2, 3]
+            assert rec[t][3] == prec[t][3] == ap[t][3] == 0
+            for classname in range(3):
+                ref_rec, ref_prec, ref_ap = eval_det.eval_det_cls(pred_cls[classname], gt_cls[classname],
+                    ovthresh, get_iou_func=eval_det.get_iou_obb)
+                assert np.array_equal(rec[t][classname], ref_rec)
+                assert np.array_equal(prec[t][classname], ref_prec)
+                assert ap[t][classname] == ref_ap
+    eval_det.close_pool()
+
+def test_get_pool_keeps_pending_results():
+    # Results queued on a pool survive a request for a pool of another size
+    pending = eval_det.get_pool(1).apply_async(time.sleep, (0.5,))
+    assert eval_det.get_pool(2) is not eval_det.get_pool(1)
+    pending.get(10)
+    eval_det.close_pool()
+
+if __name__=='__main__':
+    test_eval_det_cls_obb()
+    test_eval_det_cls_axis_aligned()
+    test_eval_det_multiprocessing_thresholds()
+    test_get_pool_keeps_pending_results()
@@ -0,0 +1,77 @@
+''' Testing the batched axis aligned NMS against the per sample numpy loops. '''
+
+import torch
+import numpy as np
+
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+from nms import nms_2d_faster, nms_3d_faster, nms_3d_faster_samecls, nms_batch
+
+def _random_batch(rng, B, K, D, num_padded=8):
+    ''' (B,K,2*D) boxes, (B,K) scores, classes and valid mask. Every sample
+    has duplicated boxes with equal scores, equal scores of distinct boxes and
+    zero sized padding entries that are not valid. Distinct boxes with equal
+    scores do not overlap, otherwise the greedy picks depend on the (unstable)
+    sort order. '''
+    box_min = rng.rand(B, K, D)*4.0/D # about as dense in 2D and 3D
+    boxes = np.concatenate((box_min, box_min + rng.rand(B, K, D)*1.2 + 0.1), 2)
+    scores = rng.rand(B, K)
+    classes = rng.randint(0, 3, (B, K)).astype(np.float64)
+    valid = np.ones((B, K), dtype=bool)
+    # Ties: box 1 duplicates box 0, boxes 2 and 3 share a score
+    boxes[:,1] = boxes[:,0]
+    scores[:,1] = scores[:,0]
+    classes[:,1] = classes[:,0]
+    boxes[:,3] += 10
+    scores[:,3] = scores[:,2]
+    # Padding at the end, some of it scored higher than every real box
+    boxes[:,K-num_padded:] = 0
+    scores[:,K-num_padded:K-num_padded//2] = 2
+    scores[:,K-num_padded//2:] = scores[:,[4]]
+    valid[:,K-num_padded:] = False
+    return boxes, scores, classes, valid
+
+def _kept_rows(rows, inds):
+    ''' Kept boxes as a sorted list of tuples, picking either of two
+    identical boxes with equal scores is correct '''
+    return sorted(tuple(row) for row in rows[inds])
+
+def _check_nms_batch(D, cls_nms):
+    rng = np.random.RandomState(D + 10*cls_nms)
+    B, K = 3, 64
+    boxes, scores, classes, valid = _random_batch(rng, B, K, D)
+    if D == 2:
+        ref_nms = nms_2d_faster
+    else:
+        ref_nms = nms_3d_faster_samecls if cls_nms else nms_3d_faster
+    for old_type in [False, True]:
+        for thresh in [0.1, 0.25, 0.5]:
+            keep = nms_batch(torch.from_numpy(boxes), torch.from_numpy(scores), thresh, old_type,
+                classes=torch.from_numpy(classes) if cls_nms else None,
+                valid=torch.from_numpy(valid.astype(np.uint8))==1).numpy()
+            assert keep.shape == (B, K)
+            for b in range(B):
+                inds = np.where(valid[b])[0]
+                boxes_with_prob = np.concatenate((boxes[b,inds], scores[b,inds,None],
+                    classes[b,inds,None]), 1)
+                pick = ref_nms(boxes_with_prob, thresh, old_type)
+                assert not keep[b,~valid[b]].any()
+                assert keep[b].sum() == len(pick)
+                assert _kept_rows(boxes_with_prob, inds.searchsorted(np.where(keep[b])[0])) == \
+                    _kept_rows(boxes_with_prob, pick)
+
+def test_nms_batch_2d():
+    _check_nms_batch(2, False)
+
+def test_nms_batch_3d():
+    _check_nms_batch(3, False)
+
+def test_nms_batch_3d_samecls():
+    _check_nms_batch(3, True)
+
+if __name__=='__main__':
+    test_nms_batch_2d()
+    test_nms_batch_3d()
+    test_nms_batch_3d_samecls()
@@ -1,73 +1,289 @@
-import zipfile
-import os
-import sys
-from os.path import basename
-
-sys.path.append('../')
-
-COMPR_DATASET_DIR = '../preprocessing/compressed_datasets/'
-DATA_DIR = ''
-
-def create_zip_archive_stage_one(filename:str):
-    global DATA_DIR
-    DATA_DIR = '../preprocessing/data/'
-
-    print('Zipping data')
-    zipf = zipfile.ZipFile(COMPR_DATASET_DIR + 'extracted_' + filename + '.zip', 'w', zipfile.ZIP_DEFLATED)
-    lenDirPath = len(DATA_DIR)
-    for root, _ , files in os.walk(DATA_DIR):
-        for file in files:
-            filePath = os.path.join(root, file)
-            zipf.write(filePath , filePath[lenDirPath :] )
-    zipf.close()
-
-def create_zip_archive_stage_two(filename:str):
-    global DATA_DIR
-    DATA_DIR = '../preprocessing/processed_data/'
-
-    print('Zipping data')
-    zipf = zipfile.ZipFile(COMPR_DATASET_DIR + 'transformed_' + filename + '.zip', 'w', zipfile.ZIP_DEFLATED)
-    lenDirPath = len(DATA_DIR)
-    for root, _ , files in os.walk(DATA_DIR):
-        for file in files:
-            filePath = os.path.join(root, file)
-            zipf.write(filePath , filePath[lenDirPath :] )
-    zipf.close()
-
-def create_zip_archive_stage_three(filename:str):
-    global DATA_DIR
-    DATA_DIR = '../preprocessing/processed_data/'
-
-    print('Zipping data')
-    zipf = zipfile.ZipFile(COMPR_DATASET_DIR + 'annotated_' + filename + '.zip', 'w', zipfile.ZIP_DEFLATED)
-    lenDirPath = len(DATA_DIR)
-    for root, _ , files in os.walk(DATA_DIR):
-        for file in files:
-            filePath = os.path.join(root, file)
-            zipf.write(filePath , filePath[lenDirPath :] )
-    zipf.close()
-
-def create_zip_archive_stage_four(filename:str):
-    global DATA_DIR
-    DATA_DIR = '../preprocessing/temp_trainval/'
-
-    print('Zipping data')
-    zipf = zipfile.ZipFile(COMPR_DATASET_DIR + 'final_' + filename + '.zip', 'w', zipfile.ZIP_DEFLATED)
-    lenDirPath = len(DATA_DIR)
-    for root, _ , files in os.walk(DATA_DIR):
-        for file in files:
-            filePath = os.path.join(root, file)
-            zipf.write(filePath , filePath[lenDirPath :] )
-    zipf.close()
-
-def read_zip_archive(filename:str):
-    global COMPR_DATASET_DIR, DATA_DIR
-
-    COMPR_DATASET_DIR = '../preprocessing/compressed_datasets/'
-    DATA_DIR = '../preprocessing/data/'
-
-    print('Unzipping data')
-    with zipfile.ZipFile(COMPR_DATASET_DIR + filename, 'r') as zip:    
-        zip.extractall(DATA_DIR) 
-
-
+import zipfile
+import os
+import sys
+import bz2
+import lzma
+import zlib
+import struct
+import shutil
+import tempfile
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename
+
+sys.path.append('../')
+
+COMPR_DATASET_DIR = '../preprocessing/compressed_datasets/'
+DATA_DIR = ''
+
+CODECS = {'stored': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2, 'lzma': zipfile.ZIP_LZMA}
+# Already compressed formats, compressing them again costs time and saves next to nothing
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CHUNK_SIZE = 1 << 20
+
+# ZIP format limits, larger values are written to ZIP64 extra fields and end records
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+# LZMA1 with the properties of preset 6 (lc=3, lp=0, pb=2, 8 MiB dictionary), as written by zipfile
+LZMA_FILTER = {'id': lzma.FILTER_LZMA1, 'lc': 3, 'lp': 0, 'pb': 2, 'dict_size': 1 << 23}
+LZMA_PROPS = struct.pack('<BI', (LZMA_FILTER['pb']*5 + LZMA_FILTER['lp'])*9 + LZMA_FILTER['lc'], LZMA_FILTER['dict_size'])
+
+def compress(data:bytes, compress_type:int, level=None):
+    """Member data of a ZIP entry: raw deflate, a bzip2 stream or the ZIP flavor of raw LZMA1."""
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+    if compress_type == zipfile.ZIP_BZIP2:
+        return bz2.compress(data, 9 if level is None else level)
+    if compress_type == zipfile.ZIP_LZMA:
+        filters = [dict(LZMA_FILTER, preset=6 if level is None else level)]
+        # version of the LZMA SDK (9.4) and size of the properties, then the properties
+        return struct.pack('<BBH', 9, 4, len(LZMA_PROPS)) + LZMA_PROPS + \
+            lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters)
+    return data
+
+def decompress(data:bytes, compress_type:int):
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -15)
+    if compress_type == zipfile.ZIP_BZIP2:
+        return bz2.decompress(data)
+    if compress_type == zipfile.ZIP_LZMA:
+        return lzma.decompress(data[4+len(LZMA_PROPS):], format=lzma.FORMAT_RAW, filters=[LZMA_FILTER])
+    return data
+
+def compress_entry(read, zinfo, level=None):
+    """Read, compress and check one entry on a worker thread (zlib, bz2 and lzma release the GIL).
+
+    The compressed data is decompressed again and its CRC compared with the CRC of the input,
+    so a corrupt entry is detected before it is written. Sets the CRC and sizes of zinfo.
+    """
+    data = read()
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.file_size = len(data)
+    payload = compress(data, zinfo.compress_type, level)
+    if zinfo.compress_type != zipfile.ZIP_STORED:
+        try:
+            crc = zlib.crc32(decompress(payload, zinfo.compress_type))
+        except (zlib.error, OSError, EOFError, lzma.LZMAError) as e:
+            raise zipfile.BadZipFile(zinfo.filename + ': ' + str(e))
+        if crc != zinfo.CRC:
+            raise zipfile.BadZipFile(zinfo.filename + ': CRC of the compressed data differs from the input')
+    zinfo.compress_size = len(payload)
+    return payload
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+def _extract_version(zinfo, zip64):
+    if zinfo.compress_type == zipfile.ZIP_LZMA:
+        return 63
+    if zinfo.compress_type == zipfile.ZIP_BZIP2:
+        return 46
+    return 45 if zip64 else 20
+
+def _limit(value):
+    # Values from the ZIP64 records are 0xFFFFFFFF in the standard records
+    return 0xFFFFFFFF if value >= ZIP64_LIMIT else value
+
+def _flag_bits(zinfo):
+    # UTF-8 file names, LZMA streams end with an end of stream marker
+    return (0x800 if not zinfo.filename.isascii() else 0) | (0x02 if zinfo.compress_type == zipfile.ZIP_LZMA else 0)
+
+class ZipWriter(object):
+    """Minimal writer of ZIP archives from already compressed entries, see PKWARE's APPNOTE.TXT.
+
+    zipfile compresses entries while it writes them, which serializes the compression. This
+    writer only appends the members compressed by compress_entry and writes the central
+    directory on close, ZIP64 records are used when a size, offset or the entry count exceeds
+    the limits of the ZIP format. Entries are described by zipfile.ZipInfo objects.
+    """
+    def __init__(self, archive_path:str):
+        self.fp = open(archive_path, 'wb')
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fp.close()
+
+    def write(self, zinfo, payload:bytes):
+        zinfo.header_offset = self.fp.tell()
+        name = zinfo.filename.encode('utf-8')
+        zip64 = zinfo.file_size >= ZIP64_LIMIT or zinfo.compress_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, zinfo.file_size, zinfo.compress_size) if zip64 else b''
+        dos_date, dos_time = _dos_date_time(zinfo.date_time)
+        self.fp.write(struct.pack('<4sHHHHHLLLHH', b'PK\x03\x04', _extract_version(zinfo, zip64),
+            _flag_bits(zinfo), zinfo.compress_type, dos_time, dos_date, zinfo.CRC,
+            0xFFFFFFFF if zip64 else zinfo.compress_size, 0xFFFFFFFF if zip64 else zinfo.file_size,
+            len(name), len(extra)))
+        self.fp.write(name)
+        self.fp.write(extra)
+        self.fp.write(payload)
+        self.entries.append(zinfo)
+
+    def close(self):
+        start_dir = self.fp.tell()
+        for zinfo in self.entries:
+            name = zinfo.filename.encode('utf-8')
+            # ZIP64 extra field with the sizes and the offset that do not fit in 4 bytes, in this order
+            zip64_fields = [value for value in [zinfo.file_size, zinfo.compress_size, zinfo.header_offset] \
+                if value >= ZIP64_LIMIT]
+            extra = struct.pack('<HH%dQ'%len(zip64_fields), 1, 8*len(zip64_fields), *zip64_fields) \
+                if zip64_fields else b''
+            dos_date, dos_time = _dos_date_time(zinfo.date_time)
+            version = _extract_version(zinfo, len(zip64_fields) > 0)
+            self.fp.write(struct.pack('<4sBBBBHHHHLLLHHHHHLL', b'PK\x01\x02', version, 3, version, 0,
+                _flag_bits(zinfo), zinfo.compress_type, dos_time, dos_date, zinfo.CRC,
+                _limit(zinfo.compress_size), _limit(zinfo.file_size),
+                len(name), len(extra), 0, 0, 0, zinfo.external_attr, _limit(zinfo.header_offset)))
+            self.fp.write(name)
+            self.fp.write(extra)
+        end_dir = self.fp.tell()
+        count, size_dir = len(self.entries), end_dir - start_dir
+        if count >= ZIP_FILECOUNT_LIMIT or size_dir >= ZIP64_LIMIT or start_dir >= ZIP64_LIMIT:
+            self.fp.write(struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                count, count, size_dir, start_dir))
+            self.fp.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, end_dir, 1))
+        count = 0xFFFF if count >= ZIP_FILECOUNT_LIMIT else count
+        self.fp.write(struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0, count, count,
+            _limit(size_dir), _limit(start_dir), 0))
+        self.fp.close()
+
+def _read_file(file_path:str):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def create_zip_archive(data_dir:str, archive_path:str, codec='deflate', level=None, workers=None, source=None):
+    """Compress all files below data_dir into one archive.
+
+    Files are read and compressed on a thread pool and written in name order, at most
+    2*workers compressed files are held in memory. Every entry is checked before it is
+    written. JPG and PNG files are always stored.
+
+    Args:
+        source: [optional] DataSource the files of data_dir were produced from. Members of its
+            archive that are not in data_dir (inputs streamed from the archive) are added too.
+    """
+    compress_type = CODECS[codec]
+    workers = workers or multiprocessing.cpu_count()
+    entries = {} # {arcname: (zinfo, read)}
+    for root, dirs, files in os.walk(data_dir):
+        for file in files:
+            filePath = os.path.join(root, file)
+            zinfo = zipfile.ZipInfo.from_file(filePath, os.path.relpath(filePath, data_dir))
+            entries[zinfo.filename] = (zinfo, partial(_read_file, filePath))
+    if source is not None and source.archive_path is not None:
+        for member in source.zipf.infolist():
+            if not member.is_dir() and member.filename not in entries:
+                zinfo = zipfile.ZipInfo(member.filename, member.date_time)
+                zinfo.external_attr = member.external_attr
+                entries[zinfo.filename] = (zinfo, partial(source.zipf.read, member))
+    entries = [entries[name] for name in sorted(entries)]
+    for zinfo, read in entries:
+        zinfo.compress_type = zipfile.ZIP_STORED if zinfo.filename.lower().endswith(STORED_EXTENSIONS) else compress_type
+
+    print('Zipping data (' + str(len(entries)) + ' files, ' + codec + ', ' + str(workers) + ' workers)')
+    with ZipWriter(archive_path) as writer, ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for zinfo, read in entries:
+            pending.append((zinfo, pool.submit(compress_entry, read, zinfo, level)))
+            if len(pending) >= 2*workers:
+                zinfo, future = pending.popleft()
+                writer.write(zinfo, future.result())
+        while pending:
+            zinfo, future = pending.popleft()
+            writer.write(zinfo, future.result())
+
+def create_zip_archive_stage_one(filename:str, **kwargs):
+    create_zip_archive('../preprocessing/data/', COMPR_DATASET_DIR + 'extracted_' + filename + '.zip', **kwargs)
+
+def create_zip_archive_stage_two(filename:str, **kwargs):
+    create_zip_archive('../preprocessing/processed_data/', COMPR_DATASET_DIR + 'transformed_' + filename + '.zip', **kwargs)
+
+def create_zip_archive_stage_three(filename:str, **kwargs):
+    # With a source archive, the clouds and images were streamed from it and only the labels are in processed_data
+    create_zip_archive('../preprocessing/processed_data/', COMPR_DATASET_DIR + 'annotated_' + filename + '.zip', **kwargs)
+
+def create_zip_archive_stage_four(filename:str, **kwargs):
+    create_zip_archive('../preprocessing/temp_trainval/', COMPR_DATASET_DIR + 'final_' + filename + '.zip', **kwargs)
+
+def read_zip_archive(filename:str):
+    global COMPR_DATASET_DIR, DATA_DIR
+
+    COMPR_DATASET_DIR = '../preprocessing/compressed_datasets/'
+    DATA_DIR = '../preprocessing/data/'
+
+    print('Unzipping data')
+    with zipfile.ZipFile(COMPR_DATASET_DIR + filename, 'r') as zip:
+        zip.extractall(DATA_DIR)
+
+class DataSource(object):
+    """Input files of a stage, read from a directory or streamed straight from an archive.
+
+    Paths are relative to the directory or the archive root, e.g. 'cloud/0001.ply'. The
+    archive is opened lazily, so a source can be passed to worker processes.
+    """
+    def __init__(self, data_dir:str, archive_filename=None):
+        self.data_dir = data_dir
+        self.archive_path = COMPR_DATASET_DIR + archive_filename if archive_filename is not None else None
+        self._zipf = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_zipf'] = None
+        return state
+
+    @property
+    def zipf(self):
+        if self._zipf is None:
+            self._zipf = zipfile.ZipFile(self.archive_path, 'r')
+        return self._zipf
+
+    def listdir(self, subdir:str):
+        if self.archive_path is None:
+            return os.listdir(os.path.join(self.data_dir, subdir))
+        subdir = subdir.strip('/')
+        return [basename(name) for name in self.zipf.namelist() \
+            if not name.endswith('/') and os.path.dirname(name) == subdir]
+
+    def getmtime(self, path:str):
+        if self.archive_path is None:
+            return os.path.getmtime(os.path.join(self.data_dir, path))
+        return os.path.getmtime(self.archive_path)
+
+    def open(self, path:str):
+        """Binary file object, archive members are decompressed while reading."""
+        if self.archive_path is None:
+            return open(os.path.join(self.data_dir, path), 'rb')
+        return self.zipf.open(path)
+
+    def copy(self, path:str, dst:str):
+        with self.open(path) as fsrc, open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+    @contextmanager
+    def local_path(self, path:str):
+        """File name of a file for readers that only accept file names (e.g. open3d).
+
+        An archive member is streamed into a temporary file with the same extension,
+        which is removed again afterwards.
+        """
+        if self.archive_path is None:
+            yield os.path.join(self.data_dir, path)
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1])
+        try:
+            with self.zipf.open(path) as fsrc, os.fdopen(fd, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+            yield tmp_path
+        finally:
+            os.remove(tmp_path)
@@ -0,0 +1,87 @@
+''' Testing archive creation and reading stage inputs from archives. '''
+
+import os
+import sys
+import zipfile
+import pytest
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+import zipping
+
+def _make_data_dir(root):
+    files = {
+        'calib.yml': b'fx: 525.0\nfy: 525.0\n'*50,
+        'cloud/0001.ply': os.urandom(1000) + b'\x00'*100000,
+        'cloud/0002.ply': b'',
+        'image/0001.jpg': os.urandom(5000),
+        'image/0001.PNG': os.urandom(3000),
+    }
+    for name, data in files.items():
+        path = root.join(*name.split('/'))
+        path.dirpath().ensure(dir=True)
+        path.write_binary(data)
+    return files
+
+@pytest.mark.parametrize('codec', sorted(zipping.CODECS.keys()))
+def test_create_zip_archive(tmpdir, codec):
+    files = _make_data_dir(tmpdir.join('data'))
+    archive_path = str(tmpdir.join('data.zip'))
+    zipping.create_zip_archive(str(tmpdir.join('data')) + '/', archive_path, codec=codec, level=1, workers=2)
+    with zipfile.ZipFile(archive_path, 'r') as zipf:
+        assert zipf.testzip() is None
+        assert zipf.namelist() == sorted(files.keys())
+        for name, data in files.items():
+            assert zipf.read(name) == data
+            stored = name.lower().endswith(zipping.STORED_EXTENSIONS)
+            assert zipf.getinfo(name).compress_type == \
+                (zipfile.ZIP_STORED if stored else zipping.CODECS[codec])
+
+def test_data_source(tmpdir, monkeypatch):
+    files = _make_data_dir(tmpdir.join('data'))
+    zipping.create_zip_archive(str(tmpdir.join('data')), str(tmpdir.join('data.zip')), workers=1)
+    monkeypatch.setattr(zipping, 'COMPR_DATASET_DIR', str(tmpdir) + '/')
+    for source in [zipping.DataSource(str(tmpdir.join('data'))), zipping.DataSource(None, 'data.zip')]:
+        assert sorted(source.listdir('cloud')) == ['0001.ply', '0002.ply']
+        with source.open('calib.yml') as f:
+            assert f.read() == files['calib.yml']
+        with source.local_path('cloud/0001.ply') as path:
+            assert path.endswith('.ply')
+            with open(path, 'rb') as f:
+                assert f.read() == files['cloud/0001.ply']
+        dst = str(tmpdir.join('copy.jpg'))
+        source.copy('image/0001.jpg', dst)
+        assert open(dst, 'rb').read() == files['image/0001.jpg']
+
+def test_compress_entry_checks_crc(monkeypatch):
+    monkeypatch.setattr(zipping, 'compress', lambda data, compress_type, level=None: b'corrupt')
+    for codec in ['deflate', 'bzip2', 'lzma']:
+        zinfo = zipfile.ZipInfo('calib.yml')
+        zinfo.compress_type = zipping.CODECS[codec]
+        with pytest.raises(zipfile.BadZipFile):
+            zipping.compress_entry(lambda: b'fx: 525.0\n', zinfo)
+
+def test_zip64(tmpdir, monkeypatch):
+    # ZIP64 records for every size, offset and the entry count
+    monkeypatch.setattr(zipping, 'ZIP64_LIMIT', 0)
+    monkeypatch.setattr(zipping, 'ZIP_FILECOUNT_LIMIT', 0)
+    files = _make_data_dir(tmpdir.join('data'))
+    archive_path = str(tmpdir.join('data.zip'))
+    zipping.create_zip_archive(str(tmpdir.join('data')), archive_path, workers=2)
+    with zipfile.ZipFile(archive_path, 'r') as zipf:
+        assert zipf.testzip() is None
+        assert {name: zipf.read(name) for name in zipf.namelist()} == files
+
+def test_stage_inputs_from_source_archive(tmpdir, monkeypatch):
+    # Inputs streamed from the source archive end up in the new archive next to the new files
+    files = _make_data_dir(tmpdir.join('data'))
+    zipping.create_zip_archive(str(tmpdir.join('data')), str(tmpdir.join('extracted.zip')), codec='lzma')
+    monkeypatch.setattr(zipping, 'COMPR_DATASET_DIR', str(tmpdir) + '/')
+    tmpdir.join('labels', 'label_3d').ensure(dir=True)
+    tmpdir.join('labels', 'label_3d', '0001.json').write_binary(b'{}')
+    tmpdir.join('labels', 'calib.yml').write_binary(b'fx: 1.0\n')
+    zipping.create_zip_archive(str(tmpdir.join('labels')), str(tmpdir.join('annotated.zip')),
+        source=zipping.DataSource(None, 'extracted.zip'))
+    files.update({'label_3d/0001.json': b'{}', 'calib.yml': b'fx: 1.0\n'})
+    with zipfile.ZipFile(str(tmpdir.join('annotated.zip')), 'r') as zipf:
+        assert zipf.namelist() == sorted(files.keys())
+        assert {name: zipf.read(name) for name in zipf.namelist()} == files